@@ -0,0 +1,264 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory profile of the BulkBuffer of the Elastic2 DocManager.
+
+A buffer is filled with a mix of inserts and updates of documents of a given
+size until it reaches ``chunk_size`` and is sent to an in-memory stand-in for
+Elasticsearch. tracemalloc measures the memory held by the full buffer, the
+peak while it is sent (including the mget responses held by
+``update_sources`` and the serialized bulk requests) and what is still held
+afterwards. The memory used by ``insert_file`` for large attachments is
+measured the same way.
+
+Run it from the root of the repository to print a report which can be
+diffed between versions and used to size the memory limits of the
+connector::
+
+  python benchmarks/elastic2_memory.py > memory.txt
+  python benchmarks/elastic2_memory.py --chunk-sizes 50000 --doc-sizes 2000
+"""
+import argparse
+import json
+import random
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_doc_manager import (
+    BufferedOperation)
+
+from tests.fakes import FakeElasticsearch, fake_doc_manager
+
+CHUNK_SIZES = (1000, 5000)
+DOC_SIZES = (100, 1000, 4000)
+UPDATE_RATIOS = (0.0, 0.5, 1.0)
+ATTACHMENT_SIZES = (1 << 20, 16 << 20)
+
+
+def deep_size(obj, seen=None):
+    """Get the size of an object and of the objects it references.
+
+    Objects referenced several times are only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif isinstance(obj, BufferedOperation):
+        for name in BufferedOperation.__slots__:
+            size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+class MemoryElasticsearch(FakeElasticsearch):
+    """Stand-in for Elasticsearch which does not keep what is written to
+    it, so that only the memory of the DocManager is measured, and which
+    records the size of the mget responses.
+
+    Responses are decoded from JSON like the ones of the real client, so
+    they do not share objects with the stored documents.
+    """
+
+    def __init__(self, meta_index_name):
+        super(MemoryElasticsearch, self).__init__(meta_index_name)
+        self.mget_size = 0
+
+    def bulk(self, body, filter_path=None):
+        self.requests += 1
+        return {'errors': False}
+
+    def mget(self, body, realtime=True):
+        resp = json.loads(json.dumps(
+            super(MemoryElasticsearch, self).mget(body, realtime)))
+        self.mget_size += deep_size(resp)
+        return resp
+
+
+class FakeGridFSFile(object):
+    """GridFS file with the methods used by insert_file."""
+
+    def __init__(self, doc_id, data):
+        self.doc_id = doc_id
+        self.data = data
+
+    def get_metadata(self):
+        return {'_id': self.doc_id, 'filename': 'file-%s' % self.doc_id,
+                'length': len(self.data)}
+
+    def read(self):
+        return self.data
+
+
+def _payload(doc_id, doc_size):
+    """Get a distinct string of about doc_size characters."""
+    return doc_id.ljust(doc_size, 'x')
+
+
+def _workload(operations, update_ratio, seed=0):
+    """Get the shuffled (kind, document id) of the operations."""
+    updates = int(round(operations * update_ratio))
+    workload = ([('update', 'u%d' % i) for i in range(updates)] +
+                [('insert', 'i%d' % i) for i in range(operations - updates)])
+    random.Random(seed).shuffle(workload)
+    return workload
+
+
+def _wait_for_fetches(buf):
+    for _, fetch in buf.fetches:
+        fetch.wait()
+
+
+def profile_buffer(chunk_size, doc_size, update_ratio):
+    """Measure the memory of a buffer of chunk_size operations.
+
+    Updates are made to documents which are only in Elasticsearch, so
+    their sources are retrieved with mget. Returns a dict of sizes in
+    bytes.
+    """
+    docman = fake_doc_manager(MemoryElasticsearch, chunk_size=chunk_size)
+    elastic = docman.elastic
+    buf = docman.BulkBuffer
+    workload = _workload(chunk_size, update_ratio)
+    for kind, doc_id in workload:
+        if kind == 'update':
+            elastic.docs[('test', 'test', doc_id)] = {
+                'payload': _payload(doc_id, doc_size), 'n': 1}
+    update_spec = {'$set': {'n': 2}}
+
+    def operate(kind, doc_id, timestamp):
+        if kind == 'insert':
+            # Inserted documents are read from the oplog while tracing,
+            # they are only kept alive by the buffer
+            doc = {'_id': doc_id, 'payload': _payload(doc_id, doc_size),
+                   'n': 1}
+            docman.upsert(doc, 'test.test', timestamp)
+        else:
+            docman.update(doc_id, update_spec, 'test.test', timestamp)
+
+    timestamp = 1 << 32
+    tracemalloc.start()
+    try:
+        for kind, doc_id in workload[:-1]:
+            timestamp += 1
+            operate(kind, doc_id, timestamp)
+        # Sources prefetched while buffering are held by the buffer too
+        _wait_for_fetches(buf)
+        buffered, _ = tracemalloc.get_traced_memory()
+        report = {
+            'buffered': buffered,
+            'action_buffer': deep_size(buf.action_buffer),
+            'sources': deep_size(buf.sources),
+            'doc_to_update': deep_size(buf.doc_to_update),
+        }
+        # The last operation fills the buffer, which is then sent
+        operate(workload[-1][0], workload[-1][1], timestamp + 1)
+        report['retained'], report['peak'] = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        docman.stop()
+    report['mget'] = elastic.mget_size
+    report['bulk_requests'] = elastic.requests
+    return report
+
+
+def profile_insert_file(size):
+    """Measure the memory of inserting a file of the given size."""
+    docman = fake_doc_manager(MemoryElasticsearch, chunk_size=1000)
+    f = FakeGridFSFile('f1', b'\0' * size)
+
+    tracemalloc.start()
+    try:
+        docman.insert_file(f, 'test.test', 1 << 32)
+        buffered, _ = tracemalloc.get_traced_memory()
+        docman.commit()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        docman.stop()
+    return {'buffered': buffered, 'peak': peak, 'retained': retained}
+
+
+def _kib(size):
+    return int(round(size / 1024.0))
+
+
+def report_lines(chunk_sizes=CHUNK_SIZES, doc_sizes=DOC_SIZES,
+                 update_ratios=UPDATE_RATIOS,
+                 attachment_sizes=ATTACHMENT_SIZES):
+    """Generate the lines of the memory report.
+
+    Sizes are in KiB, except the bytes per buffered operation, so that
+    reports made by different versions can be compared with diff.
+    """
+    yield '# BulkBuffer memory, KiB unless noted'
+    yield '%7s %6s %6s %9s %9s %9s %9s %9s %9s %9s %8s' % (
+        'chunk', 'doc', 'update', 'buffered', 'B/op', 'peak', 'retained',
+        'actions', 'sources', 'to_update', 'mget')
+    for chunk_size in chunk_sizes:
+        for doc_size in doc_sizes:
+            for update_ratio in update_ratios:
+                r = profile_buffer(chunk_size, doc_size, update_ratio)
+                yield '%7d %6d %6.2f %9d %9d %9d %9d %9d %9d %9d %8d' % (
+                    chunk_size, doc_size, update_ratio, _kib(r['buffered']),
+                    r['buffered'] // chunk_size, _kib(r['peak']),
+                    _kib(r['retained']), _kib(r['action_buffer']),
+                    _kib(r['sources']), _kib(r['doc_to_update']),
+                    _kib(r['mget']))
+    yield ''
+    yield '# insert_file memory, KiB'
+    yield '%10s %9s %9s %9s %11s' % (
+        'attachment', 'buffered', 'peak', 'retained', 'peak/size')
+    for size in attachment_sizes:
+        r = profile_insert_file(size)
+        yield '%10d %9d %9d %9d %11.1f' % (
+            _kib(size), _kib(r['buffered']), _kib(r['peak']),
+            _kib(r['retained']), float(r['peak']) / size)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the memory profile of the BulkBuffer.')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=CHUNK_SIZES)
+    parser.add_argument('--doc-sizes', type=int, nargs='+',
+                        default=DOC_SIZES)
+    parser.add_argument('--update-ratios', type=float, nargs='+',
+                        default=UPDATE_RATIOS)
+    parser.add_argument('--attachment-sizes', type=int, nargs='+',
+                        default=ATTACHMENT_SIZES,
+                        help='Sizes of the inserted files in bytes.')
+    args = parser.parse_args()
+    if tracemalloc is None:
+        parser.error('tracemalloc requires Python 3.4 or later')
+    for line in report_lines(args.chunk_sizes, args.doc_sizes,
+                             args.update_ratios, args.attachment_sizes):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio variant of the Elasticsearch DocManager.
+
+Operations are buffered exactly like in the Elasticsearch DocManager, but
+bulk and mget requests are sent by an asyncio event loop running in its own
+thread, so that many of them can be in flight at the same time. Requests which
+touch the same documents are still applied in order, unless the documents are
+versioned by Elasticsearch with the externalVersioning option.
+
+Requires Python 3.5 or later and elasticsearch-async.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+try:
+    from elasticsearch_async import AsyncElasticsearch
+except ImportError:
+    raise ImportError(
+        "Error: elasticsearch-async "
+        "(https://pypi.python.org/pypi/elasticsearch-async) is not "
+        "installed.\n"
+        "Install with:\n"
+        "  pip install elastic2-doc-manager[elastic5,async]\n"
+    )
+
+from elasticsearch.helpers import BulkIndexError
+
+from mongo_connector import errors
+from mongo_connector.doc_managers import elastic2_doc_manager
+from mongo_connector.doc_managers.elastic2_doc_manager import (
+    BULK_FILTER_PATH, bulk_bodies, bulk_failures, wrap_exceptions)
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BULK_CONCURRENCY = 4
+"""The default number of concurrent bulk requests."""
+
+__version__ = elastic2_doc_manager.__version__
+"""Elasticsearch 2.X asyncio DocManager version."""
+
+
+def _action_keys(actions):
+    """Get the documents written by a list of actions."""
+    return set((action['_index'], action.get('_type'), action['_id'])
+               for action in actions)
+
+
+class _AsyncResult(object):
+    """Expose a concurrent future like a multiprocessing AsyncResult."""
+    def __init__(self, future):
+        self._future = future
+
+    def get(self):
+        return self._future.result()
+
+
+class DocManager(elastic2_doc_manager.DocManager):
+    """Elasticsearch DocManager sending requests from an asyncio event loop.
+
+    In addition to the options of the Elasticsearch DocManager, accepts
+    `bulkConcurrency`, the number of bulk requests in flight at the same
+    time. mget requests in flight are limited by `mgetConcurrency`.
+    """
+
+    def __init__(self, url, **kwargs):
+        for option in ('aws', 'spoolDirectory', 'shardAwareBulk',
+                       'fingerprintCacheSize', 'priorityLanes',
+                       'shadowResync', 'sinkDirectory'):
+            if option in kwargs:
+                raise errors.InvalidConfiguration(
+                    'Elastic asyncio DocManager does not support the "%s" '
+                    'option' % option)
+        self.bulk_concurrency = max(
+            kwargs.get('bulkConcurrency', DEFAULT_BULK_CONCURRENCY), 1)
+        mget_concurrency = max(kwargs.get(
+            'mgetConcurrency', elastic2_doc_manager.DEFAULT_MGET_CONCURRENCY),
+            1)
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+        # Bulk requests in flight, only accessed from the event loop
+        # Format: [ (future, set of (_index, _type, _id)) ]
+        self._in_flight = []
+        # Submitted bulk requests, accessed from the calling threads
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        # Limit the number of buffers waiting to be sent, so that producers
+        # are slowed down instead of queueing an unbounded amount of memory
+        self._submit_slots = threading.BoundedSemaphore(
+            2 * self.bulk_concurrency)
+
+        hosts = url if isinstance(url, list) else [url]
+        self.async_elastic = self._run(self._create_client(
+            hosts, kwargs.get('clientOptions', {}),
+            mget_concurrency)).result()
+
+        super(DocManager, self).__init__(url, **kwargs)
+
+    def _run(self, coro):
+        """Schedule a coroutine on the event loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _create_client(self, hosts, client_options, mget_concurrency):
+        self._bulk_semaphore = asyncio.Semaphore(self.bulk_concurrency)
+        self._mget_semaphore = asyncio.Semaphore(mget_concurrency)
+        return AsyncElasticsearch(hosts=hosts, loop=self._loop,
+                                  **client_options)
+
+    def _conflicts(self, keys):
+        """Get the bulk requests in flight writing any of the keys."""
+        return [future for future, written in self._in_flight
+                if not keys.isdisjoint(written)]
+
+    async def _send_actions(self, actions, checkpoint, timestamps=None,
+                            operations=None):
+        """Send actions with bulk requests, one after another.
+
+        Writes to the same document may fall into consecutive requests, so
+        the requests of one call are never in flight at the same time. The
+        requests of different calls are. Ignored writes of the buffered
+        `operations` are logged.
+
+        Returns the list of failed items.
+        """
+        keys = _action_keys(actions)
+        # Externally versioned writes can be applied in any order
+        conflicts = [] if self.external_versioning else self._conflicts(keys)
+        # Register before waiting so that requests submitted later wait for
+        # this one
+        entry = (self._loop.create_future(), keys)
+        self._in_flight.append(entry)
+        try:
+            if conflicts:
+                await asyncio.wait(conflicts)
+            failures = []
+            stale = []
+            for body, _ in bulk_bodies(
+                    self.async_elastic.transport.serializer, actions,
+                    self.chunk_size):
+                failures.extend(await self._send_body(body, stale))
+            if timestamps:
+                self.lag_tracker.acknowledged(timestamps)
+            if stale and operations is not None:
+                self._warn_stale(stale, operations)
+            if failures:
+                LOG.error("Bulk request finished with errors: %r", failures)
+            elif checkpoint:
+                await self._loop.run_in_executor(
+                    None, self._save_checkpoint, checkpoint)
+            return failures
+        finally:
+            entry[0].set_result(None)
+            self._in_flight.remove(entry)
+
+    async def _send_body(self, body, stale=None):
+        async with self._bulk_semaphore:
+            resp = await self.async_elastic.bulk(
+                body, filter_path=BULK_FILTER_PATH)
+        return bulk_failures(resp, stale)
+
+    async def _mget_async(self, docs):
+        # Documents being written must be read after the write
+        conflicts = self._conflicts(_action_keys(docs))
+        if conflicts:
+            await asyncio.wait(conflicts)
+        async with self._mget_semaphore:
+            resp = await self.async_elastic.mget(body={'docs': docs},
+                                                 realtime=True)
+        return resp['docs']
+
+    def fetch_sources(self, docs):
+        """Start retrieving documents on the event loop."""
+        return _AsyncResult(self._run(self._mget_async(docs)))
+
+    def _submit(self, actions, checkpoint=None, timestamps=None,
+                operations=None):
+        """Schedule actions to be sent without waiting for the response."""
+        self._submit_slots.acquire()
+        future = self._run(self._send_actions(actions, checkpoint,
+                                              timestamps, operations))
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self._submit_slots.release()
+        with self._pending_lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            LOG.error("Bulk request failed with exception",
+                      exc_info=future.exception())
+
+    def _send_buffer(self, buf):
+        """Schedule the operations of one buffer shard to be sent."""
+        with buf.lock:
+            checkpoint = buf.checkpoint
+            timestamps = buf.newest_timestamps()
+            operations = buf.action_buffer
+            action_buffer = buf.get_buffer()
+            if action_buffer:
+                # Submitted while holding the lock to keep buffers in order
+                self._submit(action_buffer, checkpoint, timestamps,
+                             operations)
+
+    def wait_for_pending(self):
+        """Wait until all submitted bulk requests have been answered."""
+        with self._pending_lock:
+            pending = list(self._pending)
+        if pending:
+            concurrent.futures.wait(pending)
+
+    def _after_flush_namespace(self):
+        self.wait_for_pending()
+
+    def commit(self):
+        """Send buffered requests and refresh all indexes."""
+        self.send_buffered_operations()
+        self.wait_for_pending()
+        self.refresh()
+
+    @wrap_exceptions
+    def bulk_upsert(self, docs, namespace, timestamp):
+        """Insert multiple documents into Elasticsearch."""
+        checkpoint = {}
+        futures = []
+        chunk = []
+        docs = self._infer_bulk_mapping(docs, namespace)
+        try:
+            for action in self._bulk_upsert_actions(docs, namespace,
+                                                    timestamp, checkpoint):
+                chunk.append(action)
+                if len(chunk) == max(self.chunk_size, 1):
+                    futures.append(self._submit(chunk))
+                    chunk = []
+        except errors.EmptyDocsError:
+            # This can happen when mongo-connector starts up, there is no
+            # config file, but nothing to dump
+            return
+        if chunk:
+            futures.append(self._submit(chunk))
+
+        failures = []
+        for future in futures:
+            failures.extend(future.result())
+        if failures:
+            for resp in failures:
+                LOG.error("Could not bulk-upsert document "
+                          "into ElasticSearch: %r" % resp)
+            raise BulkIndexError('%i document(s) failed to index.' %
+                                 len(failures), failures)
+        self._save_checkpoint(checkpoint)
+        self.lag_tracker.acknowledged({namespace: timestamp})
+        if self.auto_commit_interval == 0:
+            self.commit()
+
+    def stop(self):
+        """Stop the auto-commit thread and the event loop."""
+        super(DocManager, self).stop()
+        self._run(self._close_client()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+
+    async def _close_client(self):
+        closed = self.async_elastic.transport.close()
+        if asyncio.iscoroutine(closed):
+            await closed
@@ -0,0 +1,229 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""AWS Signature Version 4 signing of the requests to Amazon Elasticsearch.
+
+The signing key derived from the secret key is only valid for one day, one
+region and one service, so it is derived once and cached instead of for
+every request. Credentials are read from a snapshot which a background
+thread refreshes, so that temporary credentials (e.g. of an instance
+profile or an assumed role) are renewed before they expire, and never on
+the path of a request.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qsl, quote, urlsplit
+except ImportError:
+    from urllib import quote
+    from urlparse import parse_qsl, urlsplit
+
+from requests.auth import AuthBase
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CREDENTIAL_REFRESH_INTERVAL = 60
+"""The default interval in seconds to refresh the AWS credentials."""
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Number of signing keys kept, e.g. for the days around midnight UTC
+_MAX_SIGNING_KEYS = 4
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _quote(value, safe='-_.~'):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return quote(value, safe=safe)
+
+
+def _frozen(credentials):
+    """Get a (access key, secret key, token) snapshot of credentials."""
+    if hasattr(credentials, 'get_frozen_credentials'):
+        # Refreshable credentials are renewed here if they expire soon
+        credentials = credentials.get_frozen_credentials()
+    return (credentials.access_key, credentials.secret_key,
+            credentials.token)
+
+
+def derive_signing_key(secret_key, datestamp, region, service):
+    """Derive the key signing the requests of one day."""
+    key = _hmac(('AWS4' + secret_key).encode('utf-8'), datestamp)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    return _hmac(key, 'aws4_request')
+
+
+class AWSSigner(AuthBase):
+    """Requests authentication signing with AWS Signature Version 4.
+
+    :Parameters:
+      - `credentials`: botocore credentials, refreshed by
+        refresh_credentials.
+      - `region`: The AWS region of the domain.
+      - `service`: The signing name of the AWS service.
+    """
+    def __init__(self, credentials, region, service='es'):
+        if not region:
+            raise ValueError('an AWS region is required')
+        self.region = region
+        self.service = service
+        self._credentials = credentials
+        self._frozen = _frozen(credentials)
+        self._lock = threading.Lock()
+        # Format: {(secret key, datestamp): signing key}
+        self._signing_keys = {}
+        self._stats = {'requests': 0, 'sign_seconds': 0.0,
+                       'signing_keys_derived': 0, 'refreshes': 0,
+                       'refresh_failures': 0}
+
+    def refresh_credentials(self):
+        """Take a new snapshot of the credentials.
+
+        The previous snapshot is kept if the credentials cannot be
+        refreshed. Returns True on success.
+        """
+        try:
+            frozen = _frozen(self._credentials)
+        except Exception:
+            LOG.exception("Could not refresh the AWS credentials")
+            with self._lock:
+                self._stats['refresh_failures'] += 1
+            return False
+        with self._lock:
+            self._frozen = frozen
+            self._stats['refreshes'] += 1
+        return True
+
+    def _signing_key(self, secret_key, datestamp):
+        key = (secret_key, datestamp)
+        with self._lock:
+            signing_key = self._signing_keys.get(key)
+            if signing_key is None:
+                if len(self._signing_keys) >= _MAX_SIGNING_KEYS:
+                    self._signing_keys.clear()
+                signing_key = derive_signing_key(
+                    secret_key, datestamp, self.region, self.service)
+                self._signing_keys[key] = signing_key
+                self._stats['signing_keys_derived'] += 1
+            return signing_key
+
+    def sign(self, method, url, headers=None, body=None, now=None):
+        """Get the headers signing a request."""
+        access_key, secret_key, token = self._frozen
+        timestamp = time.gmtime(time.time() if now is None else now)
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', timestamp)
+        datestamp = amz_date[:8]
+
+        parts = urlsplit(url)
+        host = None
+        for name, value in (headers or {}).items():
+            if name.lower() == 'host':
+                host = value
+        if host is None:
+            host = parts.hostname
+            if parts.port and parts.port != _DEFAULT_PORTS.get(parts.scheme):
+                host = '%s:%d' % (host, parts.port)
+        signed = {'host': host, 'x-amz-date': amz_date}
+        if token:
+            signed['x-amz-security-token'] = token
+        signed_headers = ';'.join(sorted(signed))
+
+        if body is None:
+            body = b''
+        elif not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        query = '&'.join(sorted(
+            '%s=%s' % (_quote(key), _quote(value))
+            for key, value in parse_qsl(parts.query,
+                                        keep_blank_values=True)))
+        canonical_request = '\n'.join([
+            method.upper(),
+            _quote(parts.path or '/', safe='/~'),
+            query,
+            ''.join('%s:%s\n' % (name, signed[name].strip())
+                    for name in sorted(signed)),
+            signed_headers,
+            hashlib.sha256(body).hexdigest()])
+        scope = '%s/%s/%s/aws4_request' % (datestamp, self.region,
+                                           self.service)
+        string_to_sign = '\n'.join([
+            ALGORITHM, amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signature = hmac.new(self._signing_key(secret_key, datestamp),
+                             string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+
+        result = {
+            'X-Amz-Date': amz_date,
+            'Authorization': '%s Credential=%s/%s, SignedHeaders=%s, '
+                             'Signature=%s' % (ALGORITHM, access_key, scope,
+                                               signed_headers, signature)}
+        if token:
+            result['X-Amz-Security-Token'] = token
+        return result
+
+    def __call__(self, r):
+        start = time.time()
+        r.headers.update(self.sign(r.method, r.url, r.headers, r.body))
+        elapsed = time.time() - start
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['sign_seconds'] += elapsed
+        return r
+
+    def stats(self):
+        """Get the number of signed requests, the seconds spent signing
+        them, the number of signing keys derived, and the number of
+        credential refreshes and failed refreshes."""
+        with self._lock:
+            return dict(self._stats)
+
+
+class CredentialRefresher(threading.Thread):
+    """Thread that periodically refreshes the credentials of a signer.
+
+    :Parameters:
+      - `signer`: The AWSSigner.
+      - `interval`: Number of seconds between refreshes.
+    """
+    def __init__(self, signer, interval=DEFAULT_CREDENTIAL_REFRESH_INTERVAL):
+        super(CredentialRefresher, self).__init__()
+        self._signer = signer
+        self._interval = max(interval, 1)
+        self._stopped = False
+        self.daemon = True
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(CredentialRefresher, self).join(timeout=timeout)
+
+    def run(self):
+        """Refresh the credentials every interval seconds."""
+        last_run = time.time()
+        while not self._stopped:
+            if time.time() - last_run >= self._interval:
+                self._signer.refresh_credentials()
+                last_run = time.time()
+            time.sleep(1)
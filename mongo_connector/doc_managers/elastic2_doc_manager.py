@@ -18,11 +18,19 @@ Receives documents from an OplogThread and takes the appropriate actions on
 Elasticsearch.
 """
 import base64
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import re
 import threading
 import time
 import warnings
 
+from multiprocessing.pool import ThreadPool
+
 import bson.json_util
 
 try:
@@ -38,7 +46,7 @@ except ImportError:
     )
 
 from elasticsearch import Elasticsearch, exceptions as es_exceptions, connection as es_connection
-from elasticsearch.helpers import bulk, scan, streaming_bulk, BulkIndexError
+from elasticsearch.helpers import scan, expand_action, BulkIndexError
 
 from mongo_connector import errors
 from mongo_connector.compat import u
@@ -47,11 +55,25 @@ from mongo_connector.constants import (DEFAULT_COMMIT_INTERVAL,
 from mongo_connector.util import exception_wrapper, retry_until_ok
 from mongo_connector.doc_managers.doc_manager_base import DocManagerBase
 from mongo_connector.doc_managers.formatters import DefaultDocumentFormatter
+from mongo_connector.doc_managers.elastic2_mapping import (
+    DEFAULT_MAPPING_SAMPLE_SIZE, infer_mapping, string_mapping)
+from mongo_connector.doc_managers.elastic2_lanes import (
+    DEFAULT_CONCURRENCY as DEFAULT_LANE_CONCURRENCY, DUMP, LIVE, BulkLanes)
+from mongo_connector.doc_managers.elastic2_resync import (
+    DEFAULT_IDLE as DEFAULT_RESYNC_IDLE, create_shadow, swap_alias,
+    untouched_types)
+from mongo_connector.doc_managers.elastic2_router import (
+    DEFAULT_REFRESH_INTERVAL, ShardRouter)
+from mongo_connector.doc_managers.elastic2_shared import (
+    DEFAULT_NAMESPACE_FIELD, SharedIndices, namespace_mapping)
+from mongo_connector.doc_managers.elastic2_spool import (DEFAULT_SEGMENT_SIZE,
+                                                         Spool)
 
 _HAS_AWS = True
 try:
     from boto3 import session
-    from requests_aws_sign import AWSV4Sign
+    from mongo_connector.doc_managers.elastic2_aws import (
+        DEFAULT_CREDENTIAL_REFRESH_INTERVAL, AWSSigner, CredentialRefresher)
 except ImportError:
     _HAS_AWS = False
 
@@ -69,6 +91,57 @@ DEFAULT_SEND_INTERVAL = 5
 
 DEFAULT_AWS_REGION = 'us-east-1'
 
+CHECKPOINT_ID = 'checkpoint'
+"""The id of the document in the meta index tracking the newest operation."""
+
+DEFAULT_RETENTION_INTERVAL = 3600
+"""The default interval in seconds to drop expired meta index entries."""
+
+DEFAULT_SPOOL_REPLAY_INTERVAL = 5
+"""The default interval in seconds to retry replaying spooled operations."""
+
+DEFAULT_SPOOL_MAX_HELD = 10000
+"""The default number of operations a buffer shard holds back while it has
+updates waiting for the spool to be replayed."""
+
+UNAVAILABLE_STATUSES = (429, 502, 503, 504)
+"""HTTP statuses for which bulk requests are spooled and retried later."""
+
+DEFAULT_MGET_CHUNK_SIZE = 500
+"""The default maximum number of documents retrieved by one mget request."""
+
+DEFAULT_MGET_CONCURRENCY = 4
+"""The default number of concurrent mget requests."""
+
+VERSION_CONFLICT = 'version_conflict_engine_exception'
+"""The type of error of a write rejected because of its version."""
+
+VERSION_CONFLICT_REASON = re.compile(r'^\[([^\]]+)\]\[([^\]]+)\]: ')
+"""Matches the type and _id of the document at the start of the reason of
+a version conflict."""
+
+BULK_FILTER_PATH = 'errors,items.*.error'
+"""Only failed items are included in the responses to bulk requests."""
+
+META_PARTITION_FORMAT = '%Y.%m.%d'
+"""The date suffix of daily meta index partitions."""
+
+MAX_SEARCHED_PARTITIONS = 31
+"""Search all meta index partitions when a range spans more days."""
+
+DEFAULT_ROUTING_CACHE_SIZE = 100000
+"""The default number of document routing values remembered for updates."""
+
+DEFAULT_FINGERPRINT_CACHE_SIZE = 0
+"""The default number of document fingerprints remembered, 0 disables it."""
+
+DEFAULT_LAG_LOG_INTERVAL = 60
+"""The default interval in seconds to log the replication lag."""
+
+DEFAULT_REFRESH_WINDOW = 0
+"""The default number of seconds in which refreshes after the first are
+skipped, 0 only collapses concurrent refreshes."""
+
 __version__ = '0.3.0'
 """Elasticsearch 2.X DocManager version."""
 
@@ -96,9 +169,47 @@ def create_aws_auth(aws_args):
     except TypeError as exc:
         raise errors.InvalidConfiguration(
             'Elastic DocManager unknown aws config option: %s' % (exc,))
-    return AWSV4Sign(aws_session.get_credentials(),
-                     aws_session.region_name or DEFAULT_AWS_REGION,
-                     'es')
+    credentials = aws_session.get_credentials()
+    if credentials is None:
+        raise errors.InvalidConfiguration(
+            'Elastic DocManager could not find AWS credentials')
+    return AWSSigner(credentials,
+                     aws_session.region_name or DEFAULT_AWS_REGION, 'es')
+
+
+class SizedRequestsHttpConnection(es_connection.RequestsHttpConnection):
+    """RequestsHttpConnection which keeps up to maxsize connections to its
+    node, like Urllib3HttpConnection."""
+
+    def __init__(self, maxsize=10, **kwargs):
+        super(SizedRequestsHttpConnection, self).__init__(**kwargs)
+        # RequestsHttpConnection checked that requests is installed
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_maxsize=maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+def sized_client_options(client_options, maxsize):
+    """Get client options whose connections keep up to maxsize connections
+    to each node.
+
+    Raises InvalidConfiguration for a connection class which cannot be
+    sized.
+    """
+    connection_class = client_options.get(
+        'connection_class', es_connection.Urllib3HttpConnection)
+    if issubclass(connection_class, es_connection.Urllib3HttpConnection):
+        return dict(client_options, maxsize=maxsize)
+    if connection_class is es_connection.RequestsHttpConnection:
+        return dict(client_options, maxsize=maxsize,
+                    connection_class=SizedRequestsHttpConnection)
+    if issubclass(connection_class, SizedRequestsHttpConnection):
+        return dict(client_options, maxsize=maxsize)
+    raise errors.InvalidConfiguration(
+        'Elastic DocManager config option "priorityLanes" cannot limit the '
+        'connections of connection_class %s, use Urllib3HttpConnection or '
+        'RequestsHttpConnection' % connection_class.__name__)
 
 
 class AutoCommiter(threading.Thread):
@@ -154,6 +265,448 @@ class AutoCommiter(threading.Thread):
             last_commit += self._sleep_interval
 
 
+class MetaIndexRetention(threading.Thread):
+    """Thread that periodically drops expired entries from the meta index.
+
+    :Parameters:
+      - `docman`: The Elasticsearch DocManager.
+      - `interval`: Number of seconds to wait between two runs.
+      - `sleep_interval`: Number of seconds to sleep.
+    """
+    def __init__(self, docman, interval=DEFAULT_RETENTION_INTERVAL,
+                 sleep_interval=1):
+        super(MetaIndexRetention, self).__init__()
+        self._docman = docman
+        self._interval = interval
+        self._sleep_interval = max(sleep_interval, 1)
+        self._stopped = False
+        self.daemon = True
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(MetaIndexRetention, self).join(timeout=timeout)
+
+    def run(self):
+        """Periodically removes meta entries outside the rollback window.
+        """
+        last_run = self._interval
+        while not self._stopped:
+            if last_run >= self._interval:
+                try:
+                    self._docman.prune_meta_index()
+                except Exception:
+                    # Retried on the next run
+                    LOG.exception("Failed to prune the meta index")
+                last_run = 0
+            time.sleep(self._sleep_interval)
+            last_run += self._sleep_interval
+
+
+class ResyncFinisher(threading.Thread):
+    """Thread that finishes the resyncs whose dump is over.
+
+    :Parameters:
+      - `docman`: The Elasticsearch DocManager.
+      - `idle`: Number of seconds without dumped documents after which a
+        resync is finished.
+      - `sleep_interval`: Number of seconds to sleep.
+    """
+    def __init__(self, docman, idle=DEFAULT_RESYNC_IDLE, sleep_interval=1):
+        super(ResyncFinisher, self).__init__()
+        self._docman = docman
+        self._idle = idle
+        self._sleep_interval = max(sleep_interval, 1)
+        self._stopped = False
+        self.daemon = True
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(ResyncFinisher, self).join(timeout=timeout)
+
+    def run(self):
+        """Periodically finishes the idle resyncs."""
+        while not self._stopped:
+            try:
+                self._docman.finish_idle_resyncs(self._idle)
+            except es_exceptions.ElasticsearchException:
+                LOG.exception("Failed to finish a resync")
+            time.sleep(self._sleep_interval)
+
+
+class SpoolReplayer(threading.Thread):
+    """Thread that replays spooled operations once Elasticsearch recovers.
+
+    :Parameters:
+      - `docman`: The Elasticsearch DocManager.
+      - `interval`: Number of seconds to wait between two replay attempts.
+      - `sleep_interval`: Number of seconds to sleep.
+    """
+    def __init__(self, docman, interval=DEFAULT_SPOOL_REPLAY_INTERVAL,
+                 sleep_interval=1):
+        super(SpoolReplayer, self).__init__()
+        self._docman = docman
+        self._interval = interval
+        self._sleep_interval = max(sleep_interval, 1)
+        self._stopped = False
+        self.daemon = True
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(SpoolReplayer, self).join(timeout=timeout)
+
+    def run(self):
+        """Periodically drains the spool.
+        """
+        last_run = self._interval
+        while not self._stopped:
+            if last_run >= self._interval:
+                if self._docman.spool.pending():
+                    self._docman.replay_spool()
+                last_run = 0
+            time.sleep(self._sleep_interval)
+            last_run += self._sleep_interval
+
+
+class LRUCache(object):
+    """Thread-safe mapping which keeps only the most recently used entries.
+
+    :Parameters:
+      - `size`: Maximum number of entries.
+    """
+    def __init__(self, size):
+        self.size = size
+        # Entries are kept in a circular doubly linked list, from the least
+        # to the most recently used, since OrderedDict needs Python 2.7
+        # Format: {key: [previous link, next link, key, value]}
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        """Make a link the most recently used."""
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = self._root[0] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._data.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        with self._lock:
+            link = self._data.get(key)
+            if link is None:
+                link = self._data[key] = [None, None, key, value]
+            else:
+                self._unlink(link)
+                link[3] = value
+            self._append(link)
+            while len(self._data) > self.size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._data[oldest[2]]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._data.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+
+
+class _Flight(object):
+    """One call of a SingleFlight function, shared by its callers."""
+    def __init__(self):
+        self.done = False
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run a function once for all the callers which need it concurrently.
+
+    A caller arriving while the function runs may have made changes that
+    run does not see, so it waits for the next run instead. That run is
+    made by one of the callers which arrived in the meantime, and its
+    result, or exception, is shared by all of them.
+
+    :Parameters:
+      - `func`: The function to run, without arguments.
+    """
+    def __init__(self, func):
+        self.func = func
+        self._cond = threading.Condition()
+        self._running = None
+        self._next = None
+        self.runs = 0
+        self.calls = 0
+
+    def __call__(self):
+        with self._cond:
+            self.calls += 1
+            if self._running is None:
+                flight = self._running = _Flight()
+            else:
+                if self._next is None:
+                    self._next = _Flight()
+                flight = self._next
+                while not flight.done and self._running is not None:
+                    self._cond.wait()
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                # The run this caller waited for is over, start the next
+                self._running, self._next = flight, None
+            self.runs += 1
+        try:
+            self.func()
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._cond:
+                flight.done = True
+                self._running = None
+                self._cond.notify_all()
+
+
+def _fingerprint(source):
+    """Hash the formatted source of a document."""
+    return hashlib.sha1(json.dumps(source, sort_keys=True,
+                                   default=u).encode('utf-8')).digest()
+
+
+def _get_field(doc, path):
+    """Get the value of a dotted field path in a document, or None."""
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _partial_update(update_spec):
+    """Get the partial document of a $set and $unset update spec.
+
+    Unset fields are set to null. Raises OperationFailed for a path into an
+    array, which a partial document cannot express.
+    """
+    partial = {}
+    changes = list((update_spec.get('$set') or {}).items())
+    changes.extend((path, None) for path in update_spec.get('$unset') or {})
+    for path, value in changes:
+        parts = path.split('.')
+        if any(part.isdigit() for part in parts):
+            raise errors.OperationFailed(
+                'Update of array element %r cannot be written to the sink' %
+                path)
+        doc = partial
+        for part in parts[:-1]:
+            doc = doc.setdefault(part, {})
+        doc[parts[-1]] = value
+    return partial
+
+
+def _updated_field(update_spec, path):
+    """Get the value a MongoDB update spec sets a dotted field path to,
+    or None."""
+    if not any(key.startswith('$') for key in update_spec):
+        # Replacement document
+        return _get_field(update_spec, path)
+    fields = update_spec.get('$set') or {}
+    if path in fields:
+        return fields[path]
+    return _get_field(fields, path)
+
+
+class LagReporter(threading.Thread):
+    """Thread that periodically logs the replication lag of each namespace.
+
+    :Parameters:
+      - `docman`: The Elasticsearch DocManager.
+      - `interval`: Number of seconds to wait between two reports.
+      - `sleep_interval`: Number of seconds to sleep.
+    """
+    def __init__(self, docman, interval=DEFAULT_LAG_LOG_INTERVAL,
+                 sleep_interval=1):
+        super(LagReporter, self).__init__()
+        self._docman = docman
+        self._interval = interval
+        self._sleep_interval = max(sleep_interval, 1)
+        self._stopped = False
+        self.daemon = True
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(LagReporter, self).join(timeout=timeout)
+
+    def run(self):
+        """Periodically logs the statistics of the DocManager.
+        """
+        last_run = 0
+        while not self._stopped:
+            if last_run >= self._interval:
+                stats = self._docman.stats()
+                for namespace, lag in sorted(stats['namespaces'].items()):
+                    LOG.info("Replication lag of %s: %s seconds, oldest "
+                             "buffered operation: %s seconds old",
+                             namespace, _seconds(lag['lag']),
+                             _seconds(lag['oldest_buffered_age']))
+                last_run = 0
+            time.sleep(self._sleep_interval)
+            last_run += self._sleep_interval
+
+
+def _seconds(value):
+    return 'n/a' if value is None else '%.1f' % value
+
+
+class LagTracker(object):
+    """Replication lag of each namespace.
+
+    The lag of a namespace is the time at which Elasticsearch acknowledged
+    its newest operation minus the oplog timestamp of that operation.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Format: {namespace: (newest acknowledged timestamp, ack time)}
+        self._acknowledged = {}
+
+    def acknowledged(self, timestamps, now=None):
+        """Record that Elasticsearch has acknowledged operations.
+
+        :Parameters:
+          - `timestamps`: Dict of the newest oplog timestamp of the
+            acknowledged operations of each namespace.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for namespace, timestamp in timestamps.items():
+                previous = self._acknowledged.get(namespace)
+                if previous is None or timestamp >= previous[0]:
+                    self._acknowledged[namespace] = (timestamp, now)
+
+    def lags(self):
+        """Get the lag of each namespace, as a dict of dicts."""
+        with self._lock:
+            return dict(
+                (namespace, {'last_ts': timestamp,
+                             'acknowledged_at': ack_time,
+                             'lag': ack_time - (timestamp >> 32)})
+                for namespace, (timestamp, ack_time)
+                in self._acknowledged.items())
+
+
+def _is_unavailable(exc):
+    """Return True if a request failed because Elasticsearch is unavailable
+    or overloaded, rather than because of the request itself."""
+    return (isinstance(exc, es_exceptions.ConnectionError) or
+            getattr(exc, 'status_code', None) in UNAVAILABLE_STATUSES)
+
+
+def _bulk(client, actions, chunk_size=DEFAULT_MAX_BULK, stale=None,
+          slot=None):
+    """Send actions to Elasticsearch with the bulk API.
+
+    Unlike elasticsearch.helpers.bulk, the response is filtered by
+    Elasticsearch down to the failed items, so that the response to a
+    successful request is tiny no matter how many actions it contains.
+
+    Returns a tuple of the number of successful actions and a list of errors.
+    Writes ignored because of their version are appended to `stale`. If
+    given, `slot` is called to get a context manager held while each
+    request is sent.
+    """
+    successes, failures = 0, []
+    for body, count in bulk_bodies(client.transport.serializer, actions,
+                                   chunk_size):
+        if slot is None:
+            resp = client.bulk(body, filter_path=BULK_FILTER_PATH)
+        else:
+            with slot():
+                resp = client.bulk(body, filter_path=BULK_FILTER_PATH)
+        failures.extend(bulk_failures(resp, stale))
+        successes += count
+    return successes - len(failures), failures
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_bodies(serializer, actions, chunk_size=DEFAULT_MAX_BULK):
+    """Serialize actions into the bodies of bulk requests.
+
+    Yields tuples of a body and the number of actions it contains.
+    """
+    if chunk_size <= 0:
+        chunk_size = DEFAULT_MAX_BULK
+    lines, count = [], 0
+    for action in actions:
+        action, data = expand_action(action)
+        lines.append(serializer.dumps(action))
+        if data is not None:
+            lines.append(serializer.dumps(data))
+        count += 1
+        if count == chunk_size:
+            yield '\n'.join(lines) + '\n', count
+            lines, count = [], 0
+    if count:
+        yield '\n'.join(lines) + '\n', count
+
+
+def bulk_failures(resp, stale=None):
+    """Get the failed items from the filtered response to a bulk request.
+
+    Version conflicts are not failures: they are writes which Elasticsearch
+    rejected because the document already has a newer external version.
+    They are appended to the `stale` list if one is given.
+    """
+    if not resp.get('errors'):
+        return []
+    failures = []
+    conflicts = 0
+    for item in resp.get('items', []):
+        for result in item.values():
+            if result['error'].get('type') == VERSION_CONFLICT:
+                conflicts += 1
+                if stale is not None:
+                    stale.append(item)
+            else:
+                failures.append(item)
+    if conflicts:
+        LOG.debug("Ignored %d writes older than the documents in "
+                  "Elasticsearch", conflicts)
+    return failures
+
+
 class DocManager(DocManagerBase):
     """Elasticsearch implementation of the DocManager interface.
 
@@ -167,13 +720,15 @@ class DocManager(DocManagerBase):
                  attachment_field="content",
                  **kwargs):
         client_options = kwargs.get('clientOptions', {})
+        self.aws_signer = None
         if 'aws' in kwargs:
             if not _HAS_AWS:
                 raise errors.InvalidConfiguration(
                     'aws extras must be installed to sign Elasticsearch '
                     'requests. Install with: '
                     'pip install elastic2-doc-manager[aws]')
-            client_options['http_auth'] = create_aws_auth(kwargs['aws'])
+            self.aws_signer = create_aws_auth(kwargs['aws'])
+            client_options['http_auth'] = self.aws_signer
             client_options['use_ssl'] = True
             client_options['verify_certs'] = True
             client_options['connection_class'] = \
@@ -183,39 +738,527 @@ class DocManager(DocManagerBase):
         self.elastic = Elasticsearch(hosts=url, **client_options)
 
         self._formatter = DefaultDocumentFormatter()
-        self.BulkBuffer = BulkBuffer(self)
 
-        # As bulk operation can be done in another thread
-        # lock is needed to prevent access to BulkBuffer
-        # while commiting documents to Elasticsearch
-        # It is because BulkBuffer might get outdated
-        # docs from Elasticsearch if bulk is still ongoing
-        self.lock = threading.Lock()
+        # Operations are partitioned by namespace (or document id) into
+        # independent buffers, so that concurrent OplogThreads writing to
+        # different partitions do not wait for each other
+        self.buffer_shard_key = kwargs.get('bulkBufferShardKey', 'namespace')
+        if self.buffer_shard_key not in ('namespace', 'id'):
+            raise errors.InvalidConfiguration(
+                'Elastic DocManager config option "bulkBufferShardKey" must '
+                'be either "namespace" or "id"')
+        self.buffer_shards = [
+            BulkBuffer(self)
+            for _ in range(max(kwargs.get('bulkBufferShards', 1), 1))]
+        self.BulkBuffer = self.buffer_shards[0]
+        self.lock = self.BulkBuffer.lock
+
+        # Concurrent flushes and refreshes are coalesced, e.g. when a full
+        # buffer is sent while the AutoCommiter commits
+        self._flusher = SingleFlight(self._send_buffers)
+        self._refresher = SingleFlight(self._refresh_indices)
+        self.refresh_window = kwargs.get('refreshWindow',
+                                         DEFAULT_REFRESH_WINDOW)
+        self._refreshed_at = 0
 
         self.auto_commit_interval = auto_commit_interval
         self.auto_send_interval = kwargs.get('autoSendInterval',
                                              DEFAULT_SEND_INTERVAL)
         self.meta_index_name = meta_index_name
         self.meta_type = meta_type
+        # The checkpoint lives in its own mapping type so that it can never
+        # collide with the meta entry of a MongoDB document.
+        self.checkpoint_type = '%s_checkpoint' % meta_type
+        # Highest timestamp persisted in the checkpoint by this DocManager
+        self._checkpoint_ts = None
+        # Write meta entries into one index per day of oplog time
+        self.partition_meta_index = kwargs.get('partitionMetaIndex', False)
+        # Number of seconds meta entries are kept, None keeps them forever
+        self.meta_index_retention = kwargs.get('metaIndexRetention')
+        # Version documents with the oplog timestamp, so that Elasticsearch
+        # rejects writes older than what it already has
+        self.external_versioning = kwargs.get('externalVersioning', False)
+        # Documents of these namespaces are routed to a shard by the value
+        # of a field instead of their _id
+        # Format: {"db.collection" or "db.*": "dotted.field.path"}
+        self.routing = kwargs.get('routing', {})
+        if not isinstance(self.routing, dict):
+            raise errors.InvalidConfiguration(
+                'Elastic DocManager config option "routing" must be a dict')
+        # Routing of recently written documents, for updates and removals
+        # which do not carry the routing field
+        self.routing_cache = LRUCache(
+            kwargs.get('routingCacheSize', DEFAULT_ROUTING_CACHE_SIZE))
+        # Fingerprints of the sources last written to Elasticsearch, to skip
+        # writes which would not change a document
+        # Format: {(_index, _type, _id): fingerprint}
+        self.fingerprints = None
+        fingerprint_cache_size = kwargs.get('fingerprintCacheSize',
+                                            DEFAULT_FINGERPRINT_CACHE_SIZE)
+        if fingerprint_cache_size:
+            self.fingerprints = LRUCache(fingerprint_cache_size)
+        self.suppressed_writes = 0
+        self._stats_lock = threading.Lock()
+        # Send bulk actions directly to the nodes holding their primary
+        # shards, according to a cached copy of the routing table
+        self.shard_router = None
+        if kwargs.get('shardAwareBulk', False):
+            self.shard_router = ShardRouter(
+                self.elastic, client_options,
+                kwargs.get('shardRoutingRefreshInterval',
+                           DEFAULT_REFRESH_INTERVAL))
+        # Collection dumps are sent with their own client and a limited
+        # share of the concurrent bulk requests, so that live operations
+        # are not stuck behind them
+        self.lanes = None
+        self.dump_elastic = self.elastic
+        self.dump_router = self.shard_router
+        if kwargs.get('priorityLanes', False):
+            try:
+                self.lanes = BulkLanes(
+                    kwargs.get('laneConcurrency', DEFAULT_LANE_CONCURRENCY),
+                    kwargs.get('laneWeights'))
+            except ValueError as exc:
+                raise errors.InvalidConfiguration(
+                    'Elastic DocManager config option "laneWeights" or '
+                    '"laneConcurrency" is invalid: %s' % exc)
+            dump_options = sized_client_options(client_options,
+                                                self.lanes.shares[DUMP])
+            self.dump_elastic = Elasticsearch(hosts=url, **dump_options)
+            if self.shard_router is not None:
+                self.dump_router = ShardRouter(
+                    self.dump_elastic, dump_options,
+                    self.shard_router.refresh_interval)
+        # Collection dumps write into shadow indices, which replace the
+        # indices behind aliases once the dumps are over
+        self.shadow_resync = kwargs.get('shadowResync', False)
+        # Format: {"_index": Resync}
+        self._resyncs = {}
+        self._resyncs_lock = threading.Lock()
+        # Namespaces matching the patterns of a shared index are written to
+        # it, instead of to one index per database
+        self.shared_indices = None
+        if kwargs.get('sharedIndices'):
+            try:
+                self.shared_indices = SharedIndices(
+                    kwargs['sharedIndices'],
+                    kwargs.get('sharedIndexNamespaceField',
+                               DEFAULT_NAMESPACE_FIELD))
+            except ValueError as exc:
+                raise errors.InvalidConfiguration(
+                    'Elastic DocManager config option "sharedIndices" is '
+                    'invalid: %s' % exc)
+        # Namespaces whose field mapping and alias have been put
+        self._shared_namespaces = set()
+        # Bulk requests are written to files on local disk instead of
+        # Elasticsearch, to be loaded later
+        self.sink = None
+        if kwargs.get('sinkDirectory'):
+            for option in ('spoolDirectory', 'shardAwareBulk',
+                           'priorityLanes', 'shadowResync', 'sharedIndices',
+                           'inferMappings', 'metaIndexRetention'):
+                if kwargs.get(option):
+                    raise errors.InvalidConfiguration(
+                        'Elastic DocManager config option "%s" cannot be '
+                        'used with "sinkDirectory"' % option)
+            # The sink is only imported when it is configured
+            from mongo_connector.doc_managers.elastic2_sink import (
+                DEFAULT_FILE_SIZE as DEFAULT_SINK_FILE_SIZE, Sink)
+            self.sink = Sink(kwargs['sinkDirectory'],
+                             kwargs.get('sinkFileSize',
+                                        DEFAULT_SINK_FILE_SIZE),
+                             kwargs.get('sinkCompressLevel', 0))
         self.unique_key = unique_key
         self.chunk_size = chunk_size
-        self.has_attachment_mapping = False
+        # Mappings inferred from the first documents of each namespace are
+        # put before they are indexed, instead of growing dynamically. The
+        # sample of a namespace first written by upsert is that document.
+        self.infer_mappings = kwargs.get('inferMappings', False)
+        self.mapping_sample_size = kwargs.get('mappingSampleSize',
+                                              DEFAULT_MAPPING_SAMPLE_SIZE)
+        # Mappings which have already been put, so they are only put once
+        # Format: {(_index, _type): {"properties": {...}, ...}}
+        self._known_mappings = {}
+        self._mappings_lock = threading.Lock()
+        self._es_major_version = None
         self.attachment_field = attachment_field
         self.auto_commiter = AutoCommiter(self, self.auto_send_interval,
                                           self.auto_commit_interval)
         self.auto_commiter.start()
+        self.meta_retention = None
+        if self.meta_index_retention:
+            self.meta_retention = MetaIndexRetention(
+                self, kwargs.get('metaIndexRetentionInterval',
+                                 DEFAULT_RETENTION_INTERVAL))
+            self.meta_retention.start()
+
+        # Sources of updated documents are retrieved in chunks by a pool of
+        # threads as soon as enough updates are buffered
+        self.mget_chunk_size = kwargs.get('mgetChunkSize',
+                                          DEFAULT_MGET_CHUNK_SIZE)
+        self.mget_concurrency = max(
+            kwargs.get('mgetConcurrency', DEFAULT_MGET_CONCURRENCY), 1)
+        self._mget_pool = None
+        self._mget_pool_lock = threading.Lock()
+
+        # Bulk requests which cannot be sent while Elasticsearch is
+        # unavailable are appended to an on-disk spool and replayed in order
+        self.spool = None
+        self.spool_replayer = None
+        self._spool_lock = threading.Lock()
+        self._spool_retry_at = 0
+        self._spool_replay_interval = kwargs.get(
+            'spoolReplayInterval', DEFAULT_SPOOL_REPLAY_INTERVAL)
+        # Buffers with updates cannot be spooled, the tailing thread waits
+        # for the spool to be replayed once they hold this many operations
+        self._spool_max_held = kwargs.get('spoolMaxHeldOperations',
+                                          DEFAULT_SPOOL_MAX_HELD)
+        if kwargs.get('spoolDirectory'):
+            self.spool = Spool(kwargs['spoolDirectory'],
+                               kwargs.get('spoolSegmentSize',
+                                          DEFAULT_SEGMENT_SIZE))
+            self.spool_replayer = SpoolReplayer(self,
+                                                self._spool_replay_interval)
+            self.spool_replayer.start()
+
+        self.lag_tracker = LagTracker()
+        self.lag_reporter = None
+        lag_log_interval = kwargs.get('lagLogInterval',
+                                      DEFAULT_LAG_LOG_INTERVAL)
+        if lag_log_interval:
+            self.lag_reporter = LagReporter(self, lag_log_interval)
+            self.lag_reporter.start()
+
+        # Temporary AWS credentials are renewed before they expire
+        self.credential_refresher = None
+        if self.aws_signer is not None:
+            self.credential_refresher = CredentialRefresher(
+                self.aws_signer,
+                kwargs.get('awsCredentialRefreshInterval',
+                           DEFAULT_CREDENTIAL_REFRESH_INTERVAL))
+            self.credential_refresher.start()
+
+        self.resync_finisher = None
+        if self.shadow_resync:
+            self.resync_finisher = ResyncFinisher(
+                self, kwargs.get('shadowResyncIdle', DEFAULT_RESYNC_IDLE))
+            self.resync_finisher.start()
 
     def _index_and_mapping(self, namespace):
         """Helper method for getting the index and type from a namespace."""
         index, doc_type = namespace.split('.', 1)
+        if self.shared_indices is not None:
+            shared = self.shared_indices.index(namespace)
+            if shared is not None:
+                return shared, doc_type
         return index.lower(), doc_type
 
+    def _is_shared(self, namespace):
+        """Whether a namespace is written to a shared index."""
+        return (self.shared_indices is not None and
+                self.shared_indices.index(namespace) is not None)
+
+    def _document_id(self, namespace, document_id):
+        """Get the _id of a document in Elasticsearch."""
+        doc_id = u(document_id)
+        if self._is_shared(namespace):
+            return self.shared_indices.document_id(namespace, doc_id)
+        return doc_id
+
+    def _original_id(self, namespace, doc_id):
+        """Get the MongoDB _id of a document from its Elasticsearch _id.
+
+        Meta index entries and checkpoints keep the MongoDB _id, which is
+        what rollbacks look up.
+        """
+        if self._is_shared(namespace):
+            return self.shared_indices.original_id(doc_id)
+        return doc_id
+
+    def _prepare_shared(self, namespace):
+        """Put the mapping of the namespace field and the filtered alias of
+        a namespace written to a shared index, once."""
+        if namespace in self._shared_namespaces or \
+                not self._is_shared(namespace):
+            return
+        index, doc_type = self._index_and_mapping(namespace)
+        self._put_mapping(index, doc_type, {"properties": {
+            self.shared_indices.field: namespace_mapping(
+                self._es_version())}})
+        name, body = self.shared_indices.alias(namespace)
+        try:
+            self.elastic.indices.put_alias(index=index, name=name,
+                                           body=body)
+        except es_exceptions.RequestError as exc:
+            # e.g. an index already has the name of the alias
+            LOG.warning("Could not create the alias %s of %s in shared "
+                        "index %s: %s", name, namespace, index, exc)
+        self._shared_namespaces.add(namespace)
+
+    def _tag_namespace(self, source, namespace):
+        """Store the namespace in a source written to a shared index."""
+        if self._is_shared(namespace):
+            source[self.shared_indices.field] = namespace
+
+    def _buffer_for(self, namespace, document_id):
+        """Get the buffer shard which holds operations on a document."""
+        if len(self.buffer_shards) == 1:
+            return self.BulkBuffer
+        if self.buffer_shard_key == 'namespace':
+            key = namespace
+        else:
+            key = (namespace, document_id)
+        return self.buffer_shards[hash(key) % len(self.buffer_shards)]
+
+    def _put_mapping(self, index, doc_type, body):
+        """Put the parts of a mapping which have not been put yet."""
+        resync = self._resyncs.get(index)
+        if resync is not None:
+            self._put_mapping(resync.shadow, doc_type, body)
+        with self._mappings_lock:
+            known = self._known_mappings.get((index, doc_type), {})
+            new = {}
+            for key, value in body.items():
+                if key == 'properties':
+                    properties = dict(
+                        (name, mapping) for name, mapping in value.items()
+                        if name not in known.get('properties', {}))
+                    if properties:
+                        new[key] = properties
+                elif known.get(key) != value:
+                    new[key] = value
+            if not new:
+                return
+            if self.sink is not None:
+                self.sink.write_mapping(index, doc_type, new)
+                self._remember_mapping(index, doc_type, new)
+                return
+            self.elastic.indices.create(index=index, ignore=400)
+            try:
+                self.elastic.indices.put_mapping(index=index,
+                                                 doc_type=doc_type,
+                                                 body=new)
+            except es_exceptions.RequestError:
+                # Also remember rejected mappings so they are not put again
+                self._remember_mapping(index, doc_type, new)
+                raise
+            self._remember_mapping(index, doc_type, new)
+
+    def _remember_mapping(self, index, doc_type, body):
+        known = self._known_mappings.setdefault((index, doc_type), {})
+        for key, value in body.items():
+            if key == 'properties':
+                known.setdefault(key, {}).update(value)
+            else:
+                known[key] = value
+
+    def _forget_mappings(self, index):
+        """Forget the mappings of a dropped index."""
+        with self._mappings_lock:
+            for key in list(self._known_mappings):
+                if key[0] == index:
+                    del self._known_mappings[key]
+
+    def _es_version(self):
+        """Get the major version of Elasticsearch."""
+        if self._es_major_version is None:
+            self._es_major_version = int(
+                self.elastic.info()['version']['number'].split('.')[0])
+        return self._es_major_version
+
+    def _infer_mapping(self, namespace, docs):
+        """Put the mapping inferred from sample documents of a namespace."""
+        properties = infer_mapping(
+            (self._formatter.format_document(doc) for doc in docs),
+            string_mapping(self._es_version()))
+        index, doc_type = self._index_and_mapping(namespace)
+        try:
+            self._put_mapping(index, doc_type, {"properties": properties})
+        except es_exceptions.RequestError as exc:
+            LOG.warning("Could not put the mapping inferred for %s, its "
+                        "fields are mapped dynamically: %s", namespace, exc)
+        # Nothing may have been inferred, the namespace is handled anyway
+        with self._mappings_lock:
+            self._known_mappings.setdefault((index, doc_type), {})
+
+    def _infer_bulk_mapping(self, docs, namespace):
+        """Put the mapping inferred from the first documents to bulk upsert.
+
+        Returns an iterator over all the documents.
+        """
+        if not self.infer_mappings:
+            return docs
+        docs = iter(docs)
+        sample = list(itertools.islice(docs, self.mapping_sample_size))
+        if sample:
+            self._infer_mapping(namespace, sample)
+        return itertools.chain(sample, docs)
+
+    def _routing_field(self, namespace):
+        """Get the field routing the documents of a namespace, or None."""
+        if not self.routing:
+            return None
+        field = self.routing.get(namespace)
+        if field is None:
+            field = self.routing.get('%s.*' % namespace.split('.', 1)[0])
+        return field
+
+    def _routing(self, namespace, index, doc_type, doc_id, doc=None,
+                 update_spec=None):
+        """Get the _routing of a document, or None if it is routed by _id.
+
+        `doc` is the full document unless `update_spec` is given. A full
+        document without the routing field is routed by _id, the routing
+        of other documents is cached or looked up.
+
+        The routing field should be immutable, like a MongoDB shard key:
+        a document whose routing changes is not removed from its old shard.
+        """
+        field = self._routing_field(namespace)
+        if field is None:
+            return None
+        key = (index, doc_type, doc_id)
+        if doc and not update_spec:
+            value = _get_field(doc, field)
+            if value is None:
+                self.routing_cache.pop(key)
+                return None
+        elif update_spec:
+            value = _updated_field(update_spec, field)
+        else:
+            value = None
+        if value is not None:
+            routing = u(value)
+            self.routing_cache.set(key, routing)
+            return routing
+        routing = self.routing_cache.get(key)
+        if routing is None:
+            routing = self._lookup_routing(namespace, index, doc_type,
+                                           doc_id)
+            if routing is not None:
+                self.routing_cache.set(key, routing)
+        return routing
+
+    def _lookup_routing(self, namespace, index, doc_type, doc_id):
+        """Find the _routing of a document which is not in the cache.
+
+        The routing is stored in the meta entry of the document, which a
+        realtime get sees as soon as it is written. Otherwise the document
+        is searched, which is not realtime: a document written since the
+        last refresh of its index is not found, and is routed by _id.
+        """
+        if self.sink is not None:
+            return None
+        if not self.partition_meta_index:
+            try:
+                entry = self.elastic.get(
+                    index=self.meta_index_name, doc_type=self.meta_type,
+                    id=self._original_id(namespace, doc_id), realtime=True)
+            except es_exceptions.NotFoundError:
+                entry = None
+            if entry is not None:
+                source = entry.get('_source') or {}
+                if ('routing' in source and
+                        source.get('ns') == namespace):
+                    # None for a document routed by _id
+                    return source['routing']
+        # The partition holding the entry is not known, and older entries
+        # have no routing: search the document itself instead.
+        try:
+            hits = self.elastic.search(
+                index=index, doc_type=doc_type, size=1,
+                body={"query": {"ids": {"values": [doc_id]}},
+                      "_source": False})['hits']['hits']
+        except es_exceptions.NotFoundError:
+            return None
+        for hit in hits:
+            return hit.get('_routing')
+        LOG.warning("Could not find the routing of document %s in %s/%s",
+                    doc_id, index, doc_type)
+        return None
+
+    def _meta_index(self, timestamp):
+        """Get the meta index which stores entries for the given timestamp."""
+        if not self.partition_meta_index:
+            return self.meta_index_name
+        return '%s-%s' % (self.meta_index_name, time.strftime(
+            META_PARTITION_FORMAT, time.gmtime(timestamp >> 32)))
+
+    def _meta_indices(self, start_ts=None, end_ts=None):
+        """Get the meta indices to search for entries in a time range."""
+        if not self.partition_meta_index:
+            return self.meta_index_name
+        pattern = '%s-*' % self.meta_index_name
+        if start_ts is None or end_ts is None:
+            return pattern
+        day = 24 * 60 * 60
+        start, end = (start_ts >> 32) // day, (end_ts >> 32) // day
+        if end - start >= MAX_SEARCHED_PARTITIONS:
+            return pattern
+        return ','.join(self._meta_index((d * day) << 32)
+                        for d in range(start, end + 1))
+
+    def prune_meta_index(self, now=None):
+        """Remove meta entries older than the configured retention.
+
+        Partitioned meta indices are dropped as a whole once the entire day
+        falls outside the retention, otherwise old entries are scanned and
+        deleted with bulk requests, since Elasticsearch 2.x has no delete by
+        query API.
+        """
+        if now is None:
+            now = time.time()
+        cutoff_ts = int(now - self.meta_index_retention) << 32
+        if not self.partition_meta_index:
+            _, failures = self._send_bulk(
+                {'_op_type': 'delete', '_index': hit['_index'],
+                 '_type': hit['_type'], '_id': hit['_id']}
+                for hit in scan(
+                    self.elastic, index=self.meta_index_name,
+                    doc_type=self.meta_type, _source=False,
+                    query={"query": {"range": {"_ts": {"lt": cutoff_ts}}}}))
+            for resp in failures:
+                LOG.error("Could not delete expired meta entry: %r", resp)
+            return
+        cutoff_index = self._meta_index(cutoff_ts)
+        prefix = '%s-' % self.meta_index_name
+        for name in sorted(self.elastic.indices.get(index=prefix + '*')):
+            try:
+                time.strptime(name[len(prefix):], META_PARTITION_FORMAT)
+            except ValueError:
+                # Not a meta index partition
+                continue
+            if name < cutoff_index:
+                LOG.info("Dropping expired meta index %s", name)
+                self.elastic.indices.delete(index=name, ignore=404)
+
     def stop(self):
         """Stop the auto-commit thread."""
         self.auto_commiter.join()
+        if self.meta_retention:
+            self.meta_retention.join()
+        if self.spool_replayer:
+            self.spool_replayer.join()
+        if self.lag_reporter:
+            self.lag_reporter.join()
+        if self.resync_finisher:
+            self.resync_finisher.join()
+        if self.credential_refresher:
+            self.credential_refresher.join()
         self.auto_commit_interval = 0
         # Commit any remaining docs from buffer
         self.commit()
+        if self.spool:
+            self.spool.close()
+        if self._mget_pool is not None:
+            self._mget_pool.close()
+            self._mget_pool.join()
+        if self.sink is not None:
+            self.sink.close()
+        for resync in self._resyncs.values():
+            # The dump may not be complete
+            LOG.warning("The resync of %s did not finish, shadow index %s "
+                        "is left as is", resync.alias, resync.shadow)
 
     def apply_update(self, doc, update_spec):
         if "$set" not in update_spec and "$unset" not in update_spec:
@@ -225,13 +1268,29 @@ class DocManager(DocManagerBase):
 
     @wrap_exceptions
     def handle_command(self, doc, namespace, timestamp):
-        # Flush buffer before handle command
-        self.commit()
+        if self.sink is not None and (doc.get('dropDatabase') or
+                                      doc.get('drop')):
+            LOG.warning("Deleted documents cannot be written to the sink, "
+                        "ignoring command %r on %s", doc, namespace)
+            return
+        # Operations buffered on the affected namespaces are sent before
+        # the command is handled, the other namespaces keep buffering
         db = namespace.split('.', 1)[0]
         if doc.get('dropDatabase'):
             dbs = self.command_helper.map_db(db)
             for _db in dbs:
-                self.elastic.indices.delete(index=_db.lower())
+                self._flush_namespace(_db.lower())
+                self._abort_resync(_db.lower())
+                if self.shared_indices is None:
+                    self.elastic.indices.delete(index=_db.lower())
+                else:
+                    self._drop_shared_database(_db)
+                    # Every collection of the database may be shared
+                    self.elastic.indices.delete(index=_db.lower(),
+                                                ignore=404)
+                self._forget_mappings(_db.lower())
+            if self.fingerprints is not None:
+                self.fingerprints.clear()
 
         if doc.get('renameCollection'):
             raise errors.OperationFailed(
@@ -240,29 +1299,60 @@ class DocManager(DocManagerBase):
         if doc.get('create'):
             db, coll = self.command_helper.map_collection(db, doc['create'])
             if db and coll:
-                self.elastic.indices.put_mapping(
-                    index=db.lower(), doc_type=coll,
-                    body={
-                        "_source": {"enabled": True}
-                    })
+                index, _ = self._index_and_mapping('%s.%s' % (db, coll))
+                self._flush_namespace(index, coll)
+                self._put_mapping(index, coll,
+                                  {"_source": {"enabled": True}})
+                self._prepare_shared('%s.%s' % (db, coll))
 
         if doc.get('drop'):
             db, coll = self.command_helper.map_collection(db, doc['drop'])
             if db and coll:
+                namespace = '%s.%s' % (db, coll)
+                index, _ = self._index_and_mapping(namespace)
+                # The documents to delete are searched, so they must be
+                # visible
+                self._flush_namespace(index, coll, refresh=True)
                 # This will delete the items in coll, but not get rid of the
                 # mapping.
                 warnings.warn("Deleting all documents of type %s on index %s."
                               "The mapping definition will persist and must be"
-                              "removed manually." % (coll, db))
-                responses = streaming_bulk(
-                    self.elastic,
-                    (dict(result, _op_type='delete') for result in scan(
-                        self.elastic, index=db.lower(), doc_type=coll)))
-                for ok, resp in responses:
-                    if not ok:
-                        LOG.error(
-                            "Error occurred while deleting ElasticSearch docum"
-                            "ent during handling of 'drop' command: %r" % resp)
+                              "removed manually." % (coll, index))
+                query = None
+                if self._is_shared(namespace):
+                    query = self.shared_indices.namespace_query(namespace)
+                _, failures = self._send_bulk(
+                    dict(result, _op_type='delete') for result in scan(
+                        self.elastic, query=query,
+                        index=self._indices_of(index), doc_type=coll))
+                for resp in failures:
+                    LOG.error(
+                        "Error occurred while deleting ElasticSearch docum"
+                        "ent during handling of 'drop' command: %r" % resp)
+                if self.fingerprints is not None:
+                    self.fingerprints.clear()
+
+    def _drop_shared_database(self, db):
+        """Delete the documents and aliases of a database from the shared
+        indices."""
+        names = self.shared_indices.names
+        for index in names:
+            self._flush_namespace(index)
+        # The documents to delete are searched, so they must be visible
+        self.elastic.indices.refresh(index=names, ignore_unavailable=True)
+        _, failures = self._send_bulk(
+            dict(result, _op_type='delete') for result in scan(
+                self.elastic, query=self.shared_indices.database_query(db),
+                index=names, ignore_unavailable=True))
+        for resp in failures:
+            LOG.error("Error occurred while deleting ElasticSearch document "
+                      "during handling of 'dropDatabase' command: %r" % resp)
+        self.elastic.indices.delete_alias(index=names,
+                                          name='%s.*' % db.lower(),
+                                          ignore=404)
+        for namespace in list(self._shared_namespaces):
+            if namespace.split('.', 1)[0] == db:
+                self._shared_namespaces.discard(namespace)
 
     @wrap_exceptions
     def update(self, document_id, update_spec, namespace, timestamp):
@@ -271,11 +1361,11 @@ class DocManager(DocManagerBase):
         """
 
         index, doc_type = self._index_and_mapping(namespace)
-        with self.lock:
+        doc_id = self._document_id(namespace, document_id)
+        buf = self._buffer_for(namespace, doc_id)
+        with buf.lock:
             # Check if document source is stored in local buffer
-            document = self.BulkBuffer.get_from_sources(index,
-                                                        doc_type,
-                                                        u(document_id))
+            document = buf.get_from_sources(index, doc_type, doc_id)
         if document:
             # Document source collected from local buffer
             # Perform apply_update on it and then it will be
@@ -284,6 +1374,9 @@ class DocManager(DocManagerBase):
             # _id is immutable in MongoDB, so won't have changed in update
             updated['_id'] = document_id
             self.upsert(updated, namespace, timestamp)
+        elif self.sink is not None:
+            updated = {"_id": document_id}
+            self._sink_update(document_id, update_spec, namespace, timestamp)
         else:
             # Document source needs to be retrieved from Elasticsearch
             # before performing update. Pass update_spec to upsert function
@@ -292,83 +1385,77 @@ class DocManager(DocManagerBase):
         # upsert() strips metadata, so only _id + fields in _source still here
         return updated
 
+    def _sink_update(self, document_id, update_spec, namespace, timestamp):
+        """Write an update of a document which is not buffered to the sink,
+        which cannot retrieve the document to apply it to.
+
+        A replacement is written as the document, and $set and $unset as a
+        partial update, whose object values are merged into the stored
+        objects and whose unset fields are null.
+        """
+        if not any(key.startswith('$') for key in update_spec):
+            self.upsert(dict(update_spec, _id=document_id), namespace,
+                        timestamp)
+            return
+        partial = _partial_update(update_spec)
+        index, doc_type = self._index_and_mapping(namespace)
+        doc_id = self._document_id(namespace, document_id)
+        self.index(BufferedOperation(
+            'update', index, doc_type, doc_id,
+            {'doc': self._formatter.format_document(partial)},
+            self._routing(namespace, index, doc_type, doc_id,
+                          update_spec=update_spec),
+            namespace, timestamp))
+
     @wrap_exceptions
     def upsert(self, doc, namespace, timestamp, update_spec=None):
         """Insert a document into Elasticsearch."""
         index, doc_type = self._index_and_mapping(namespace)
-        # No need to duplicate '_id' in source document
-        doc_id = u(doc.pop("_id"))
-        metadata = {
-            'ns': namespace,
-            '_ts': timestamp
-        }
-
+        doc_id = self._document_id(namespace, doc["_id"])
+        if (self.infer_mappings and not update_spec and
+                (index, doc_type) not in self._known_mappings):
+            self._infer_mapping(namespace, [doc])
+        self._prepare_shared(namespace)
+
+        source = None
+        if not update_spec:
+            # No need to duplicate '_id' in source document
+            source = self._formatter.format_document(doc)
+            source.pop('_id', None)
         # Index the source document, using lowercase namespace as index name.
-        action = {
-            '_op_type': 'index',
-            '_index': index,
-            '_type': doc_type,
-            '_id': doc_id,
-            '_source': self._formatter.format_document(doc)
-        }
-        # Index document metadata with original namespace (mixed upper/lower).
-        meta_action = {
-            '_op_type': 'index',
-            '_index': self.meta_index_name,
-            '_type': self.meta_type,
-            '_id': doc_id,
-            '_source': bson.json_util.dumps(metadata)
-        }
+        operation = BufferedOperation(
+            'index', index, doc_type, doc_id, source,
+            self._routing(namespace, index, doc_type, doc_id, doc,
+                          update_spec),
+            namespace, timestamp)
 
-        self.index(action, meta_action, doc, update_spec)
-
-        # Leave _id, since it's part of the original document
-        doc['_id'] = doc_id
+        self.index(operation, doc, update_spec)
 
     @wrap_exceptions
     def bulk_upsert(self, docs, namespace, timestamp):
         """Insert multiple documents into Elasticsearch."""
-        def docs_to_upsert():
-            doc = None
-            for doc in docs:
-                # Remove metadata and redundant _id
-                index, doc_type = self._index_and_mapping(namespace)
-                doc_id = u(doc.pop("_id"))
-                document_action = {
-                    '_index': index,
-                    '_type': doc_type,
-                    '_id': doc_id,
-                    '_source': self._formatter.format_document(doc)
-                }
-                document_meta = {
-                    '_index': self.meta_index_name,
-                    '_type': self.meta_type,
-                    '_id': doc_id,
-                    '_source': {
-                        'ns': namespace,
-                        '_ts': timestamp
-                    }
-                }
-                yield document_action
-                yield document_meta
-            if doc is None:
-                raise errors.EmptyDocsError(
-                    "Cannot upsert an empty sequence of "
-                    "documents into Elastic Search")
+        checkpoint = {}
+        docs = self._infer_bulk_mapping(docs, namespace)
         try:
-            kw = {}
-            if self.chunk_size > 0:
-                kw['chunk_size'] = self.chunk_size
-
-            responses = streaming_bulk(client=self.elastic,
-                                       actions=docs_to_upsert(),
-                                       **kw)
-
-            for ok, resp in responses:
-                if not ok:
+            # The other namespaces of a shared index are not dumped
+            if self.shadow_resync and not self._is_shared(namespace):
+                index, doc_type = self._index_and_mapping(namespace)
+                with self._resync_writes(index, doc_type) as shadow:
+                    _, failures = self._send_bulk(self._bulk_upsert_actions(
+                        docs, namespace, timestamp, checkpoint, shadow),
+                        lane=DUMP)
+            else:
+                _, failures = self._send_bulk(self._bulk_upsert_actions(
+                    docs, namespace, timestamp, checkpoint), lane=DUMP)
+            if failures:
+                for resp in failures:
                     LOG.error(
                         "Could not bulk-upsert document "
                         "into ElasticSearch: %r" % resp)
+                raise BulkIndexError('%i document(s) failed to index.' %
+                                     len(failures), failures)
+            self._save_checkpoint(checkpoint)
+            self.lag_tracker.acknowledged({namespace: timestamp})
             if self.auto_commit_interval == 0:
                 self.commit()
         except errors.EmptyDocsError:
@@ -376,69 +1463,90 @@ class DocManager(DocManagerBase):
             # config file, but nothing to dump
             pass
 
+    def _bulk_upsert_actions(self, docs, namespace, timestamp, checkpoint,
+                             target_index=None):
+        """Generate the actions to upsert multiple documents.
+
+        The checkpoint dict is updated once all documents have been
+        generated. The documents are written into `target_index` if given,
+        instead of the index of the namespace.
+        """
+        self._prepare_shared(namespace)
+        doc = None
+        for doc in docs:
+            # Remove metadata and redundant _id
+            index, doc_type = self._index_and_mapping(namespace)
+            original_id = u(doc["_id"])
+            doc_id = self._document_id(namespace, original_id)
+            source = self._formatter.format_document(doc)
+            source.pop('_id', None)
+            self._tag_namespace(source, namespace)
+            document_action = {
+                '_index': target_index or index,
+                '_type': doc_type,
+                '_id': doc_id,
+                '_source': source
+            }
+            document_meta = {
+                '_index': self._meta_index(timestamp),
+                '_type': self.meta_type,
+                '_id': original_id,
+                '_source': {
+                    'ns': namespace,
+                    '_ts': timestamp
+                }
+            }
+            routing = self._routing(namespace, index, doc_type, doc_id, doc)
+            if routing is not None:
+                document_action['_routing'] = routing
+            if self._routing_field(namespace) is not None:
+                document_meta['_source']['routing'] = routing
+            if self.fingerprints is not None:
+                self.fingerprints.pop((index, doc_type, doc_id))
+            self._set_version(document_action, timestamp)
+            self._set_version(document_meta, timestamp)
+            yield document_action
+            yield document_meta
+        if doc is None:
+            raise errors.EmptyDocsError(
+                "Cannot upsert an empty sequence of "
+                "documents into Elastic Search")
+        checkpoint.update(_id=original_id, ns=namespace, _ts=timestamp)
+
     @wrap_exceptions
     def insert_file(self, f, namespace, timestamp):
         doc = f.get_metadata()
-        doc_id = str(doc.pop('_id'))
+        doc_id = self._document_id(namespace, str(doc.pop('_id')))
         index, doc_type = self._index_and_mapping(namespace)
+        self._prepare_shared(namespace)
 
         # make sure that elasticsearch treats it like a file
-        if not self.has_attachment_mapping:
-            body = {
-                "properties": {
-                    self.attachment_field: {"type": "attachment"}
-                }
+        self._put_mapping(index, doc_type, {
+            "properties": {
+                self.attachment_field: {"type": "attachment"}
             }
-            self.elastic.indices.put_mapping(index=index,
-                                             doc_type=doc_type,
-                                             body=body)
-            self.has_attachment_mapping = True
-
-        metadata = {
-            'ns': namespace,
-            '_ts': timestamp,
-        }
+        })
 
+        routing = self._routing(namespace, index, doc_type, doc_id, doc)
         doc = self._formatter.format_document(doc)
         doc[self.attachment_field] = base64.b64encode(f.read()).decode()
 
-        action = {
-            '_op_type': 'index',
-            '_index': index,
-            '_type': doc_type,
-            '_id': doc_id,
-            '_source': doc
-        }
-        meta_action = {
-            '_op_type': 'index',
-            '_index': self.meta_index_name,
-            '_type': self.meta_type,
-            '_id': doc_id,
-            '_source': bson.json_util.dumps(metadata)
-        }
-
-        self.index(action, meta_action)
+        self.index(BufferedOperation('index', index, doc_type, doc_id, doc,
+                                     routing, namespace, timestamp))
 
     @wrap_exceptions
     def remove(self, document_id, namespace, timestamp):
         """Remove a document from Elasticsearch."""
         index, doc_type = self._index_and_mapping(namespace)
+        doc_id = self._document_id(namespace, document_id)
 
-        action = {
-            '_op_type': 'delete',
-            '_index': index,
-            '_type': doc_type,
-            '_id': u(document_id)
-        }
-
-        meta_action = {
-            '_op_type': 'delete',
-            '_index': self.meta_index_name,
-            '_type': self.meta_type,
-            '_id': u(document_id)
-        }
+        routing = self._routing(namespace, index, doc_type, doc_id)
+        if routing is not None:
+            self.routing_cache.pop((index, doc_type, doc_id))
 
-        self.index(action, meta_action)
+        self.index(BufferedOperation('delete', index, doc_type, doc_id,
+                                     routing=routing, namespace=namespace,
+                                     timestamp=timestamp))
 
     @wrap_exceptions
     def _stream_search(self, *args, **kwargs):
@@ -454,8 +1562,9 @@ class DocManager(DocManagerBase):
         This method is used to find documents that may be in conflict during
         a rollback event in MongoDB.
         """
-        return self._stream_search(
-            index=self.meta_index_name,
+        results = self._stream_search(
+            index=self._meta_indices(start_ts, end_ts),
+            ignore_unavailable=True,
             body={
                 "query": {
                     "range": {
@@ -463,37 +1572,685 @@ class DocManager(DocManagerBase):
                     }
                 }
             })
-
-    def index(self, action, meta_action, doc_source=None, update_spec=None):
-        with self.lock:
-            self.BulkBuffer.add_upsert(action, meta_action, doc_source, update_spec)
-
-        # Divide by two to account for meta actions
-        if len(self.BulkBuffer.action_buffer) / 2 >= self.chunk_size or self.auto_commit_interval == 0:
+        if not self.partition_meta_index:
+            return results
+        return self._unique_entries(results)
+
+    def _unique_entries(self, results):
+        """Skip entries of documents already returned from another
+        meta index partition."""
+        seen = set()
+        for entry in results:
+            key = (entry.get('ns'), entry['_id'])
+            if key not in seen:
+                seen.add(key)
+                yield entry
+
+    def _set_version(self, action, timestamp):
+        """Set the external version of an action to the oplog timestamp."""
+        if self.external_versioning and timestamp is not None:
+            action['_version'] = timestamp
+            action['_version_type'] = 'external'
+
+    def _bulk_actions(self, operation):
+        """Build the bulk actions of a buffered operation: the action on
+        the document, and the one on its meta index entry."""
+        action = {
+            '_op_type': operation.op_type,
+            '_index': operation.index,
+            '_type': operation.doc_type,
+            '_id': operation.doc_id
+        }
+        if operation.source is not None:
+            # Also tags the sources of updates, which were not formatted
+            # by upsert
+            self._tag_namespace(operation.source, operation.namespace)
+            action['_source'] = operation.source
+        if operation.routing is not None:
+            action['_routing'] = operation.routing
+
+        meta_id = self._original_id(operation.namespace, operation.doc_id)
+        if operation.op_type == 'delete' and not self.partition_meta_index:
+            meta_action = {
+                '_op_type': 'delete',
+                '_index': self.meta_index_name,
+                '_type': self.meta_type,
+                '_id': meta_id
+            }
+        else:
+            # Index document metadata with original namespace (mixed
+            # upper/lower). A removal is recorded in the current partition
+            # since the entry may live in any of them, so rollbacks still
+            # see it. The routing is kept for later lookups.
+            meta_source = {
+                'ns': operation.namespace,
+                '_ts': operation.timestamp
+            }
+            if self._routing_field(operation.namespace) is not None:
+                meta_source['routing'] = operation.routing
+            meta_action = {
+                '_op_type': 'index',
+                '_index': self._meta_index(operation.timestamp),
+                '_type': self.meta_type,
+                '_id': meta_id,
+                '_source': bson.json_util.dumps(meta_source)
+            }
+        if operation.op_type != 'update':
+            # Partial updates cannot be externally versioned
+            self._set_version(action, operation.timestamp)
+        self._set_version(meta_action, operation.timestamp)
+        return action, meta_action
+
+    def index(self, operation, doc_source=None, update_spec=None):
+        buf = self._buffer_for(operation.namespace, operation.doc_id)
+        with buf.lock:
+            buf.add_upsert(operation, doc_source, update_spec)
+            buf.update_checkpoint(
+                self._original_id(operation.namespace, operation.doc_id),
+                operation.namespace, operation.timestamp)
+
+        if self.auto_commit_interval == 0:
             self.commit()
+        elif len(buf.action_buffer) >= self.chunk_size:
+            # Only the full shard is sent, the others keep buffering
+            self._send_buffer(buf)
+            self.refresh()
 
     def send_buffered_operations(self):
         """Send buffered operations to Elasticsearch.
 
         This method is periodically called by the AutoCommitThread.
+        Callers arriving while the buffers are being sent wait for one
+        more flush, shared by all of them.
+        """
+        self._flusher()
+
+    def _send_buffers(self):
+        for buf in self.buffer_shards:
+            self._send_buffer(buf)
+
+    def _flush_namespace(self, index, doc_type=None, refresh=False):
+        """Send the buffered operations on an index, or on one of its
+        mappings, and optionally refresh the index.
+
+        The operations on other namespaces stay buffered.
         """
-        with self.lock:
+        def affected(op_index, op_doc_type):
+            return op_index == index and doc_type in (None, op_doc_type)
+
+        for buf in self.buffer_shards:
+            # The lock is held until the operations are sent, so that later
+            # operations on the namespace cannot be sent before them
+            with buf.lock:
+                part = buf.split(affected)
+                try:
+                    self._send_buffer(part)
+                finally:
+                    if part.action_buffer:
+                        # The operations were kept, e.g. until the spool is
+                        # replayed, or could not be prepared
+                        buf.merge(part)
+        self._after_flush_namespace()
+        if refresh and self.sink is None:
+            retry_until_ok(self.elastic.indices.refresh, index=index)
+
+    def _after_flush_namespace(self):
+        """Hook called once the operations on a namespace have been sent."""
+        pass
+
+    def _send_buffer(self, buf):
+        """Send the operations of one buffer shard to Elasticsearch."""
+        with buf.lock:
             try:
-                action_buffer = self.BulkBuffer.get_buffer()
+                if self.spool is not None and self.spool.pending():
+                    # Older operations are still spooled, they must reach
+                    # Elasticsearch before anything else does
+                    if ((time.time() < self._spool_retry_at or
+                            not self.replay_spool()) and
+                            self._spool_buffer(buf)):
+                        return
+                checkpoint = buf.checkpoint
+                timestamps = buf.newest_timestamps()
+                operations = buf.action_buffer
+                action_buffer = buf.get_buffer()
+                fingerprints = None
+                if self.fingerprints is not None:
+                    action_buffer, fingerprints = self._skip_unchanged(
+                        action_buffer)
+                    if not action_buffer:
+                        # Elasticsearch already has every document
+                        if checkpoint:
+                            self._save_checkpoint(checkpoint)
+                        self.lag_tracker.acknowledged(timestamps)
                 if action_buffer:
-                    successes, errors = bulk(self.elastic, action_buffer)
+                    stale = []
+                    try:
+                        successes, errors = self._send_bulk(action_buffer,
+                                                            stale)
+                    except es_exceptions.TransportError as exc:
+                        if self.spool is None or not _is_unavailable(exc):
+                            raise
+                        LOG.warning("Elasticsearch is unavailable, spooling "
+                                    "%d actions: %s", len(action_buffer), exc)
+                        self._spool_retry_at = (time.time() +
+                                                self._spool_replay_interval)
+                        self._spool_actions(action_buffer, checkpoint,
+                                            timestamps)
+                        return
                     LOG.debug("Bulk request finished, successfully sent %d "
                               "operations", successes)
+                    if stale:
+                        self._warn_stale(stale, operations)
+                    self.lag_tracker.acknowledged(timestamps)
                     if errors:
                         LOG.error(
                             "Bulk request finished with errors: %r", errors)
+                    elif checkpoint:
+                        self._save_checkpoint(checkpoint)
+                    if fingerprints and not errors and not stale:
+                        # Only sources known to be in Elasticsearch
+                        for key, fingerprint in fingerprints.items():
+                            self.fingerprints.set(key, fingerprint)
             except es_exceptions.ElasticsearchException:
                 LOG.exception("Bulk request failed with exception")
 
+    def _warn_stale(self, stale, operations):
+        """Warn about the writes of buffered operations which Elasticsearch
+        ignored because the document has a newer external version, like
+        the writes of a rollback."""
+        namespaces = dict(
+            ((operation.index, operation.doc_type, operation.doc_id),
+             operation.namespace) for operation in operations)
+        meta_prefix = '%s-' % self.meta_index_name
+        for item in stale:
+            for result in item.values():
+                error = result['error']
+                index = error.get('index') or ''
+                if (index == self.meta_index_name or
+                        index.startswith(meta_prefix)):
+                    # The write of the document is reported
+                    continue
+                match = VERSION_CONFLICT_REASON.match(
+                    error.get('reason') or '')
+                namespace = match and namespaces.get(
+                    (index, match.group(1), match.group(2)))
+                if namespace:
+                    LOG.warning(
+                        "Elasticsearch ignored a write of document %s in "
+                        "%s older than its stored version: %s",
+                        self._original_id(namespace, match.group(2)),
+                        namespace, error.get('reason'))
+                else:
+                    LOG.warning("Elasticsearch ignored a write older than "
+                                "the stored version: %r", error)
+
+    def _skip_unchanged(self, action_buffer):
+        """Drop the writes of sources identical to those in Elasticsearch.
+
+        Returns the remaining actions, and the fingerprints of the sources
+        they write, to be remembered once they have been sent. Documents
+        which are written are forgotten until then.
+        """
+        actions = []
+        fingerprints = {}
+        skipped = 0
+        for action, meta_action in zip(action_buffer[::2],
+                                       action_buffer[1::2]):
+            key = (action['_index'], action['_type'], action['_id'])
+            if action.get('_op_type') in ('delete', 'update'):
+                self.fingerprints.pop(key)
+                fingerprints.pop(key, None)
+            else:
+                fingerprint = _fingerprint(action['_source'])
+                if self.fingerprints.get(key) == fingerprint:
+                    skipped += 1
+                    continue
+                self.fingerprints.pop(key)
+                fingerprints[key] = fingerprint
+            actions.append(action)
+            actions.append(meta_action)
+        if skipped:
+            with self._stats_lock:
+                self.suppressed_writes += skipped
+            LOG.debug("Skipped %d writes of unchanged documents", skipped)
+        return actions, fingerprints
+
+    def _send_bulk(self, actions, stale=None, lane=LIVE):
+        """Send actions with bulk requests.
+
+        With shardAwareBulk, each chunk of actions is split by the node
+        holding the primary shards, and every part is sent to its node.
+        With priorityLanes, the requests are sent by the client of the
+        lane, within its share of the concurrent requests.
+
+        Returns a tuple of the number of successful actions and a list of
+        errors. Writes ignored because of their version are appended to
+        `stale`.
+        """
+        if self.sink is not None:
+            return self._sink_bulk(actions)
+        if lane == DUMP:
+            elastic, router = self.dump_elastic, self.dump_router
+        else:
+            elastic, router = self.elastic, self.shard_router
+            if self._resyncs:
+                actions = self._with_shadow_writes(actions)
+        slot = None
+        if self.lanes is not None:
+            slot = functools.partial(self.lanes.slot, lane)
+        if router is None:
+            return _bulk(elastic, actions, self.chunk_size, stale, slot)
+        successes, failures = 0, []
+        for chunk in _chunks(actions, max(self.chunk_size, 1)):
+            for client, group in router.group(chunk):
+                try:
+                    sent, failed = _bulk(client, group, self.chunk_size,
+                                         stale, slot)
+                except es_exceptions.ConnectionError as exc:
+                    if client is elastic:
+                        raise
+                    # The node may have left the cluster
+                    LOG.warning("Could not send a bulk request to its node, "
+                                "letting the cluster route it: %s", exc)
+                    router.invalidate()
+                    sent, failed = _bulk(elastic, group, self.chunk_size,
+                                         stale, slot)
+                successes += sent
+                failures.extend(failed)
+        return successes, failures
+
+    def _sink_bulk(self, actions):
+        """Write the bodies of the bulk requests to the sink files."""
+        successes = 0
+        for body, count in bulk_bodies(self.elastic.transport.serializer,
+                                       actions, self.chunk_size):
+            self.sink.write(body.encode('utf-8'))
+            successes += count
+        return successes, []
+
+    def _with_shadow_writes(self, actions):
+        """Write actions on indices being resynced to their shadow index
+        too."""
+        for action in actions:
+            yield action
+            resync = self._resyncs.get(action['_index'])
+            if resync is not None:
+                yield dict(action, _index=resync.shadow)
+                if resync.touched is not None:
+                    resync.touched.add((action['_type'], action['_id'],
+                                        action.get('_routing')))
+
+    def _indices_of(self, index):
+        """Get the index and its shadow index, if it is being resynced."""
+        resync = self._resyncs.get(index)
+        if resync is None:
+            return index
+        return [index, resync.shadow]
+
+    def begin_resync(self, index):
+        """Start a resync of an index.
+
+        Documents dumped with bulk_upsert are written into a new shadow
+        index, and the other operations on the index are written to both
+        indices, until finish_resync moves the alias named after the index
+        to the shadow index. Returns the name of the shadow index.
+        """
+        with self._resyncs_lock:
+            return self._begin_resync(index).shadow
+
+    def _begin_resync(self, index):
+        resync = self._resyncs.get(index)
+        if resync is None:
+            resync = create_shadow(self.elastic, index)
+            LOG.info("Resyncing index %s into %s", index, resync.shadow)
+            self._resyncs[index] = resync
+        return resync
+
+    @contextlib.contextmanager
+    def _resync_writes(self, index, doc_type):
+        """Context manager of a dump of doc_type into the shadow index of
+        index."""
+        with self._resyncs_lock:
+            resync = self._begin_resync(index)
+            resync.writers += 1
+            resync.doc_types.add(doc_type)
+        try:
+            yield resync.shadow
+        finally:
+            with self._resyncs_lock:
+                resync.writers -= 1
+                resync.last_write = time.time()
+
+    def finish_resync(self, index):
+        """Finish the resync of an index.
+
+        The buffered operations are sent, the documents of the mapping
+        types which were not dumped are copied into the shadow index, its
+        settings are restored and the alias named after the index is moved
+        to it. The indices previously behind the alias are deleted.
+        """
+        with self._resyncs_lock:
+            self._finish_resync(index)
+
+    @contextlib.contextmanager
+    def _buffers_locked(self):
+        """Context manager during which no operation is sent."""
+        for buf in self.buffer_shards:
+            buf.lock.acquire()
+        try:
+            # Also wait for the requests already submitted
+            self._after_flush_namespace()
+            yield
+        finally:
+            for buf in self.buffer_shards:
+                buf.lock.release()
+
+    def _finish_resync(self, index):
+        resync = self._resyncs[index]
+        self.send_buffered_operations()
+        with self._buffers_locked():
+            resync.touched = set()
+        try:
+            # Replication goes on during the copy
+            doc_types = self._copy_untouched_types(resync)
+            # No operation can be sent while the alias is moved
+            with self._buffers_locked():
+                self._copy_touched(resync, doc_types)
+                swap_alias(self.elastic, resync)
+                del self._resyncs[index]
+        finally:
+            resync.touched = None
+        LOG.info("Finished the resync of index %s into %s", index,
+                 resync.shadow)
+
+    def _copy_untouched_types(self, resync):
+        """Copy the documents of the types which were not dumped from the
+        current index into the shadow index.
+
+        Live operations are written to both indices during the copy, which
+        may overwrite them with an older version: they are recorded to be
+        copied again by _copy_touched. Returns the copied types.
+        """
+        doc_types = untouched_types(self.elastic, resync)
+        if not doc_types:
+            return doc_types
+        LOG.info("Copying the documents of %s from %s into %s",
+                 ', '.join(doc_types), resync.alias, resync.shadow)
+        self.elastic.indices.refresh(index=resync.alias)
+        actions = []
+        for hit in scan(self.elastic, index=resync.alias, doc_type=doc_types,
+                        version=self.external_versioning):
+            action = {'_index': resync.shadow, '_type': hit['_type'],
+                      '_id': hit['_id'], '_source': hit['_source']}
+            if '_routing' in hit:
+                action['_routing'] = hit['_routing']
+            if self.external_versioning and '_version' in hit:
+                action['_version'] = hit['_version']
+                action['_version_type'] = 'external_gte'
+            actions.append(action)
+            if len(actions) >= self.chunk_size:
+                self._copy_actions(resync, actions)
+                actions = []
+        if actions:
+            self._copy_actions(resync, actions)
+        return doc_types
+
+    def _copy_touched(self, resync, doc_types):
+        """Copy the newest version of the documents of the copied types
+        written by live operations during the copy.
+
+        No operation is sent meanwhile, so the current index holds the
+        newest version of these documents.
+        """
+        keys = sorted(key for key in resync.touched if key[0] in doc_types)
+        if not keys:
+            return
+        LOG.debug("Copying %d documents written during the copy of %s",
+                  len(keys), resync.alias)
+        docs = []
+        for doc_type, doc_id, routing in keys:
+            doc = {'_index': resync.alias, '_type': doc_type, '_id': doc_id}
+            if routing is not None:
+                doc['_routing'] = routing
+            docs.append(doc)
+        actions = []
+        for chunk in _chunks(docs, max(self.mget_chunk_size, 1)):
+            for doc in self.elastic.mget(body={'docs': chunk},
+                                         realtime=True)['docs']:
+                action = {'_index': resync.shadow, '_type': doc['_type'],
+                          '_id': doc['_id']}
+                if '_routing' in doc:
+                    action['_routing'] = doc['_routing']
+                if not doc.get('found'):
+                    action['_op_type'] = 'delete'
+                else:
+                    action['_source'] = doc['_source']
+                    if self.external_versioning and '_version' in doc:
+                        action['_version'] = doc['_version']
+                        action['_version_type'] = 'external_gte'
+                actions.append(action)
+        self._copy_actions(resync, actions)
+
+    def _copy_actions(self, resync, actions):
+        _, failures = self._send_bulk(actions)
+        if failures:
+            # The current index is kept, the resync can be finished again
+            raise errors.OperationFailed(
+                'Could not copy %d document(s) into shadow index %s: %r' % (
+                    len(failures), resync.shadow, failures[:10]))
+
+    def finish_idle_resyncs(self, idle):
+        """Finish the resyncs without dumped documents for idle seconds."""
+        with self._resyncs_lock:
+            now = time.time()
+            for index, resync in list(self._resyncs.items()):
+                if resync.writers == 0 and now - resync.last_write >= idle:
+                    self._finish_resync(index)
+
+    def _abort_resync(self, index):
+        """Drop the shadow index of an index, if it is being resynced."""
+        with self._resyncs_lock:
+            resync = self._resyncs.pop(index, None)
+        if resync is not None:
+            LOG.warning("Aborting the resync of index %s", index)
+            self.elastic.indices.delete(index=resync.shadow, ignore=404)
+
+    def _mget(self, docs):
+        """Retrieve documents with a realtime mget request."""
+        if self.sink is not None:
+            LOG.warning("The sources of %d updated documents cannot be "
+                        "retrieved from the sink", len(docs))
+            return [dict(doc, found=False) for doc in docs]
+        return self.elastic.mget(body={'docs': docs}, realtime=True)['docs']
+
+    def fetch_sources(self, docs):
+        """Start retrieving documents in the background.
+
+        Returns an AsyncResult holding the list of retrieved documents.
+        """
+        with self._mget_pool_lock:
+            if self._mget_pool is None:
+                self._mget_pool = ThreadPool(self.mget_concurrency)
+        return self._mget_pool.apply_async(self._mget, (docs,))
+
+    def _spool_buffer(self, buf):
+        """Move the operations of a buffer shard to the spool.
+
+        Returns False if the buffer must be sent to Elasticsearch instead,
+        because the spool has been replayed while waiting for it.
+        """
+        if buf.doc_to_update:
+            # Updates need the current sources from Elasticsearch, so the
+            # buffer is kept until the spool has been replayed
+            if len(buf.action_buffer) < self._spool_max_held:
+                LOG.debug("Keeping %d buffered operations with pending "
+                          "updates until the spool is replayed",
+                          len(buf.action_buffer))
+                return True
+            LOG.warning("%d buffered operations with pending updates are "
+                        "held back, waiting for the spool to be replayed",
+                        len(buf.action_buffer))
+            while not self.replay_spool():
+                time.sleep(self._spool_replay_interval)
+            return False
+        checkpoint = buf.checkpoint
+        timestamps = buf.newest_timestamps()
+        action_buffer = buf.get_buffer()
+        if self.fingerprints is not None:
+            action_buffer, _ = self._skip_unchanged(action_buffer)
+        if action_buffer:
+            self._spool_actions(action_buffer, checkpoint, timestamps)
+        return True
+
+    def _spool_actions(self, action_buffer, checkpoint, timestamps=None):
+        """Append a bulk request to the spool."""
+        record = self.elastic.transport.serializer.dumps(
+            {'actions': action_buffer, 'checkpoint': checkpoint,
+             'timestamps': timestamps or {}})
+        if not isinstance(record, bytes):
+            record = record.encode('utf-8')
+        self.spool.append(record)
+
+    def replay_spool(self):
+        """Send spooled bulk requests to Elasticsearch in order.
+
+        Returns True if the spool has been drained, or False if Elasticsearch
+        is still unavailable.
+        """
+        with self._spool_lock:
+            while True:
+                record = self.spool.peek()
+                if record is None:
+                    return True
+                request = json.loads(record.decode('utf-8'))
+                try:
+                    successes, errors = self._send_bulk(request['actions'])
+                    LOG.debug("Replayed %d spooled operations", successes)
+                    self.lag_tracker.acknowledged(
+                        request.get('timestamps', {}))
+                    if errors:
+                        LOG.error("Replayed bulk request finished with "
+                                  "errors: %r", errors)
+                    elif request['checkpoint']:
+                        self._save_checkpoint(request['checkpoint'])
+                except es_exceptions.ElasticsearchException as exc:
+                    if _is_unavailable(exc):
+                        LOG.warning("Elasticsearch is still unavailable, "
+                                    "retrying spooled operations later: %s",
+                                    exc)
+                        self._spool_retry_at = (time.time() +
+                                                self._spool_replay_interval)
+                        return False
+                    LOG.exception("Replaying spooled bulk request failed")
+                self.spool.consume()
+
     def commit(self):
         """Send buffered requests and refresh all indexes."""
         self.send_buffered_operations()
-        retry_until_ok(self.elastic.indices.refresh, index="")
+        self.refresh()
+
+    def refresh(self):
+        """Refresh all indexes.
+
+        Concurrent calls share one refresh, and the refresh is skipped if
+        the previous one started less than `refreshWindow` seconds ago, or
+        while operations are spooled.
+        """
+        if self.spool is not None and self.spool.pending():
+            # Elasticsearch is unavailable, or behind the spool
+            return
+        if (self.refresh_window and
+                time.time() - self._refreshed_at < self.refresh_window):
+            return
+        self._refresher()
+
+    def _refresh_indices(self):
+        self._refreshed_at = time.time()
+        if self.sink is None:
+            retry_until_ok(self.elastic.indices.refresh, index="")
+
+    def stats(self):
+        """Get the statistics of this DocManager.
+
+        Returns a dict with:
+          - `namespaces`: dict of the statistics of each namespace: the
+            oplog timestamp of the newest operation acknowledged by
+            Elasticsearch (`last_ts`), when it was acknowledged
+            (`acknowledged_at`), the replication lag in seconds (`lag`), and
+            the age in seconds of the oldest buffered operation
+            (`oldest_buffered_age`). Values which are not known are None.
+          - `suppressed_writes`: number of writes of unchanged documents
+            which have been skipped.
+          - `lanes`: with priorityLanes, dict of the number of bulk requests
+            of each lane, the seconds spent waiting to send them, and the
+            requests in flight.
+          - `sink`: with sinkDirectory, dict of the number of complete
+            files, and the bytes and bulk request bodies written.
+          - `aws`: with aws, dict of the number of signed requests, the
+            seconds spent signing them, the number of signing keys derived,
+            and the number of credential refreshes and failed refreshes.
+        """
+        now = time.time()
+        namespaces = self.lag_tracker.lags()
+        for buf in self.buffer_shards:
+            with buf.lock:
+                buffered = [(namespace, entry[1]) for namespace, entry
+                            in buf.namespaces.items()]
+            for namespace, buffered_at in buffered:
+                stats = namespaces.setdefault(namespace, {})
+                age = now - buffered_at
+                if stats.get('oldest_buffered_age') is None or \
+                        age > stats['oldest_buffered_age']:
+                    stats['oldest_buffered_age'] = age
+        for stats in namespaces.values():
+            for key in ('last_ts', 'acknowledged_at', 'lag',
+                        'oldest_buffered_age'):
+                stats.setdefault(key, None)
+        result = {'namespaces': namespaces,
+                  'suppressed_writes': self.suppressed_writes}
+        if self.lanes is not None:
+            result['lanes'] = self.lanes.stats()
+        if self.sink is not None:
+            result['sink'] = self.sink.stats()
+        if self.aws_signer is not None:
+            result['aws'] = self.aws_signer.stats()
+        return result
+
+    def _save_checkpoint(self, checkpoint):
+        """Store the newest flushed operation in the meta index.
+
+        The checkpoint is versioned by its timestamp, so Elasticsearch itself
+        rejects a checkpoint older than the one already stored.
+        """
+        timestamp = checkpoint.get('_ts')
+        if timestamp is None or (self._checkpoint_ts is not None and
+                                 timestamp <= self._checkpoint_ts):
+            return
+        if self.sink is not None:
+            self._sink_bulk([{
+                '_index': self.meta_index_name,
+                '_type': self.checkpoint_type,
+                '_id': CHECKPOINT_ID,
+                '_source': {'last_id': checkpoint['_id'],
+                            'last_ts': timestamp,
+                            'ns': checkpoint['ns']},
+                '_version': timestamp,
+                '_version_type': 'external_gte'}])
+            self._checkpoint_ts = timestamp
+            return
+        try:
+            self.elastic.index(index=self.meta_index_name,
+                               doc_type=self.checkpoint_type,
+                               id=CHECKPOINT_ID,
+                               body={'last_id': checkpoint['_id'],
+                                     'last_ts': timestamp,
+                                     'ns': checkpoint['ns']},
+                               version=timestamp,
+                               version_type='external_gte')
+        except es_exceptions.ConflictError:
+            # A newer checkpoint has already been stored
+            pass
+        self._checkpoint_ts = timestamp
 
     @wrap_exceptions
     def get_last_doc(self):
@@ -502,9 +2259,28 @@ class DocManager(DocManagerBase):
         This method is used to help define a time window within which documents
         may be in conflict after a MongoDB rollback.
         """
+        if self.sink is not None:
+            # Nothing can be rolled back in the sink files
+            return None
+        try:
+            result = self.elastic.get(index=self.meta_index_name,
+                                      doc_type=self.checkpoint_type,
+                                      id=CHECKPOINT_ID,
+                                      realtime=True)
+        except es_exceptions.NotFoundError:
+            # No checkpoint has been stored yet, e.g. the meta index was
+            # written by an older version of this DocManager
+            return self._search_last_doc()
+        source = result['_source']
+        return {'_id': source['last_id'],
+                '_ts': source['last_ts'],
+                'ns': source['ns']}
+
+    def _search_last_doc(self):
+        """Find the most recently modified document in the meta index."""
         try:
             result = self.elastic.search(
-                index=self.meta_index_name,
+                index=self._meta_indices(),
                 body={
                     "query": {"match_all": {}},
                     "sort": [{"_ts": "desc"}],
@@ -519,6 +2295,81 @@ class DocManager(DocManagerBase):
             return None
 
 
+class BufferedOperation(object):
+    """An operation on one document waiting in a BulkBuffer.
+
+    Only the fields which differ between operations are kept. The bulk
+    actions on the document and on its meta index entry are built from
+    them when the buffer is sent, see DocManager._bulk_actions.
+
+    The record is also the handle of a buffered update whose source is
+    applied later: it stays at its place in the buffer, and is skipped
+    when the buffer is sent if the update failed.
+    """
+    __slots__ = ('op_type', 'index', 'doc_type', 'doc_id', 'source',
+                 'routing', 'namespace', 'timestamp', 'failed')
+
+    def __init__(self, op_type, index, doc_type, doc_id, source=None,
+                 routing=None, namespace=None, timestamp=None):
+        self.op_type = op_type
+        self.index = index
+        self.doc_type = doc_type
+        self.doc_id = doc_id
+        self.source = source
+        self.routing = routing
+        self.namespace = namespace
+        self.timestamp = timestamp
+        self.failed = False
+
+    @property
+    def key(self):
+        return (self.index, self.doc_type, self.doc_id)
+
+    def mget_doc(self):
+        """Get the document to request from the mget API."""
+        doc = {'_index': self.index,
+               '_type': self.doc_type,
+               '_id': self.doc_id}
+        if self.routing is not None:
+            # Only the shard holding the document is asked for it
+            doc['_routing'] = self.routing
+        return doc
+
+
+def _partition(items, moved):
+    """Split items into the lists of the ones kept and the ones moved."""
+    kept, taken = [], []
+    for item in items:
+        (taken if moved(item) else kept).append(item)
+    return kept, taken
+
+
+def _newest_checkpoint(docman, operations):
+    """Get the checkpoint of the newest of buffered operations."""
+    checkpoint = None
+    for operation in operations:
+        if operation.timestamp is None:
+            continue
+        if checkpoint is None or operation.timestamp >= checkpoint['_ts']:
+            checkpoint = {'_id': docman._original_id(operation.namespace,
+                                                     operation.doc_id),
+                          'ns': operation.namespace,
+                          '_ts': operation.timestamp}
+    return checkpoint
+
+
+class _Fetched(object):
+    """Sources of an mget request which have already been retrieved."""
+    def __init__(self, docs):
+        self.docs = docs
+
+    def get(self, timeout=None):
+        return self.docs
+
+    def wait(self, timeout=None):
+        pass
+
+
 class BulkBuffer(object):
 
     def __init__(self, docman):
@@ -526,27 +2377,52 @@ class BulkBuffer(object):
         # Parent object
         self.docman = docman
 
-        # Action buffer for bulk indexing
+        # As bulk operation can be done in another thread
+        # lock is needed to prevent access to BulkBuffer
+        # while commiting documents to Elasticsearch
+        # It is because BulkBuffer might get outdated
+        # docs from Elasticsearch if bulk is still ongoing
+        self.lock = threading.Lock()
+
+        # Operations buffered for bulk indexing
+        # Format: [ BufferedOperation ]
         self.action_buffer = []
 
         # Docs to update
-        # Dict stores all documents for which firstly
+        # List stores all operations for which firstly
         # source has to be retrieved from Elasticsearch
         # and then apply_update needs to be performed
-        # Format: [ (doc, update_spec, action_buffer_index, get_from_ES) ]
+        # Format: [ (operation, update_spec, get_from_ES) ]
         self.doc_to_update = []
 
-        # Below dictionary contains ids of documents
+        # Below set contains keys of documents
         # which need to be retrieved from Elasticsearch
         # It prevents from getting same document multiple times from ES
-        # Format: {"_index": {"_type": {"_id": True}}}
-        self.doc_to_get = {}
+        # Format: set([ (_index, _type, _id) ])
+        self.doc_to_get = set()
 
         # Dictionary of sources
-        # Format: {"_index": {"_type": {"_id": {"_source": actual_source}}}}
+        # Format: {(_index, _type, _id): actual_source}
         self.sources = {}
 
-    def add_upsert(self, action, meta_action, doc_source, update_spec):
+        # Operations whose documents have to be retrieved from Elasticsearch
+        # which have not been requested yet, and the requests which have
+        # already been started
+        # Format: [ operation ] and [ ([ operation ], AsyncResult) ]
+        self.pending_gets = []
+        self.fetches = []
+
+        # Newest operation in the buffer, stored as the meta index
+        # checkpoint once the buffer has been sent
+        # Format: {"_id": doc_id, "ns": namespace, "_ts": timestamp}
+        self.checkpoint = None
+
+        # Newest timestamp of each namespace in the buffer, and when its
+        # first operation was buffered
+        # Format: {namespace: [timestamp, time buffered]}
+        self.namespaces = {}
+
+    def add_upsert(self, operation, doc_source, update_spec):
         """
         Function which stores sources for "insert" actions
         and decide if for "update" action has to add docs to
@@ -558,12 +2434,10 @@ class BulkBuffer(object):
         # from Elasticsearch. It means also that source
         # is not stored in local buffer
         if update_spec:
-            self.bulk_index(action, meta_action)
+            self.bulk_index(operation)
 
-            # -1 -> to get latest index number
-            # -1 -> to get action instead of meta_action
             # Update document based on source retrieved from ES
-            self.add_doc_to_update(action, update_spec, len(self.action_buffer) - 2)
+            self.add_doc_to_update(operation, update_spec)
         else:
             # Insert and update operations provide source
             # Store it in local buffer and use for comming updates
@@ -571,54 +2445,76 @@ class BulkBuffer(object):
             # add_to_sources will not be called for delete operation
             # as it does not provide doc_source
             if doc_source:
-                self.add_to_sources(action, doc_source)
-            self.bulk_index(action, meta_action)
+                self.add_to_sources(operation, doc_source)
+            self.bulk_index(operation)
 
-    def add_doc_to_update(self, action, update_spec, action_buffer_index):
+    def add_doc_to_update(self, operation, update_spec):
         """
         Prepare document for update based on Elasticsearch response.
         Set flag if document needs to be retrieved from Elasticsearch
         """
 
-        doc = {'_index': action['_index'],
-               '_type': action['_type'],
-               '_id': action['_id']}
-
         # If get_from_ES == True -> get document's source from Elasticsearch
-        get_from_ES = self.should_get_id(action)
-        self.doc_to_update.append((doc, update_spec, action_buffer_index, get_from_ES))
+        get_from_ES = self.should_get_id(operation)
+        self.doc_to_update.append((operation, update_spec, get_from_ES))
+        if get_from_ES:
+            self.pending_gets.append(operation)
+            if len(self.pending_gets) >= self.docman.mget_chunk_size:
+                self.prefetch()
+
+    def _fetch(self, operations):
+        docs = [operation.mget_doc() for operation in operations]
+        self.fetches.append((operations, self.docman.fetch_sources(docs)))
+
+    def prefetch(self):
+        """Start retrieving the pending documents from Elasticsearch"""
+        spool = self.docman.spool
+        if spool is not None and spool.pending():
+            # Elasticsearch is behind the spool, its documents are outdated
+            return
+        operations, self.pending_gets = self.pending_gets, []
+        if operations:
+            self._fetch(operations)
 
-    def should_get_id(self, action):
+    def should_get_id(self, operation):
         """
         Mark document to retrieve its source from Elasticsearch.
         Returns:
             True - if marking document for the first time in this bulk
             False - if document has been already marked
         """
-        mapping_ids = self.doc_to_get.setdefault(
-            action['_index'], {}).setdefault(action['_type'], set())
-        if action['_id'] in mapping_ids:
+        key = operation.key
+        if key in self.doc_to_get:
             # There is an update on this id already
             return False
         else:
-            mapping_ids.add(action['_id'])
+            self.doc_to_get.add(key)
             return True
 
     def get_docs_sources_from_ES(self):
         """Get document sources using MGET elasticsearch API"""
-        docs = [doc for doc, _, _, get_from_ES in self.doc_to_update if get_from_ES]
-        if docs:
-            documents = self.docman.elastic.mget(body={'docs': docs}, realtime=True)
-            return iter(documents['docs'])
-        else:
-            return iter([])
+        chunk_size = self.docman.mget_chunk_size
+        while self.pending_gets:
+            self._fetch(self.pending_gets[:chunk_size])
+            self.pending_gets = self.pending_gets[chunk_size:]
+        documents = []
+        try:
+            for _, fetch in self.fetches:
+                documents.extend(fetch.get())
+        except Exception:
+            # Request every document again on the next attempt
+            self.pending_gets = [operation for operations, _ in self.fetches
+                                 for operation in operations]
+            self.fetches = []
+            raise
+        return iter(documents)
 
     @wrap_exceptions
     def update_sources(self):
         """Update local sources based on response from Elasticsearch"""
         ES_documents = self.get_docs_sources_from_ES()
 
-        for doc, update_spec, action_buffer_index, get_from_ES in self.doc_to_update:
+        for operation, update_spec, get_from_ES in self.doc_to_update:
             if get_from_ES:
                 # Update source based on response from ES
                 ES_doc = next(ES_documents)
@@ -629,20 +2525,20 @@ class BulkBuffer(object):
                     # Seems like something went wrong during replication
                     LOG.error("mGET: Document id: %s has not been found "
                               "in Elasticsearch. Due to that "
-                              "following update failed: %s", doc['_id'], update_spec)
-                    self.reset_action(action_buffer_index)
+                              "following update failed: %s", operation.doc_id, update_spec)
+                    self.reset_action(operation)
                     continue
             else:
                 # Get source stored locally before applying update
                 # as it is up-to-date
-                source = self.get_from_sources(doc['_index'],
-                                               doc['_type'],
-                                               doc['_id'])
+                source = self.get_from_sources(operation.index,
+                                               operation.doc_type,
+                                               operation.doc_id)
                 if not source:
                     LOG.error("mGET: Document id: %s has not been found "
                               "in local sources. Due to that following "
-                              "update failed: %s", doc["_id"], update_spec)
-                    self.reset_action(action_buffer_index)
+                              "update failed: %s", operation.doc_id, update_spec)
+                    self.reset_action(operation)
                     continue
 
             updated = self.docman.apply_update(source, update_spec)
@@ -652,37 +2548,127 @@ class BulkBuffer(object):
                 del updated['_id']
 
             # Everytime update locally stored sources to keep them up-to-date
-            self.add_to_sources(doc, updated)
+            self.add_to_sources(operation, updated)
 
-            self.action_buffer[action_buffer_index]['_source'] = self.docman._formatter.format_document(updated)
+            operation.source = self.docman._formatter.format_document(updated)
 
-        # Remove empty actions if there were errors
-        self.action_buffer = [each_action for each_action in self.action_buffer if each_action]
-
-    def reset_action(self, action_buffer_index):
+    def reset_action(self, operation):
         """Reset specific action as update failed"""
-        self.action_buffer[action_buffer_index] = {}
-        self.action_buffer[action_buffer_index + 1] = {}
+        # The operation stays in action_buffer, which is not copied, and is
+        # left out when the bulk actions are built
+        operation.failed = True
 
-    def add_to_sources(self, action, doc_source):
+    def add_to_sources(self, operation, doc_source):
         """Store sources locally"""
-        mapping = self.sources.setdefault(action['_index'], {}).setdefault(action['_type'], {})
-        mapping[action['_id']] = doc_source
+        self.sources[operation.key] = doc_source
 
     def get_from_sources(self, index, doc_type, document_id):
         """Get source stored locally"""
-        return self.sources.get(index, {}).get(doc_type, {}).get(document_id, {})
+        return self.sources.get((index, doc_type, document_id), {})
 
-    def bulk_index(self, action, meta_action):
-        self.action_buffer.append(action)
-        self.action_buffer.append(meta_action)
+    def update_checkpoint(self, doc_id, namespace, timestamp):
+        """Remember the operation if it is the newest one in the buffer"""
+        if timestamp is None:
+            return
+        if self.checkpoint is None or timestamp >= self.checkpoint['_ts']:
+            self.checkpoint = {'_id': doc_id, 'ns': namespace, '_ts': timestamp}
+        entry = self.namespaces.get(namespace)
+        if entry is None:
+            self.namespaces[namespace] = [timestamp, time.time()]
+        elif timestamp > entry[0]:
+            entry[0] = timestamp
+
+    def newest_timestamps(self):
+        """Get the newest timestamp of each namespace in the buffer"""
+        return dict((namespace, entry[0])
+                    for namespace, entry in self.namespaces.items())
+
+    def bulk_index(self, operation):
+        self.action_buffer.append(operation)
+
+    def split(self, affected):
+        """Move the operations on some namespaces to a new buffer.
+
+        `affected` is called with the _index and _type of the operations.
+        The sources being retrieved from Elasticsearch are waited for, so
+        that each buffer gets the ones of its operations.
+        """
+        part = BulkBuffer(self.docman)
+        if not self.action_buffer:
+            return part
+
+        def moved(operation):
+            return affected(operation.index, operation.doc_type)
+
+        self.action_buffer, part.action_buffer = _partition(
+            self.action_buffer, moved)
+        if not part.action_buffer:
+            return part
+        self.doc_to_update, part.doc_to_update = _partition(
+            self.doc_to_update, lambda entry: moved(entry[0]))
+        self._split_fetches(part, moved)
+        self.pending_gets, part.pending_gets = _partition(
+            self.pending_gets, moved)
+        for key in [key for key in self.sources if affected(*key[:2])]:
+            part.sources[key] = self.sources.pop(key)
+        for key in [key for key in self.doc_to_get if affected(*key[:2])]:
+            self.doc_to_get.discard(key)
+            part.doc_to_get.add(key)
+        for namespace in list(self.namespaces):
+            if affected(*self.docman._index_and_mapping(namespace)):
+                part.namespaces[namespace] = self.namespaces.pop(namespace)
+        self.checkpoint = _newest_checkpoint(self.docman, self.action_buffer)
+        part.checkpoint = _newest_checkpoint(self.docman, part.action_buffer)
+        return part
+
+    def merge(self, part):
+        """Move back the operations of a buffer returned by split."""
+        if not part.action_buffer:
+            return
+        # The namespaces of the two buffers are distinct, so the order of
+        # their operations relative to each other does not matter
+        self.action_buffer.extend(part.action_buffer)
+        self.doc_to_update.extend(part.doc_to_update)
+        self.fetches.extend(part.fetches)
+        self.pending_gets.extend(part.pending_gets)
+        self.sources.update(part.sources)
+        self.doc_to_get.update(part.doc_to_get)
+        self.namespaces.update(part.namespaces)
+        self.checkpoint = _newest_checkpoint(self.docman, self.action_buffer)
+        part.clean_up()
+
+    def _split_fetches(self, part, moved):
+        """Share the retrieved sources between this buffer and part."""
+        fetches, self.fetches = self.fetches, []
+        try:
+            results = [(operations, fetch.get())
+                       for operations, fetch in fetches]
+        except Exception:
+            LOG.exception("mGET: Could not retrieve sources, they are "
+                          "requested again when the buffer is sent")
+            # Request every document again on the next attempt
+            self.pending_gets = [operation for operations, _ in fetches
+                                 for operation in operations
+                                 ] + self.pending_gets
+            return
+        for operations, docs in results:
+            kept, taken = _partition(zip(operations, docs),
+                                     lambda pair: moved(pair[0]))
+            for buf, pairs in ((self, kept), (part, taken)):
+                if pairs:
+                    buf.fetches.append(([op for op, _ in pairs],
+                                        _Fetched([doc for _, doc in pairs])))
 
     def clean_up(self):
         """Do clean-up before returning buffer"""
         self.action_buffer = []
         self.sources = {}
-        self.doc_to_get = {}
+        self.doc_to_get = set()
         self.doc_to_update = []
+        self.pending_gets = []
+        self.fetches = []
+        self.checkpoint = None
+        self.namespaces = {}
 
     def get_buffer(self):
         """Get buffer which needs to be bulked to elasticsearch"""
@@ -692,6 +2678,12 @@ class BulkBuffer(object):
         if self.doc_to_update:
             self.update_sources()
 
-        ES_buffer = self.action_buffer
+        operations = self.action_buffer
         self.clean_up()
+        # The bulk actions are only built now, so that the buffer holds
+        # one compact record per operation
+        ES_buffer = []
+        for operation in operations:
+            if not operation.failed:
+                ES_buffer.extend(self.docman._bulk_actions(operation))
         return ES_buffer
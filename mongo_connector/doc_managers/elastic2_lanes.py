@@ -0,0 +1,105 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Priority lanes for the bulk requests of the Elasticsearch DocManager.
+
+Operations read from the oplog go through the live lane, and the documents
+of a collection dump through the dump lane. Each lane sends its requests
+with its own client, so it has its own connection pool, and may only have
+its weighted share of the concurrent bulk requests in flight. The live lane
+can also use the share of the dump lane while it is free, so live changes
+never wait behind the requests of a dump.
+"""
+import contextlib
+import threading
+import time
+
+LIVE = 'live'
+"""The lane of the operations read from the oplog."""
+
+DUMP = 'dump'
+"""The lane of the documents of a collection dump."""
+
+DEFAULT_CONCURRENCY = 4
+"""The default number of concurrent bulk requests of all lanes."""
+
+DEFAULT_WEIGHTS = {LIVE: 3, DUMP: 1}
+"""The default weights of the lanes in the concurrent bulk requests."""
+
+
+class BulkLanes(object):
+    """Limit the concurrent bulk requests of the live and dump lanes.
+
+    :Parameters:
+      - `concurrency`: Number of concurrent bulk requests of all lanes.
+      - `weights`: Dict of the weight of each lane. Each lane gets at least
+        one request.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, weights=None):
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        if set(weights) != set([LIVE, DUMP]):
+            raise ValueError('lane weights must be given for "%s" and "%s"'
+                             % (LIVE, DUMP))
+        if any(weight <= 0 for weight in weights.values()):
+            raise ValueError('lane weights must be positive')
+        if concurrency < 2:
+            raise ValueError('lane concurrency must be at least 2')
+        total = float(sum(weights.values()))
+        dump = min(max(int(round(concurrency * weights[DUMP] / total)), 1),
+                   concurrency - 1)
+        # Format: {lane: number of concurrent requests}
+        self.shares = {LIVE: concurrency - dump, DUMP: dump}
+        self.concurrency = concurrency
+        self._cond = threading.Condition()
+        self._used = {LIVE: 0, DUMP: 0}
+        # Format: {lane: {"requests": count, "wait": seconds}}
+        self._stats = {LIVE: {'requests': 0, 'wait': 0.0},
+                       DUMP: {'requests': 0, 'wait': 0.0}}
+
+    def _available(self, lane):
+        if sum(self._used.values()) >= self.concurrency:
+            return False
+        # Only the live lane borrows the free requests of the other lane
+        return lane == LIVE or self._used[lane] < self.shares[lane]
+
+    def acquire(self, lane):
+        """Wait until a bulk request of the lane may be sent."""
+        start = time.time()
+        with self._cond:
+            while not self._available(lane):
+                self._cond.wait()
+            self._used[lane] += 1
+            self._stats[lane]['requests'] += 1
+            self._stats[lane]['wait'] += time.time() - start
+
+    def release(self, lane):
+        with self._cond:
+            self._used[lane] -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, lane):
+        """Context manager holding a bulk request of the lane."""
+        self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        """Get the number of requests of each lane, the seconds spent
+        waiting to send them, and the requests in flight."""
+        with self._cond:
+            return dict((lane, dict(stats, in_flight=self._used[lane]))
+                        for lane, stats in self._stats.items())
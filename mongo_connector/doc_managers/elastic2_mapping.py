@@ -0,0 +1,164 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inference of Elasticsearch mappings from sample documents.
+
+The inferred mappings are the ones dynamic mapping with the default
+``date_detection`` and ``dynamic_date_formats`` would create for the sample
+documents, so installing them upfront only saves the cluster state updates
+Elasticsearch makes each time a bulk request introduces a new field. Fields
+may still be mapped differently than by dynamic mapping when they are not
+in the sample, when their first value in the sample has another type than
+their first indexed value, or when an index uses other dynamic mapping
+settings.
+"""
+import datetime
+import numbers
+import re
+
+from mongo_connector.compat import is_string
+
+DEFAULT_MAPPING_SAMPLE_SIZE = 100
+"""The default number of documents sampled to infer a mapping."""
+
+
+def string_mapping(major_version):
+    """Get the dynamic mapping of strings in an Elasticsearch version."""
+    if major_version >= 5:
+        return {"type": "text",
+                "fields": {"keyword": {"type": "keyword",
+                                       "ignore_above": 256}}}
+    return {"type": "string"}
+
+
+# The default dynamic_date_formats of Elasticsearch
+_OPTIONAL_TIME_DATE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(T\d{2}(:\d{2}(:\d{2}([.,]\d{1,9})?)?)?(Z|[+-]\d{2}(:?\d{2})?)?)?$')
+_SLASH_DATE = re.compile(
+    r'(\d{4})/(\d{2})/(\d{2})( \d{2}:\d{2}:\d{2})?( [+-]\d{4})?$')
+_SLASH_DATE_FORMAT = "yyyy/MM/dd HH:mm:ss Z||yyyy/MM/dd Z"
+
+
+def _detect_date(value):
+    """Get the mapping date detection gives a string, or None."""
+    # Like Elasticsearch, only try strings with several separators
+    if not any(value.count(sep) > 1 for sep in '-:/'):
+        return None
+    for pattern, mapping in (
+            (_OPTIONAL_TIME_DATE, {"type": "date"}),
+            (_SLASH_DATE, {"type": "date", "format": _SLASH_DATE_FORMAT})):
+        match = pattern.match(value)
+        if match is None:
+            continue
+        try:
+            datetime.date(*[int(part) for part in match.group(1, 2, 3)])
+        except ValueError:
+            continue
+        return mapping
+    return None
+
+
+def _infer_type(value, strings):
+    """Infer the mapping of a formatted value, or None if unknown."""
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, numbers.Integral):
+        return {"type": "long"}
+    if isinstance(value, numbers.Real):
+        return {"type": "double"}
+    if isinstance(value, datetime.datetime):
+        return {"type": "date"}
+    if is_string(value):
+        return _detect_date(value) or dict(strings)
+    if isinstance(value, dict):
+        properties = _infer_properties(value, strings)
+        return {"properties": properties} if properties else None
+    if isinstance(value, list):
+        mapping = None
+        for item in value:
+            mapping = _merge_mapping(mapping, _infer_type(item, strings))
+        return mapping
+    return None
+
+
+def _infer_properties(doc, strings):
+    properties = {}
+    for name, value in doc.items():
+        # Dotted names are not valid field names in Elasticsearch 2.x
+        if '.' in name:
+            continue
+        mapping = _infer_type(value, strings)
+        if mapping is not None:
+            properties[name] = mapping
+    return properties
+
+
+# Marks a field whose sampled values have incompatible types
+_CONFLICT = {"type": None}
+
+
+def _merge_mapping(mapping, other):
+    if mapping is None or mapping == other:
+        return other
+    if other is None:
+        return mapping
+    if mapping is _CONFLICT or other is _CONFLICT:
+        return _CONFLICT
+    if "properties" in mapping and "properties" in other:
+        properties = dict(mapping["properties"])
+        _merge_properties(properties, other["properties"])
+        return {"properties": properties}
+    if set([mapping.get("type"), other.get("type")]) == set(["long",
+                                                              "double"]):
+        return {"type": "double"}
+    return _CONFLICT
+
+
+def _merge_properties(properties, other):
+    for name, mapping in other.items():
+        properties[name] = _merge_mapping(properties.get(name), mapping)
+
+
+def _without_conflicts(properties):
+    result = {}
+    for name, mapping in properties.items():
+        if mapping is _CONFLICT:
+            continue
+        if "properties" in mapping:
+            mapping = {"properties": _without_conflicts(mapping["properties"])}
+        result[name] = mapping
+    return result
+
+
+def infer_mapping(docs, strings=None):
+    """Infer the properties of a mapping from formatted sample documents.
+
+    Fields whose values have incompatible types in the sample, or only
+    values of unknown types, are left out and mapped dynamically. Strings
+    in the default ``dynamic_date_formats`` are mapped as dates, as long
+    as every sampled value of the field is a date in the same format.
+
+    :Parameters:
+      - `docs`: Iterable of documents formatted for Elasticsearch.
+      - `strings`: Mapping of string fields, see `string_mapping`.
+    """
+    if strings is None:
+        strings = string_mapping(5)
+    properties = {}
+    for doc in docs:
+        _merge_properties(properties, _infer_properties(doc, strings))
+    # The _id is a metadata field
+    properties.pop('_id', None)
+    return _without_conflicts(properties)
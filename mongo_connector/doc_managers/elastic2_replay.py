@@ -0,0 +1,426 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Record and replay streams of DocManager operations.
+
+Recordings are gzipped files with one MongoDB Extended JSON record per line:
+``{"t": seconds since the start, "op": method name, "args": [...]}``. They
+are written by the DocManager of this module, which records every call to
+``upsert``, ``update``, ``remove``, ``bulk_upsert`` and ``handle_command``
+before passing it on to the Elasticsearch DocManager. Set ``docManager`` to
+``elastic2_replay`` and the ``recordFile`` option in the mongo-connector
+configuration to record production traffic. Recordings of synthetic
+workloads are made by ``generate_workload``.
+
+``replay`` drives any DocManager with a recording, as fast as possible or at
+the recorded speed, and reports the sustained throughput and the lag between
+an operation and its arrival in Elasticsearch. From the command line::
+
+  python -m mongo_connector.doc_managers.elastic2_replay generate \\
+      workload.gz --count 100000 --updates 0.5 --skew 3
+  python -m mongo_connector.doc_managers.elastic2_replay replay \\
+      workload.gz --url localhost:9200 --speed 1
+"""
+import gzip
+import itertools
+import json
+import logging
+import random
+import string
+import sys
+import threading
+import time
+
+import bson.json_util
+
+from mongo_connector import errors
+from mongo_connector.doc_managers import elastic2_doc_manager
+
+LOG = logging.getLogger(__name__)
+
+RECORDED_OPERATIONS = ('upsert', 'update', 'remove', 'bulk_upsert',
+                       'handle_command')
+"""The DocManager methods which are recorded and replayed."""
+
+BULK_RECORD_SIZE = 1000
+"""The maximum number of documents in one recorded bulk_upsert call."""
+
+LAG_SAMPLE_INTERVAL = 0.5
+"""The interval in seconds at which the replay lag is sampled."""
+
+__version__ = elastic2_doc_manager.__version__
+"""Elasticsearch 2.X recording DocManager version."""
+
+
+class Recorder(object):
+    """Append DocManager calls to a recording file.
+
+    :Parameters:
+      - `path`: Path of the recording, which is overwritten.
+    """
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def record(self, op, *args):
+        # Serialized right away, as DocManagers modify the documents
+        line = bson.json_util.dumps(
+            {'t': time.time() - self._start, 'op': op, 'args': list(args)})
+        with self._lock:
+            self._file.write(line.encode('utf-8') + b'\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_records(path):
+    """Iterate over the records of a recording."""
+    # GzipFile is not a context manager on Python 2.6
+    fd = gzip.open(path, 'rb')
+    try:
+        for line in fd:
+            if line.strip():
+                yield bson.json_util.loads(line.decode('utf-8'))
+    finally:
+        fd.close()
+
+
+def save_records(path, records):
+    """Write records, e.g. from generate_workload, to a recording."""
+    fd = gzip.open(path, 'wb')
+    try:
+        for record in records:
+            fd.write(bson.json_util.dumps(record).encode('utf-8') + b'\n')
+    finally:
+        fd.close()
+
+
+class DocManager(elastic2_doc_manager.DocManager):
+    """Elasticsearch DocManager recording the operations it receives.
+
+    In addition to the options of the Elasticsearch DocManager, requires
+    `recordFile`, the path of the recording.
+    """
+
+    def __init__(self, url, **kwargs):
+        if not kwargs.get('recordFile'):
+            raise errors.InvalidConfiguration(
+                'Elastic recording DocManager requires the "recordFile" '
+                'option')
+        self.recorder = Recorder(kwargs['recordFile'])
+        self._updating = threading.local()
+        super(DocManager, self).__init__(url, **kwargs)
+
+    def upsert(self, doc, namespace, timestamp, update_spec=None):
+        if not getattr(self._updating, 'active', False):
+            self.recorder.record('upsert', doc, namespace, timestamp)
+        return super(DocManager, self).upsert(doc, namespace, timestamp,
+                                              update_spec)
+
+    def update(self, document_id, update_spec, namespace, timestamp):
+        self.recorder.record('update', document_id, update_spec, namespace,
+                             timestamp)
+        # The upsert made by the update itself is not recorded
+        self._updating.active = True
+        try:
+            return super(DocManager, self).update(
+                document_id, update_spec, namespace, timestamp)
+        finally:
+            self._updating.active = False
+
+    def remove(self, document_id, namespace, timestamp):
+        self.recorder.record('remove', document_id, namespace, timestamp)
+        return super(DocManager, self).remove(document_id, namespace,
+                                              timestamp)
+
+    def bulk_upsert(self, docs, namespace, timestamp):
+        docs = iter(docs)
+        while True:
+            chunk = list(itertools.islice(docs, BULK_RECORD_SIZE))
+            if not chunk:
+                break
+            self.recorder.record('bulk_upsert', chunk, namespace, timestamp)
+            super(DocManager, self).bulk_upsert(chunk, namespace, timestamp)
+
+    def handle_command(self, doc, namespace, timestamp):
+        self.recorder.record('handle_command', doc, namespace, timestamp)
+        return super(DocManager, self).handle_command(doc, namespace,
+                                                      timestamp)
+
+    def stop(self):
+        super(DocManager, self).stop()
+        self.recorder.close()
+
+
+def _payloads(rng, size=64 * 1024):
+    """Random text to cut document payloads from."""
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(rng.choice(alphabet) for _ in range(size))
+
+
+def _pick(rng, ids, skew):
+    """Pick an id, the first ones being more likely the higher the skew."""
+    return int(len(ids) * rng.random() ** skew)
+
+
+def generate_workload(count, inserts=0.6, updates=0.3, deletes=0.1,
+                      namespaces=('test.test',), doc_size=512,
+                      doc_size_sigma=0.5, skew=1.0, rate=1000.0, seed=None,
+                      start=None):
+    """Generate the records of a synthetic workload.
+
+    :Parameters:
+      - `count`: Number of operations.
+      - `inserts`, `updates`, `deletes`: Relative frequencies of each kind
+        of operation. Updates and deletes need an existing document, so the
+        first operations are inserts.
+      - `namespaces`: Namespaces the operations are spread over.
+      - `doc_size`: Median size in bytes of the inserted documents.
+      - `doc_size_sigma`: Sigma of the log-normal distribution of the size of
+        the inserted documents, 0 makes them all the same size.
+      - `skew`: Skew of the documents targeted by updates and deletes
+        towards the oldest ones. 1 is uniform, 3 sends about half the
+        operations to the oldest 10% of the documents.
+      - `rate`: Number of operations per second, used for the recorded time
+        of each operation and its oplog timestamp.
+      - `seed`: Seed of the random generator, for repeatable workloads.
+      - `start`: Oplog time in seconds of the first operation, defaults to
+        now.
+    """
+    rng = random.Random(seed)
+    payloads = _payloads(rng)
+    total = float(inserts + updates + deletes)
+    if total <= 0:
+        raise ValueError('The operation mix must not be empty')
+    insert_ratio, update_ratio = inserts / total, (inserts + updates) / total
+    live = dict((namespace, []) for namespace in namespaces)
+    next_id = 0
+    if start is None:
+        start = time.time()
+    start = int(start)
+    for i in range(count):
+        t = i / float(rate)
+        timestamp = ((start + int(t)) << 32) + i % (1 << 32)
+        namespace = rng.choice(namespaces)
+        ids = live[namespace]
+        choice = rng.random()
+        if choice < insert_ratio or not ids:
+            size = max(int(rng.lognormvariate(0, doc_size_sigma) *
+                           doc_size), 1)
+            if size < len(payloads):
+                offset = rng.randrange(len(payloads) - size)
+                payload = payloads[offset:offset + size]
+            else:
+                payload = (payloads * (size // len(payloads) + 1))[:size]
+            doc = {'_id': next_id, 'counter': 0, 'payload': payload}
+            ids.append(next_id)
+            next_id += 1
+            yield {'t': t, 'op': 'upsert', 'args': [doc, namespace, timestamp]}
+        elif choice < update_ratio:
+            doc_id = ids[_pick(rng, ids, skew)]
+            yield {'t': t, 'op': 'update',
+                   'args': [doc_id, {'$set': {'counter': i}}, namespace,
+                            timestamp]}
+        else:
+            index = _pick(rng, ids, skew)
+            doc_id = ids[index]
+            # Keep the older documents first
+            ids.pop(index)
+            yield {'t': t, 'op': 'remove',
+                   'args': [doc_id, namespace, timestamp]}
+
+
+class _LagSampler(threading.Thread):
+    """Thread that measures how long operations take to reach
+    Elasticsearch, from the checkpoint of the DocManager."""
+    def __init__(self, docman, interval=LAG_SAMPLE_INTERVAL):
+        super(_LagSampler, self).__init__()
+        self._docman = docman
+        self._interval = interval
+        self._lock = threading.Lock()
+        # Format: [ (timestamp, time issued) ], in timestamp order
+        self._issued = []
+        self._next = 0
+        self._stopped = False
+        self.lags = []
+        self.daemon = True
+
+    def issued(self, timestamp):
+        with self._lock:
+            self._issued.append((timestamp, time.time()))
+
+    def sample(self):
+        try:
+            last_doc = self._docman.get_last_doc()
+        except Exception:
+            LOG.exception("Could not get the last document")
+            return
+        if not last_doc:
+            return
+        now = time.time()
+        with self._lock:
+            issued_at = None
+            while (self._next < len(self._issued) and
+                   self._issued[self._next][0] <= last_doc['_ts']):
+                issued_at = self._issued[self._next][1]
+                self._next += 1
+        if issued_at is not None:
+            self.lags.append(now - issued_at)
+
+    def drained(self):
+        with self._lock:
+            return self._next >= len(self._issued)
+
+    def join(self, timeout=None):
+        self._stopped = True
+        super(_LagSampler, self).join(timeout=timeout)
+
+    def run(self):
+        while not self._stopped:
+            time.sleep(self._interval)
+            self.sample()
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+def replay(docman, records, speed=None, sample_interval=LAG_SAMPLE_INTERVAL):
+    """Drive a DocManager with recorded operations.
+
+    Operations are replayed as fast as possible, or at `speed` times the
+    recorded speed. Once all of them have been replayed, the DocManager is
+    committed. The lag of an operation is the time from its replay until the
+    checkpoint of the DocManager reaches its timestamp.
+
+    Returns a dict of the number of operations and documents, the seconds
+    spent replaying them and committing, the sustained operations per
+    second, and the mean, 99th percentile and maximum lag in seconds.
+    """
+    sampler = _LagSampler(docman, sample_interval)
+    sampler.start()
+    operations = documents = 0
+    start = time.time()
+    first = None
+    try:
+        for record in records:
+            if speed:
+                if first is None:
+                    first = record['t']
+                delay = start + (record['t'] - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if record['op'] not in RECORDED_OPERATIONS:
+                raise ValueError('Cannot replay %r' % (record['op'],))
+            args = record['args']
+            getattr(docman, record['op'])(*args)
+            operations += 1
+            documents += len(args[0]) if record['op'] == 'bulk_upsert' else 1
+            sampler.issued(args[-1])
+        replayed = time.time()
+        docman.commit()
+        committed = time.time()
+        sampler.sample()
+    finally:
+        sampler.join()
+    seconds = replayed - start
+    return {
+        'operations': operations,
+        'documents': documents,
+        'seconds': seconds,
+        'commit_seconds': committed - replayed,
+        'ops_per_sec': operations / seconds if seconds else None,
+        'lag_mean': (sum(sampler.lags) / len(sampler.lags)
+                     if sampler.lags else None),
+        'lag_p99': _percentile(sampler.lags, 99),
+        'lag_max': max(sampler.lags) if sampler.lags else None,
+        'drained': sampler.drained(),
+    }
+
+
+def _option(value):
+    """Parse a KEY=VALUE DocManager option, VALUE being JSON or a string."""
+    key, _, value = value.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main(argv=None):
+    # argparse needs Python 2.7
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Generate and replay recordings of DocManager '
+                    'operations.')
+    commands = parser.add_subparsers(dest='command')
+
+    generate = commands.add_parser(
+        'generate', help='Write a recording of a synthetic workload.')
+    generate.add_argument('path')
+    generate.add_argument('--count', type=int, default=100000)
+    generate.add_argument('--inserts', type=float, default=0.6)
+    generate.add_argument('--updates', type=float, default=0.3)
+    generate.add_argument('--deletes', type=float, default=0.1)
+    generate.add_argument('--namespace', action='append', dest='namespaces',
+                          help='May be given several times, defaults to '
+                               'test.test.')
+    generate.add_argument('--doc-size', type=int, default=512)
+    generate.add_argument('--doc-size-sigma', type=float, default=0.5)
+    generate.add_argument('--skew', type=float, default=1.0)
+    generate.add_argument('--rate', type=float, default=1000.0)
+    generate.add_argument('--seed', type=int)
+
+    replay_cmd = commands.add_parser(
+        'replay', help='Replay a recording and report the throughput.')
+    replay_cmd.add_argument('path')
+    replay_cmd.add_argument('--url', default='localhost:9200')
+    replay_cmd.add_argument('--doc-manager', default='elastic2_doc_manager',
+                            help='Module in mongo_connector.doc_managers.')
+    replay_cmd.add_argument('--speed', type=float, default=0,
+                            help='Multiple of the recorded speed, 0 replays '
+                                 'as fast as possible.')
+    replay_cmd.add_argument('--option', action='append', type=_option,
+                            default=[], dest='options',
+                            help='DocManager option as KEY=VALUE, VALUE '
+                                 'being parsed as JSON if possible.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        save_records(args.path, generate_workload(
+            args.count, args.inserts, args.updates, args.deletes,
+            tuple(args.namespaces or ['test.test']), args.doc_size,
+            args.doc_size_sigma, args.skew, args.rate, args.seed))
+    elif args.command == 'replay':
+        module = __import__('mongo_connector.doc_managers.' +
+                            args.doc_manager, fromlist=['DocManager'])
+        docman = module.DocManager(args.url, **dict(args.options))
+        try:
+            report = replay(docman, load_records(args.path), args.speed)
+        finally:
+            docman.stop()
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resync of an index into a shadow index swapped in behind an alias.
+
+The shadow index is created with the mappings of the current index and with
+settings suited to bulk loading: no replicas and no periodic refresh. Once
+it holds every document, its settings are restored and the alias named
+after the MongoDB database is moved to it in one request, so readers of the
+alias switch from the old documents to the new ones at once.
+
+Only the mapping types (collections) which were dumped are rebuilt by a
+resync. The documents of the other types of the index are copied from the
+current index into the shadow index before the swap, since the current
+index is deleted.
+"""
+import logging
+import time
+
+from elasticsearch import exceptions as es_exceptions
+
+from mongo_connector import errors
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_IDLE = 60
+"""The default number of seconds without dumped documents after which a
+resync is finished."""
+
+BULK_LOAD_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+"""The settings of a shadow index while documents are dumped into it."""
+
+DEFAULT_RESTORED_SETTINGS = {"number_of_replicas": 1,
+                             "refresh_interval": "1s"}
+"""The settings of a shadow index once the resync is finished, unless the
+index it replaces had other values."""
+
+# Settings of the current index which are kept by the shadow index
+_COPIED_SETTINGS = ('number_of_shards', 'analysis')
+
+# Number of names tried for a shadow index, e.g. when several resyncs of an
+# index start within the same second
+_MAX_SHADOW_ATTEMPTS = 10
+
+
+class Resync(object):
+    """A resync of the index behind an alias into a shadow index.
+
+    :Parameters:
+      - `alias`: The name of the index being resynced.
+      - `shadow`: The name of the shadow index.
+      - `restore`: Settings of the shadow index once the resync is over.
+    """
+    def __init__(self, alias, shadow, restore):
+        self.alias = alias
+        self.shadow = shadow
+        self.restore = restore
+        # Number of bulk_upsert calls writing into the shadow index
+        self.writers = 0
+        self.last_write = time.time()
+        # Mapping types dumped into the shadow index
+        self.doc_types = set()
+        # Documents written by live operations while the other types are
+        # copied into the shadow index, or None
+        # Format: set([(_type, _id, _routing)])
+        self.touched = None
+
+
+def shadow_name(alias, now=None):
+    """Get the name of a new shadow index of an alias."""
+    return '%s-resync-%s' % (alias, time.strftime(
+        '%Y%m%d%H%M%S', time.gmtime(time.time() if now is None else now)))
+
+
+def _current_indices(client, alias):
+    """Get the settings of the indices behind an alias, or of the index
+    named like it."""
+    try:
+        return client.indices.get_settings(index=alias)
+    except es_exceptions.NotFoundError:
+        return {}
+
+
+def create_shadow(client, alias, now=None):
+    """Create a shadow index for an alias, with the mappings of its current
+    index. Returns a Resync."""
+    settings = dict(BULK_LOAD_SETTINGS)
+    restore = dict(DEFAULT_RESTORED_SETTINGS)
+    mappings = {}
+    current = _current_indices(client, alias)
+    if current:
+        for index, mapping in client.indices.get_mapping(
+                index=alias).items():
+            mappings.update(mapping.get('mappings', {}))
+    for index in current:
+        index_settings = current[index]['settings'].get('index', {})
+        for key in _COPIED_SETTINGS:
+            if key in index_settings:
+                settings.setdefault(key, index_settings[key])
+        for key in restore:
+            if key in index_settings:
+                restore[key] = index_settings[key]
+    body = {"settings": {"index": settings}}
+    if mappings:
+        body["mappings"] = mappings
+    if now is None:
+        now = time.time()
+    for attempt in range(_MAX_SHADOW_ATTEMPTS):
+        shadow = shadow_name(alias, now + attempt)
+        try:
+            client.indices.create(index=shadow, body=body)
+        except es_exceptions.RequestError:
+            if attempt == _MAX_SHADOW_ATTEMPTS - 1:
+                raise
+            LOG.debug("Shadow index %s already exists", shadow)
+            continue
+        return Resync(alias, shadow, restore)
+
+
+def untouched_types(client, resync):
+    """Get the mapping types of the current index of an alias which were
+    not dumped into its shadow index."""
+    if not _current_indices(client, resync.alias):
+        return []
+    doc_types = set()
+    for mapping in client.indices.get_mapping(index=resync.alias).values():
+        doc_types.update(mapping.get('mappings', {}))
+    doc_types.discard('_default_')
+    return sorted(doc_types - resync.doc_types)
+
+
+def swap_alias(client, resync):
+    """Restore the settings of a shadow index and move the alias to it.
+
+    The indices previously behind the alias are deleted. An alias cannot
+    have the name of an index, so when the alias replaces an index of the
+    same name, that index is removed by the request adding the alias.
+    """
+    client.indices.put_settings(index=resync.shadow,
+                                body={"index": resync.restore})
+    client.indices.refresh(index=resync.shadow)
+    old = [index for index in _current_indices(client, resync.alias)
+           if index != resync.shadow]
+    actions = [{"remove": {"index": index, "alias": resync.alias}}
+               for index in old if index != resync.alias]
+    actions.append({"add": {"index": resync.shadow, "alias": resync.alias}})
+    if resync.alias in old:
+        LOG.warning("Deleting index %s to replace it with an alias to %s",
+                    resync.alias, resync.shadow)
+        actions.append({"remove_index": {"index": resync.alias}})
+    try:
+        client.indices.update_aliases(body={"actions": actions})
+    except es_exceptions.RequestError as exc:
+        if resync.alias not in old:
+            raise
+        # Nothing was changed, the index is kept
+        raise errors.OperationFailed(
+            "Could not replace index %s with an alias to %s in one request, "
+            "Elasticsearch may not support the remove_index alias action. "
+            "Move the documents of %s to an index behind an alias of that "
+            "name before resyncing it: %s" % (
+                resync.alias, resync.shadow, resync.alias, exc))
+    for index in old:
+        if index != resync.alias:
+            client.indices.delete(index=index)
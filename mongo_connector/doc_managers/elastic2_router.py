@@ -0,0 +1,200 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shard-aware routing of bulk actions for the Elasticsearch DocManager.
+
+Elasticsearch assigns a document to the shard given by the murmur3 hash of
+its routing value (its _id by default) modulo the number of primary shards.
+The router computes the same shard from a cached copy of the cluster's
+routing table and groups bulk actions by the node holding the primary shard,
+so that each group can be sent directly to that node.
+"""
+import logging
+import struct
+import threading
+import time
+
+from elasticsearch import Elasticsearch, exceptions as es_exceptions
+
+from mongo_connector.compat import u
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 60
+"""The default interval in seconds to refresh the cached routing table."""
+
+_MASK = 0xffffffff
+_BLOCK = struct.Struct('<I')
+
+# Indices with these settings do not route by hash modulo number of shards
+_UNSUPPORTED_SETTINGS = ('index.routing_partition_size',
+                         'index.shrink.source.name',
+                         'index.number_of_routing_shards')
+
+
+def _rotl(value, bits):
+    return ((value << bits) | (value >> (32 - bits))) & _MASK
+
+
+def murmur3_hash(routing):
+    """Hash a routing value like Elasticsearch's Murmur3HashFunction.
+
+    The string is hashed as its UTF-16 code units in little-endian order,
+    with murmur3_x86_32 and a seed of 0. Returns a signed 32 bit integer.
+    """
+    data = bytearray(u(routing).encode('utf-16-le'))
+    length = len(data)
+    h = 0
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    end = length - length % 4
+    for offset in range(0, end, 4):
+        k, = _BLOCK.unpack_from(bytes(data[offset:offset + 4]))
+        k = (_rotl((k * c1) & _MASK, 15) * c2) & _MASK
+        h = _rotl(h ^ k, 13)
+        h = (h * 5 + 0xe6546b64) & _MASK
+    k = 0
+    tail = length % 4
+    if tail >= 3:
+        k ^= data[end + 2] << 16
+    if tail >= 2:
+        k ^= data[end + 1] << 8
+    if tail >= 1:
+        k ^= data[end]
+        h ^= (_rotl((k * c1) & _MASK, 15) * c2) & _MASK
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & _MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & _MASK
+    h ^= h >> 16
+    return h - (1 << 32) if h & 0x80000000 else h
+
+
+def shard_id(routing, number_of_shards):
+    """Get the shard of a routing value in an index."""
+    # Python's modulo of a negative hash matches Java's Math.floorMod
+    return murmur3_hash(routing) % number_of_shards
+
+
+class ShardRouter(object):
+    """Group bulk actions by the node holding their primary shard.
+
+    :Parameters:
+      - `client`: The Elasticsearch client used to read the routing table,
+        and to send actions which cannot be routed.
+      - `client_options`: Options of the clients created for each node.
+      - `refresh_interval`: Number of seconds the routing table is cached.
+    """
+    def __init__(self, client, client_options=None,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.client = client
+        self.client_options = client_options or {}
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # Format: {"_index": [ node id of the primary of each shard ] or None}
+        self._primaries = {}
+        # Format: {node id: Elasticsearch}
+        self._clients = {}
+        self._refreshed_at = 0
+
+    def invalidate(self):
+        """Forget the routing table, e.g. after a node failed."""
+        with self._lock:
+            self._primaries = {}
+            self._refreshed_at = 0
+
+    def _load_primaries(self, index):
+        """Read the primary shards of an index from the cluster state."""
+        settings = self.client.indices.get_settings(
+            index=index, flat_settings=True)
+        if index not in settings:
+            # An alias or a pattern rather than a concrete index
+            return None
+        index_settings = settings[index]['settings']
+        if any(name in index_settings for name in _UNSUPPORTED_SETTINGS):
+            return None
+        state = self.client.cluster.state(metric='routing_table',
+                                          index=index)
+        shards = state['routing_table']['indices'][index]['shards']
+        primaries = [None] * len(shards)
+        for number, copies in shards.items():
+            for copy in copies:
+                if copy['primary'] and copy['state'] == 'STARTED':
+                    primaries[int(number)] = copy['node']
+        return primaries
+
+    def _primaries_of(self, index):
+        if time.time() - self._refreshed_at > self.refresh_interval:
+            self._primaries = {}
+            self._refreshed_at = time.time()
+        if index not in self._primaries:
+            try:
+                self._primaries[index] = self._load_primaries(index)
+            except es_exceptions.NotFoundError:
+                # The index will be created by the bulk request
+                self._primaries[index] = None
+        return self._primaries[index]
+
+    def node_for(self, action):
+        """Get the id of the node holding the primary shard of an action,
+        or None if it is not known."""
+        primaries = self._primaries_of(action['_index'])
+        if not primaries:
+            return None
+        routing = (action.get('_routing') or action.get('_parent') or
+                   action['_id'])
+        return primaries[shard_id(routing, len(primaries))]
+
+    def _client_for(self, node):
+        if node is None:
+            return self.client
+        if node not in self._clients:
+            info = self.client.nodes.info(node_id=node, metric='http')
+            address = info['nodes'].get(node, {}).get(
+                'http', {}).get('publish_address')
+            if address is None:
+                LOG.warning("Node %s has no HTTP address, its shards are "
+                            "routed by the cluster", node)
+                self._clients[node] = self.client
+            else:
+                self._clients[node] = Elasticsearch(
+                    hosts=[address], **self.client_options)
+        return self._clients[node]
+
+    def group(self, actions):
+        """Group actions by the node holding their primary shard.
+
+        The order of the actions is kept within each group, so actions on
+        the same document are still applied in order. `actions` must be a
+        list, it is sent as a whole if the routing table cannot be read.
+        Returns a list of tuples of an Elasticsearch client and a list of
+        actions.
+        """
+        groups = {}
+        nodes = []
+        with self._lock:
+            try:
+                for action in actions:
+                    node = self.node_for(action)
+                    if node not in groups:
+                        groups[node] = []
+                        nodes.append(node)
+                    groups[node].append(action)
+                return [(self._client_for(node), groups[node])
+                        for node in nodes]
+            except es_exceptions.TransportError as exc:
+                LOG.warning("Could not read the routing table, letting the "
+                            "cluster route bulk actions: %s", exc)
+                self._primaries = {}
+                return [(self.client, list(actions))]
@@ -0,0 +1,105 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared indices holding the documents of many small namespaces.
+
+Each MongoDB database normally gets its own index. Namespaces matching the
+patterns of a shared index are written to that index instead, with the
+collection as mapping type. The namespace of each document is stored in a
+field, and the _id of a document is prefixed with its database, so that
+documents of collections with the same name in different databases do not
+collide. Every namespace gets a filtered alias named after it, e.g.
+``tenant_1.users``, to search its documents only.
+"""
+import fnmatch
+
+from mongo_connector.compat import is_string
+
+DEFAULT_NAMESPACE_FIELD = "mongodb_ns"
+"""The default field storing the namespace of documents in shared indices."""
+
+
+def namespace_mapping(major_version):
+    """Get the mapping of the namespace field in an Elasticsearch version."""
+    if major_version >= 5:
+        return {"type": "keyword"}
+    return {"type": "string", "index": "not_analyzed"}
+
+
+class SharedIndices(object):
+    """Map namespaces to the shared indices holding their documents.
+
+    :Parameters:
+      - `config`: Dict of the name of each shared index to a list of
+        namespace patterns, like ``"tenant_*.*"`` or ``"db.collection"``.
+        The first index with a matching pattern is used.
+      - `field`: The field storing the namespace of the documents.
+    """
+    def __init__(self, config, field=DEFAULT_NAMESPACE_FIELD):
+        if not isinstance(config, dict):
+            raise ValueError('shared indices must be a dict of index names '
+                             'to lists of namespace patterns')
+        self.field = field
+        # Format: [(index, pattern)]
+        self._patterns = []
+        for index in sorted(config):
+            patterns = config[index]
+            if is_string(patterns):
+                patterns = [patterns]
+            if index != index.lower():
+                raise ValueError('shared index name "%s" must be lowercase'
+                                 % index)
+            for pattern in patterns:
+                if '.' not in pattern:
+                    raise ValueError('namespace pattern "%s" must be of the '
+                                     'form "database.collection"' % pattern)
+                self._patterns.append((index, pattern))
+        self.names = sorted(config)
+        # Format: {namespace: index or None}
+        self._cache = {}
+
+    def index(self, namespace):
+        """Get the shared index of a namespace, or None."""
+        try:
+            return self._cache[namespace]
+        except KeyError:
+            pass
+        for index, pattern in self._patterns:
+            if fnmatch.fnmatchcase(namespace, pattern):
+                break
+        else:
+            index = None
+        self._cache[namespace] = index
+        return index
+
+    def document_id(self, namespace, doc_id):
+        """Get the _id of a document in its shared index."""
+        return '%s.%s' % (namespace.split('.', 1)[0], doc_id)
+
+    def original_id(self, doc_id):
+        """Get the MongoDB _id of a document from its shared index _id."""
+        return doc_id.split('.', 1)[1]
+
+    def alias(self, namespace):
+        """Get the name and body of the filtered alias of a namespace."""
+        return namespace.lower(), {
+            "filter": {"term": {self.field: namespace}}}
+
+    def database_query(self, db):
+        """Get the query matching the documents of a database."""
+        return {"query": {"prefix": {self.field: '%s.' % db}}}
+
+    def namespace_query(self, namespace):
+        """Get the query matching the documents of a namespace."""
+        return {"query": {"term": {self.field: namespace}}}
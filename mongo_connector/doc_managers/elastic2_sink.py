@@ -0,0 +1,344 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline NDJSON file sink of the bulk requests of the DocManager.
+
+With the ``sinkDirectory`` option, the DocManager writes the bodies of the
+bulk requests it would have sent to files on local disk instead of
+Elasticsearch. The files are named ``bulk-<number>.ndjson``, or
+``bulk-<number>.ndjson.gz`` with ``sinkCompressLevel``, and are rotated once
+they hold ``sinkFileSize`` bytes. A file is only given its final name once
+it is complete, until then it ends with ``.part``. Mappings put by the
+DocManager are appended to ``mappings.ndjson``.
+
+The sink cannot retrieve documents, so an update of a document which is
+not in the buffer is written as a partial ``update`` action: fields
+removed by ``$unset`` are set to null, objects set by ``$set`` are merged
+into the stored objects, and updates of array elements are rejected with
+OperationFailed. Partial updates are not externally versioned.
+
+``load`` pushes the files into Elasticsearch later, with concurrent bulk
+requests. The actions on a document always go to the same request queue,
+so they are applied in the order they were written. From the command
+line::
+
+  python -m mongo_connector.doc_managers.elastic2_sink load /data/sink \\
+      --url localhost:9200 --concurrency 8
+
+The sink also measures the connector side alone, e.g. by replaying a
+recording with ``elastic2_replay replay --option sinkDirectory=...``.
+"""
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from mongo_connector.constants import DEFAULT_MAX_BULK
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_FILE_SIZE = 256 * 1024 * 1024
+"""The default number of bytes written to a sink file before it is
+rotated."""
+
+DEFAULT_LOAD_CONCURRENCY = 8
+"""The default number of concurrent bulk requests of the loader."""
+
+MAPPINGS_FILE = 'mappings.ndjson'
+"""The file of the mappings put by the DocManager, one per line."""
+
+_FILE_NAME = 'bulk-%020d.ndjson'
+_FILE_RE = re.compile(r'^bulk-(\d{20})\.ndjson(\.gz)?$')
+_PART_SUFFIX = '.part'
+
+
+def sink_files(directory):
+    """List the paths of the complete sink files, in the order they were
+    written."""
+    names = sorted((int(match.group(1)), match.group(0))
+                   for match in map(_FILE_RE.match, os.listdir(directory))
+                   if match)
+    return [os.path.join(directory, name) for _, name in names]
+
+
+def _open(path, mode, compress_level=0):
+    # GzipFile is not a context manager on Python 2.6
+    if compress_level or path.endswith('.gz'):
+        return gzip.open(path, mode, compress_level or 9)
+    return open(path, mode)
+
+
+class Sink(object):
+    """Rotated NDJSON files receiving the bodies of bulk requests.
+
+    :Parameters:
+      - `directory`: Directory of the files. It is created if it does not
+        exist.
+      - `file_size`: Number of uncompressed bytes written to a file before
+        the next one is started.
+      - `compress_level`: gzip compression level of the files, 0 disables
+        compression.
+    """
+    def __init__(self, directory, file_size=DEFAULT_FILE_SIZE,
+                 compress_level=0):
+        self.directory = directory
+        self.file_size = file_size
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.endswith(_PART_SUFFIX):
+                LOG.warning("Ignoring incomplete sink file %s",
+                            os.path.join(directory, name))
+        existing = [int(_FILE_RE.match(os.path.basename(path)).group(1))
+                    for path in sink_files(directory)]
+        self._number = max(existing) + 1 if existing else 0
+        self._file = None
+        self._path = None
+        self._written = 0
+        self._stats = {'files': 0, 'bytes': 0, 'requests': 0}
+
+    def _name(self, number):
+        name = _FILE_NAME % number
+        if self.compress_level:
+            name += '.gz'
+        return os.path.join(self.directory, name)
+
+    def _finish(self):
+        """Close the current file and give it its final name."""
+        if self._file is None:
+            return
+        self._file.close()
+        os.rename(self._path + _PART_SUFFIX, self._path)
+        self._file = None
+        self._stats['files'] += 1
+
+    def write(self, body):
+        """Append the body of a bulk request, given as bytes."""
+        with self.lock:
+            if self._file is None:
+                self._path = self._name(self._number)
+                self._number += 1
+                self._file = _open(self._path + _PART_SUFFIX, 'wb',
+                                   self.compress_level)
+                self._written = 0
+            self._file.write(body)
+            self._written += len(body)
+            self._stats['bytes'] += len(body)
+            self._stats['requests'] += 1
+            if self._written >= self.file_size:
+                self._finish()
+
+    def write_mapping(self, index, doc_type, body):
+        """Append a mapping to put before the files are loaded."""
+        line = json.dumps({'index': index, 'type': doc_type, 'body': body})
+        with self.lock:
+            with open(os.path.join(self.directory, MAPPINGS_FILE), 'a') as fd:
+                fd.write(line + '\n')
+
+    def stats(self):
+        """Get the number of complete files, and the bytes and bulk request
+        bodies written."""
+        with self.lock:
+            return dict(self._stats)
+
+    def close(self):
+        with self.lock:
+            self._finish()
+
+
+def _read_actions(path):
+    """Iterate over the (key, lines) of the actions of a sink file.
+
+    The key identifies the document of an action, and the lines are the
+    action line, followed by the source line unless it is a delete.
+    """
+    fd = _open(path, 'rb')
+    try:
+        lines = iter(fd)
+        for line in lines:
+            if not line.strip():
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            (op_type, meta), = json.loads(line.decode('utf-8')).items()
+            key = '%s/%s/%s' % (meta.get('_index'), meta.get('_type'),
+                                meta.get('_id'))
+            if op_type == 'delete':
+                yield key, [line]
+            else:
+                source = next(lines)
+                if not source.endswith(b'\n'):
+                    source += b'\n'
+                yield key, [line, source]
+    finally:
+        fd.close()
+
+
+def put_mappings(client, directory):
+    """Put the mappings recorded in a sink directory."""
+    path = os.path.join(directory, MAPPINGS_FILE)
+    if not os.path.exists(path):
+        return 0
+    count = 0
+    with open(path) as fd:
+        for line in fd:
+            if line.strip():
+                mapping = json.loads(line)
+                client.indices.create(index=mapping['index'], ignore=400)
+                client.indices.put_mapping(index=mapping['index'],
+                                           doc_type=mapping['type'],
+                                           body=mapping['body'])
+                count += 1
+    return count
+
+
+class _Sender(threading.Thread):
+    """Thread sending the bulk requests of one queue in order."""
+
+    def __init__(self, client, requests):
+        super(_Sender, self).__init__()
+        self._client = client
+        self._requests = requests
+        self.failures = []
+        self.error = None
+        self.sent = 0
+        self.daemon = True
+
+    def run(self):
+        # Imported here, the DocManager imports this module
+        from mongo_connector.doc_managers.elastic2_doc_manager import (
+            BULK_FILTER_PATH, bulk_failures)
+        while True:
+            body = self._requests.get()
+            if body is None:
+                return
+            if self.error is not None:
+                # Later requests could depend on the failed one
+                continue
+            try:
+                resp = self._client.bulk(body, filter_path=BULK_FILTER_PATH)
+            except Exception as exc:
+                LOG.exception("Could not load a bulk request")
+                self.error = exc
+                continue
+            self.failures.extend(bulk_failures(resp))
+            self.sent += 1
+
+
+def load(client, directory, concurrency=DEFAULT_LOAD_CONCURRENCY,
+         chunk_size=DEFAULT_MAX_BULK):
+    """Load the files of a sink directory into Elasticsearch.
+
+    The mappings are put first. The actions are then split into
+    `concurrency` queues by document, and each queue sends bulk requests of
+    at most `chunk_size` actions, one at a time.
+
+    Returns a dict of the number of files, actions, bulk requests and
+    failed actions, the seconds spent and the actions loaded per second.
+    Raises the first exception of a bulk request once every queue is done.
+    """
+    concurrency = max(concurrency, 1)
+    chunk_size = max(chunk_size, 1)
+    start = time.time()
+    mappings = put_mappings(client, directory)
+    queues = [queue.Queue(maxsize=2) for _ in range(concurrency)]
+    senders = [_Sender(client, requests) for requests in queues]
+    for sender in senders:
+        sender.start()
+    # Format: [[lines, number of actions]] for each queue
+    pending = [[[], 0] for _ in range(concurrency)]
+    files = actions = 0
+    try:
+        for path in sink_files(directory):
+            files += 1
+            for key, lines in _read_actions(path):
+                lane = (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % \
+                    concurrency
+                chunk = pending[lane]
+                chunk[0].extend(lines)
+                chunk[1] += 1
+                actions += 1
+                if chunk[1] >= chunk_size:
+                    queues[lane].put(b''.join(chunk[0]))
+                    pending[lane] = [[], 0]
+        for lane, chunk in enumerate(pending):
+            if chunk[1]:
+                queues[lane].put(b''.join(chunk[0]))
+    finally:
+        for requests in queues:
+            requests.put(None)
+        for sender in senders:
+            sender.join()
+    seconds = time.time() - start
+    failures = [failure for sender in senders for failure in sender.failures]
+    for failure in failures:
+        LOG.error("Could not load document into Elasticsearch: %r", failure)
+    for sender in senders:
+        if sender.error is not None:
+            raise sender.error
+    return {
+        'files': files,
+        'mappings': mappings,
+        'actions': actions,
+        'requests': sum(sender.sent for sender in senders),
+        'failures': len(failures),
+        'seconds': seconds,
+        'actions_per_sec': actions / seconds if seconds else None,
+    }
+
+
+def main(argv=None):
+    # argparse needs Python 2.7
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Load the files written by the DocManager sink into '
+                    'Elasticsearch.')
+    commands = parser.add_subparsers(dest='command')
+    load_cmd = commands.add_parser(
+        'load', help='Load a sink directory and report the throughput.')
+    load_cmd.add_argument('directory')
+    load_cmd.add_argument('--url', action='append', dest='urls',
+                          help='May be given several times, defaults to '
+                               'localhost:9200.')
+    load_cmd.add_argument('--concurrency', type=int,
+                          default=DEFAULT_LOAD_CONCURRENCY)
+    load_cmd.add_argument('--chunk-size', type=int, default=DEFAULT_MAX_BULK,
+                          help='Maximum number of actions per request.')
+
+    args = parser.parse_args(argv)
+    if args.command != 'load':
+        parser.print_help()
+        return 2
+    from elasticsearch import Elasticsearch
+    client = Elasticsearch(hosts=args.urls or ['localhost:9200'],
+                           maxsize=max(args.concurrency, 1))
+    report = load(client, args.directory, args.concurrency, args.chunk_size)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Durable on-disk spool of bulk requests for the Elasticsearch DocManager.
+
+The spool is an append-only log split into fixed size, memory-mapped segment
+files. Each record is a 4 byte big-endian length followed by the payload. The
+length is written after the payload, so a zero length always marks the end of
+the written part of a segment, even after a crash. The position of the oldest
+record which has not been replayed yet is kept in a separate cursor file.
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+"""The default size in bytes of a spool segment file."""
+
+_HEADER = struct.Struct('>I')
+_SEGMENT_NAME = 'segment-%020d.spool'
+_SEGMENT_RE = re.compile(r'^segment-(\d{20})\.spool$')
+_CURSOR_NAME = 'cursor'
+
+
+class Spool(object):
+    """Append-only, segment-rotated log of records on local disk.
+
+    :Parameters:
+      - `directory`: Directory holding the segment and cursor files. It is
+        created if it does not exist.
+      - `segment_size`: Size in bytes of each segment file. Records larger
+        than a segment get a segment of their own.
+    """
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        segments = self._segments()
+        self._read_segment, self._read_offset = self._load_cursor(segments)
+        self._read_map = None
+        self._read_map_segment = None
+
+        self._segment = segments[-1] if segments else 0
+        self._file, self._map = self._open_segment(self._segment)
+        self._offset = self._end_of(self._map)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, _SEGMENT_NAME % segment)
+
+    def _segments(self):
+        """List the numbers of the existing segment files."""
+        return sorted(int(match.group(1))
+                      for match in map(_SEGMENT_RE.match,
+                                       os.listdir(self.directory))
+                      if match)
+
+    def _load_cursor(self, segments):
+        try:
+            with open(os.path.join(self.directory, _CURSOR_NAME)) as fd:
+                segment, offset = fd.read().split()
+            return int(segment), int(offset)
+        except (IOError, OSError, ValueError):
+            return (segments[0] if segments else 0), 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, _CURSOR_NAME)
+        with open(path + '.tmp', 'w') as fd:
+            fd.write('%d %d' % (self._read_segment, self._read_offset))
+            fd.flush()
+            os.fsync(fd.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _open_segment(self, segment, size=None):
+        """Open a segment for writing, preallocating new ones."""
+        path = self._path(segment)
+        fd = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        fd.seek(0, os.SEEK_END)
+        if fd.tell() == 0:
+            fd.truncate(size or self.segment_size)
+        fd.seek(0, os.SEEK_END)
+        return fd, mmap.mmap(fd.fileno(), fd.tell())
+
+    @staticmethod
+    def _end_of(segment_map, offset=0):
+        """Find the offset right after the last record in a segment."""
+        while offset + _HEADER.size <= len(segment_map):
+            length, = _HEADER.unpack_from(segment_map, offset)
+            if not length:
+                break
+            offset += _HEADER.size + length
+        return offset
+
+    def _rotate(self, min_size):
+        self._map.close()
+        self._file.close()
+        self._segment += 1
+        self._file, self._map = self._open_segment(
+            self._segment, max(self.segment_size, min_size))
+        self._offset = 0
+
+    def append(self, record):
+        """Durably append a record given as bytes."""
+        with self.lock:
+            needed = _HEADER.size + len(record)
+            # Keep room for the terminating zero length
+            if self._offset + needed + _HEADER.size > len(self._map):
+                self._rotate(needed + _HEADER.size)
+            start = self._offset + _HEADER.size
+            self._map[start:start + len(record)] = record
+            _HEADER.pack_into(self._map, self._offset, len(record))
+            self._map.flush()
+            self._offset += needed
+
+    def pending(self):
+        """Return True if there are records which have not been consumed."""
+        return (self._read_segment, self._read_offset) < (self._segment,
+                                                           self._offset)
+
+    def _map_for_read(self, segment):
+        if segment == self._segment:
+            return self._map
+        if self._read_map_segment != segment:
+            self._close_read_map()
+            with open(self._path(segment), 'rb') as fd:
+                self._read_map = mmap.mmap(fd.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            self._read_map_segment = segment
+        return self._read_map
+
+    def _close_read_map(self):
+        if self._read_map is not None:
+            self._read_map.close()
+            self._read_map = None
+            self._read_map_segment = None
+
+    def peek(self):
+        """Get the oldest record which has not been consumed, or None."""
+        with self.lock:
+            while self.pending():
+                segment_map = self._map_for_read(self._read_segment)
+                if self._read_offset + _HEADER.size <= len(segment_map):
+                    length, = _HEADER.unpack_from(segment_map,
+                                                  self._read_offset)
+                    if length:
+                        start = self._read_offset + _HEADER.size
+                        return segment_map[start:start + length]
+                # End of a segment which has been completely consumed
+                self._next_segment()
+            return None
+
+    def consume(self):
+        """Mark the record returned by the last peek as replayed."""
+        with self.lock:
+            segment_map = self._map_for_read(self._read_segment)
+            length, = _HEADER.unpack_from(segment_map, self._read_offset)
+            self._read_offset += _HEADER.size + length
+            if (self._read_segment < self._segment and
+                    self._end_of(segment_map, self._read_offset) ==
+                    self._read_offset):
+                self._next_segment()
+            self._save_cursor()
+
+    def _next_segment(self):
+        """Move the cursor to the next segment and drop the consumed one."""
+        self._close_read_map()
+        consumed = self._read_segment
+        self._read_segment += 1
+        self._read_offset = 0
+        self._save_cursor()
+        try:
+            os.remove(self._path(consumed))
+        except OSError:
+            LOG.warning("Could not remove replayed spool segment %s",
+                        self._path(consumed))
+
+    def close(self):
+        with self.lock:
+            self._close_read_map()
+            self._map.close()
+            self._file.close()
@@ -41,9 +41,10 @@ setup(name='elastic2-doc-manager',
       url='https://github.com/mongodb-labs/elastic2-doc-manager',
       install_requires=['mongo-connector>=2.5.0'],
       extras_require={
-          'aws': ['boto3 >= 1.4.0', 'requests-aws-sign >= 0.1.2'],
+          'aws': ['boto3 >= 1.4.0', 'requests >= 2.5.1'],
           'elastic2': ['elasticsearch>=2.0.0,<3.0.0'],
-          'elastic5': ['elasticsearch>=5.0.0,<6.0.0']
+          'elastic5': ['elasticsearch>=5.0.0,<6.0.0'],
+          'async': ['elasticsearch-async>=5.0.0,<6.0.0']
       },
       packages=["mongo_connector", "mongo_connector.doc_managers"],
       license="Apache License, Version 2.0",
@@ -0,0 +1,189 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory stand-ins for Elasticsearch used by the unit tests of the
+Elastic2 DocManager, which run without a cluster."""
+import fnmatch
+import json
+import threading
+
+from elasticsearch.serializer import JSONSerializer
+
+from mongo_connector.doc_managers.elastic2_doc_manager import DocManager
+
+
+class FakeIndices(object):
+    def __init__(self):
+        self.refreshes = 0
+
+    def refresh(self, index=None):
+        self.refreshes += 1
+
+    def create(self, index, ignore=None):
+        pass
+
+    def put_mapping(self, index, doc_type, body):
+        pass
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+def _merge(source, doc):
+    """Merge a partial document into a source, like an update request."""
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(source.get(key), dict):
+            _merge(source[key], value)
+        else:
+            source[key] = value
+
+
+class FakeElasticsearch(object):
+    """In-memory stand-in for the Elasticsearch client.
+
+    Documents are stored by (_index, _type, _id), and the number of bulk
+    actions received for each document is counted.
+    """
+
+    def __init__(self, meta_index_name):
+        self.meta_index_name = meta_index_name
+        self.indices = FakeIndices()
+        self.transport = FakeTransport()
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.writes = {}
+        self.requests = 0
+
+    def bulk(self, body, filter_path=None):
+        lines = iter(body.splitlines())
+        with self.lock:
+            self.requests += 1
+            for line in lines:
+                (op_type, meta), = json.loads(line).items()
+                key = (meta['_index'], meta['_type'], meta['_id'])
+                source = None if op_type == 'delete' else json.loads(
+                    next(lines))
+                if meta['_index'] == self.meta_index_name:
+                    continue
+                self.writes[key] = self.writes.get(key, 0) + 1
+                if source is None:
+                    self.docs.pop(key, None)
+                elif op_type == 'update':
+                    _merge(self.docs[key], source['doc'])
+                else:
+                    self.docs[key] = source
+        return {'errors': False}
+
+    def mget(self, body, realtime=True):
+        with self.lock:
+            docs = []
+            for doc in body['docs']:
+                key = (doc['_index'], doc['_type'], doc['_id'])
+                if key in self.docs:
+                    docs.append(dict(doc, found=True,
+                                     _source=dict(self.docs[key])))
+                else:
+                    docs.append(dict(doc, found=False))
+            return {'docs': docs}
+
+    def index(self, **kwargs):
+        # Only used for the checkpoint
+        pass
+
+
+class FakeSharedIndices(FakeIndices):
+    """Stand-in for the indices client, recording mappings and aliases."""
+
+    def __init__(self):
+        super(FakeSharedIndices, self).__init__()
+        # Format: {(index, doc_type): {"properties": ...}}
+        self.mappings = {}
+        # Format: {alias: (index, body)}
+        self.aliases = {}
+
+    def refresh(self, index=None, ignore_unavailable=False):
+        self.refreshes += 1
+
+    def put_mapping(self, index, doc_type, body):
+        mapping = self.mappings.setdefault((index, doc_type), {})
+        mapping.setdefault('properties', {}).update(
+            body.get('properties', {}))
+
+    def put_alias(self, index, name, body):
+        self.aliases[name] = (index, body)
+
+    def delete_alias(self, index, name, ignore=None):
+        for alias in fnmatch.filter(list(self.aliases), name):
+            del self.aliases[alias]
+
+    def delete(self, index, ignore=None):
+        pass
+
+
+def _matches(query, source):
+    """Evaluate the term and prefix queries used by the DocManager."""
+    if not query or 'query' not in query:
+        return True
+    (kind, spec), = query['query'].items()
+    (field, value), = spec.items()
+    if kind == 'term':
+        return source.get(field) == value
+    return source.get(field, '').startswith(value)
+
+
+class FakeSearchElasticsearch(FakeElasticsearch):
+    """Stand-in for Elasticsearch which can also be scanned."""
+
+    def __init__(self, meta_index_name):
+        super(FakeSearchElasticsearch, self).__init__(meta_index_name)
+        self.indices = FakeSharedIndices()
+
+    def info(self):
+        return {'version': {'number': '5.6.0'}}
+
+    def search(self, index, body=None, doc_type=None, **kwargs):
+        if not isinstance(index, list):
+            index = [index]
+        hits = [{'_index': key[0], '_type': key[1], '_id': key[2],
+                 '_source': source}
+                for key, source in sorted(self.docs.items())
+                if key[0] in index and doc_type in (None, key[1]) and
+                _matches(body, source)]
+        return {'_scroll_id': 'scroll', 'hits': {'hits': hits},
+                '_shards': {'successful': 1, 'total': 1}}
+
+    def scroll(self, scroll_id, **kwargs):
+        return {'_scroll_id': scroll_id, 'hits': {'hits': []},
+                '_shards': {'successful': 1, 'total': 1}}
+
+    def clear_scroll(self, **kwargs):
+        pass
+
+
+def fake_doc_manager(elastic_class=FakeElasticsearch,
+                     doc_manager_class=DocManager, **kwargs):
+    """Create a DocManager which sends its requests to a new instance of
+    elastic_class, and which only sends buffered operations when asked to.
+
+    Options are passed to the DocManager. The stand-in is created with the
+    name of the meta index, and is both the live and the dump client.
+    """
+    options = dict(auto_commit_interval=None, autoSendInterval=0,
+                   lagLogInterval=0)
+    options.update(kwargs)
+    docman = doc_manager_class('localhost:9200', **options)
+    docman.elastic = docman.dump_elastic = elastic_class(
+        docman.meta_index_name)
+    return docman
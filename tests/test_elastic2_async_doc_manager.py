@@ -0,0 +1,130 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the Elastic2 asyncio DocManager."""
+import json
+import sys
+
+from elasticsearch.serializer import JSONSerializer
+
+sys.path[0:0] = [""]
+
+from mongo_connector.test_utils import TESTARGS
+
+from tests import unittest, elastic_pair
+from tests.test_elastic2 import ElasticsearchTestCase
+from tests.fakes import fake_doc_manager
+
+try:
+    import asyncio
+    from mongo_connector.doc_managers.elastic2_async_doc_manager import (
+        DocManager)
+    _HAS_ASYNC = True
+except (ImportError, SyntaxError):
+    _HAS_ASYNC = False
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+    def close(self):
+        pass
+
+
+class FakeAsyncElasticsearch(object):
+    """Stand-in for the asyncio client, answering bulk requests in the
+    reverse order they were sent."""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.bodies = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def bulk(self, body, filter_path=None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        def done():
+            self.in_flight -= 1
+            self.bodies.append(body)
+            future.set_result({'errors': False})
+        loop.call_later(0.05 / self.in_flight, done)
+        return future
+
+
+@unittest.skipUnless(_HAS_ASYNC, 'Cannot test without elasticsearch-async')
+class TestElasticAsyncDocManager(ElasticsearchTestCase):
+    """Unit tests for the Elastic asyncio DocManager."""
+
+    def setUp(self):
+        super(TestElasticAsyncDocManager, self).setUp()
+        self.elastic_doc.stop()
+        self.elastic_doc = DocManager(elastic_pair, auto_commit_interval=None,
+                                      chunk_size=10, bulkConcurrency=3)
+
+    def test_upsert_and_update(self):
+        """Test that updates of a document are applied in order, even when
+        several bulk requests are in flight."""
+        for i in range(100):
+            self.elastic_doc.upsert({'_id': i % 10, 'a': i}, *TESTARGS)
+            self.elastic_doc.update(i % 10, {'$set': {'b': i}}, *TESTARGS)
+            if i % 15 == 0:
+                self.elastic_doc.send_buffered_operations()
+        self.elastic_doc.commit()
+
+        docs = sorted(self._search(), key=lambda doc: int(doc['_id']))
+        self.assertEqual(docs, [{'_id': str(i), 'a': 90 + i, 'b': 90 + i}
+                                for i in range(10)])
+
+    def test_bulk_upsert(self):
+        """Test the bulk_upsert method."""
+        self.elastic_doc.bulk_upsert([], *TESTARGS)
+        docs = ({"_id": i} for i in range(1000))
+        self.elastic_doc.bulk_upsert(docs, *TESTARGS)
+        self.elastic_doc.commit()
+        self.assertEqual(self._count(), 1000)
+
+
+@unittest.skipUnless(_HAS_ASYNC, 'Cannot test without elasticsearch-async')
+class TestAsyncBulkOrder(unittest.TestCase):
+    """Tests of the order of the bulk requests of the asyncio DocManager."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(doc_manager_class=DocManager,
+                                       chunk_size=1, bulkConcurrency=4)
+        self.docman._run(self.docman._close_client()).result()
+        self.docman.async_elastic = FakeAsyncElasticsearch()
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_buffer_sent_in_order(self):
+        """Test that the bulk requests of one buffer are sent one after
+        another."""
+        for i in range(3):
+            self.docman.upsert({'_id': 1, 'a': i}, *TESTARGS)
+        self.docman.send_buffered_operations()
+        self.docman.wait_for_pending()
+        client = self.docman.async_elastic
+        self.assertEqual(client.max_in_flight, 1)
+        sources = [json.loads(body.splitlines()[1]) for body in client.bodies
+                   if self.docman.meta_index_name not in body]
+        self.assertEqual(sources, [{'a': 0}, {'a': 1}, {'a': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
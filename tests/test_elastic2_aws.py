@@ -0,0 +1,119 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the AWS request signing of the Elastic2 DocManager."""
+import collections
+import sys
+
+sys.path[0:0] = [""]
+
+try:
+    import requests
+    from mongo_connector.doc_managers.elastic2_aws import AWSSigner
+except ImportError:
+    requests = None
+
+from tests import unittest
+
+ReadOnlyCredentials = collections.namedtuple(
+    'ReadOnlyCredentials', ['access_key', 'secret_key', 'token'])
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+
+# 2015-08-30T12:36:00Z, the date of the AWS Signature Version 4 test suite
+NOW = 1440938160
+
+DAY = 24 * 3600
+
+
+class RefreshableCredentials(object):
+    """Stand-in for botocore credentials which are renewed when read."""
+
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def get_frozen_credentials(self):
+        token = next(self.tokens)
+        if token is None:
+            raise RuntimeError('could not refresh')
+        return ReadOnlyCredentials(ACCESS_KEY, SECRET_KEY, token)
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class TestAWSSigner(unittest.TestCase):
+    """Tests of the signing of requests."""
+
+    def test_signature(self):
+        """Test the get-vanilla case of the AWS test suite."""
+        signer = AWSSigner(ReadOnlyCredentials(ACCESS_KEY, SECRET_KEY, None),
+                           'us-east-1', 'service')
+        headers = signer.sign('GET', 'https://example.amazonaws.com/',
+                              now=NOW)
+        self.assertEqual(headers, {
+            'X-Amz-Date': '20150830T123600Z',
+            'Authorization':
+                'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/'
+                'service/aws4_request, SignedHeaders=host;x-amz-date, '
+                'Signature=5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b'
+                '8aae1d763fbf31'})
+
+    def test_signing_key_cached(self):
+        """Test that the signing key is derived once a day."""
+        signer = AWSSigner(ReadOnlyCredentials(ACCESS_KEY, SECRET_KEY, None),
+                           'us-east-1')
+        url = 'https://search-test.us-east-1.es.amazonaws.com/_bulk'
+        first = signer.sign('POST', url, body='{}\n', now=NOW)
+        second = signer.sign('POST', url, body='{}\n', now=NOW + 60)
+        self.assertNotEqual(first['Authorization'], second['Authorization'])
+        self.assertEqual(signer.stats()['signing_keys_derived'], 1)
+        signer.sign('POST', url, body='{}\n', now=NOW + DAY)
+        self.assertEqual(signer.stats()['signing_keys_derived'], 2)
+
+    def test_sign_request(self):
+        """Test signing a prepared request, and the signing metrics."""
+        signer = AWSSigner(ReadOnlyCredentials(ACCESS_KEY, SECRET_KEY, 'a'),
+                           'us-east-1')
+        request = requests.Request(
+            'POST', 'https://search-test.us-east-1.es.amazonaws.com/_bulk'
+            '?filter_path=errors', data=b'{}\n').prepare()
+        signer(request)
+        self.assertEqual(request.headers['X-Amz-Security-Token'], 'a')
+        self.assertIn('SignedHeaders=host;x-amz-date;x-amz-security-token',
+                      request.headers['Authorization'])
+        stats = signer.stats()
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreaterEqual(stats['sign_seconds'], 0)
+
+    def test_refresh_credentials(self):
+        """Test that refreshed credentials are used, and that the previous
+        ones are kept if the refresh fails."""
+        signer = AWSSigner(RefreshableCredentials(['a', 'b', None]),
+                           'us-east-1')
+        url = 'https://search-test.us-east-1.es.amazonaws.com/'
+        self.assertEqual(signer.sign('GET', url)['X-Amz-Security-Token'],
+                         'a')
+        self.assertTrue(signer.refresh_credentials())
+        self.assertEqual(signer.sign('GET', url)['X-Amz-Security-Token'],
+                         'b')
+        self.assertFalse(signer.refresh_credentials())
+        self.assertEqual(signer.sign('GET', url)['X-Amz-Security-Token'],
+                         'b')
+        stats = signer.stats()
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['refresh_failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the BulkBuffer of the Elastic2 DocManager."""
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path[0:0] = [""]
+
+from mongo_connector.command_helper import CommandHelper
+
+from tests import unittest
+from tests.fakes import fake_doc_manager
+
+
+class TestBulkBuffer(unittest.TestCase):
+    """Tests of the buffering of operations."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager()
+        self.elastic = self.docman.elastic
+        self.buf = self.docman.BulkBuffer
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_buffered_operations(self):
+        """Test that each operation is buffered as one record."""
+        self.docman.upsert({'_id': 1, 'a': 1}, 'test.test', 1)
+        self.docman.update(1, {'$set': {'a': 2}}, 'test.test', 2)
+        self.docman.remove(2, 'test.test', 3)
+        self.assertEqual(
+            [(op.op_type, op.doc_id, op.source)
+             for op in self.buf.action_buffer],
+            [('index', '1', {'a': 1}), ('index', '1', {'a': 2}),
+             ('delete', '2', None)])
+
+        actions = self.buf.get_buffer()
+        self.assertEqual(len(actions), 6)
+        self.assertEqual(actions[1]['_source'],
+                         '{"ns": "test.test", "_ts": 1}')
+        self.assertEqual(actions[5]['_op_type'], 'delete')
+        self.assertEqual(self.buf.action_buffer, [])
+
+    def test_failed_update_skipped(self):
+        """Test that an update of a missing document is left out of the
+        bulk actions without moving the other operations."""
+        self.docman.upsert({'_id': 1, 'a': 1}, 'test.test', 1)
+        self.docman.commit()
+
+        self.docman.update(1, {'$set': {'a': 2}}, 'test.test', 2)
+        self.docman.update(9, {'$set': {'a': 2}}, 'test.test', 3)
+        self.docman.update(1, {'$set': {'b': 3}}, 'test.test', 4)
+        buffered = self.buf.action_buffer
+        self.docman.commit()
+
+        # The failed update keeps its place in the buffer
+        self.assertEqual([(op.doc_id, op.failed) for op in buffered],
+                         [('1', False), ('9', True), ('1', False)])
+        self.assertEqual(self.elastic.docs,
+                         {('test', 'test', '1'): {'a': 2, 'b': 3}})
+        self.assertNotIn(('test', 'test', '9'), self.elastic.writes)
+        self.assertEqual(self.elastic.writes[('test', 'test', '1')], 3)
+
+
+class TestSplit(unittest.TestCase):
+    """Tests of the flush of the operations on one namespace."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(mgetChunkSize=1)
+        self.elastic = self.docman.elastic
+        self.docman.command_helper = CommandHelper()
+        self.buf = self.docman.BulkBuffer
+        for i, namespace in enumerate(['test.a', 'test.b', 'other.a']):
+            self.docman.upsert({'_id': 1, 'n': i}, namespace, i + 1)
+        self.docman.commit()
+        self.timestamp = 10
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def operate(self, namespace):
+        self.timestamp += 1
+        self.docman.update(1, {'$set': {'m': self.timestamp}}, namespace,
+                           self.timestamp)
+        self.timestamp += 1
+        self.docman.upsert({'_id': 2, 'm': self.timestamp}, namespace,
+                           self.timestamp)
+
+    def test_split(self):
+        """Test that the operations and retrieved sources of a namespace
+        are moved to another buffer."""
+        for namespace in ['test.a', 'test.b', 'other.a', 'test.a']:
+            self.operate(namespace)
+        part = self.buf.split(lambda index, doc_type: doc_type == 'a')
+
+        self.assertEqual([(op.index, op.doc_type)
+                          for op in part.action_buffer],
+                         [('test', 'a'), ('test', 'a'), ('other', 'a'),
+                          ('other', 'a'), ('test', 'a'), ('test', 'a')])
+        self.assertEqual(len(self.buf.action_buffer), 2)
+        self.assertEqual(sorted(part.namespaces), ['other.a', 'test.a'])
+        self.assertEqual(part.checkpoint['_ts'], 18)
+        self.assertEqual(self.buf.checkpoint['_ts'], 14)
+
+        actions = part.get_buffer()[::2]
+        self.assertEqual([action['_source'] for action in actions],
+                         [{'n': 0, 'm': 11}, {'m': 12}, {'n': 2, 'm': 15},
+                          {'m': 16}, {'n': 0, 'm': 17}, {'m': 18}])
+        actions = self.buf.get_buffer()[::2]
+        self.assertEqual([action['_source'] for action in actions],
+                         [{'n': 1, 'm': 13}, {'m': 14}])
+
+    def test_create_flushes_collection(self):
+        """Test that a command only sends the operations of its
+        collection."""
+        self.operate('test.a')
+        self.operate('test.b')
+        self.docman.handle_command({'create': 'a'}, 'test.$cmd', 20)
+        self.assertEqual(self.elastic.docs[('test', 'a', '2')], {'m': 12})
+        self.assertNotIn(('test', 'b', '2'), self.elastic.docs)
+        self.assertEqual(len(self.buf.action_buffer), 2)
+
+        self.docman.commit()
+        self.assertEqual(self.elastic.docs[('test', 'b', '1')],
+                         {'n': 1, 'm': 13})
+
+
+class TestSplitSpooled(unittest.TestCase):
+    """Tests of the flush of one namespace while operations are spooled."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.docman = fake_doc_manager(spoolDirectory=self.directory,
+                                       spoolReplayInterval=3600)
+        self.elastic = self.docman.elastic
+        self.docman.command_helper = CommandHelper()
+        self.buf = self.docman.BulkBuffer
+
+    def tearDown(self):
+        self.docman.stop()
+        shutil.rmtree(self.directory)
+
+    def test_kept_operations_merged(self):
+        """Test that the operations of a namespace which are kept until the
+        spool is replayed stay buffered."""
+        self.docman.upsert({'_id': 1, 'n': 0}, 'test.a', 1)
+        self.docman.commit()
+        # Elasticsearch was unavailable for a while
+        self.docman._spool_actions(
+            [{'_index': 'test', '_type': 'a', '_id': '2', '_source': {}}],
+            None)
+        self.docman._spool_retry_at = time.time() + 3600
+        self.docman.update(1, {'$set': {'n': 1}}, 'test.a', 2)
+        self.docman.upsert({'_id': 3}, 'test.b', 3)
+        self.docman.handle_command({'create': 'a'}, 'test.$cmd', 4)
+        self.assertEqual([op.doc_id for op in self.buf.action_buffer],
+                         ['3', '1'])
+        self.assertEqual(len(self.buf.doc_to_update), 1)
+
+        # Elasticsearch recovered
+        self.docman._spool_retry_at = 0
+        self.docman.commit()
+        self.assertFalse(self.docman.spool.pending())
+        self.assertEqual(self.elastic.docs, {
+            ('test', 'a', '1'): {'n': 1}, ('test', 'a', '2'): {},
+            ('test', 'b', '3'): {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -146,6 +146,30 @@ class TestElasticDocManager(ElasticsearchTestCase):
         for doc in res:
             self.assertEqual(doc['_id'], '1')
             self.assertEqual(doc['_source']['name'], 'John')
+        # The document passed in is left untouched
+        self.assertEqual(docc, {'_id': '1', 'name': 'John'})
+
+    def test_update_chunked_mget(self):
+        """Test updates whose sources are retrieved by several concurrent
+        mget requests."""
+        docman = DocManager(elastic_pair, auto_commit_interval=None,
+                            mgetChunkSize=3, mgetConcurrency=2)
+        try:
+            for i in range(10):
+                docman.upsert({'_id': i, 'a': i}, *TESTARGS)
+            docman.commit()
+
+            for i in range(10):
+                docman.update(i, {'$set': {'b': 2 * i}}, *TESTARGS)
+            # Sources of full chunks are requested while buffering
+            self.assertEqual(len(docman.BulkBuffer.fetches), 3)
+            docman.commit()
+
+            docs = sorted(self._search(), key=lambda doc: int(doc['_id']))
+            self.assertEqual(docs, [{'_id': str(i), 'a': i, 'b': 2 * i}
+                                    for i in range(10)])
+        finally:
+            docman.stop()
 
     def test_upsert_with_updates(self):
         """Test the upsert method with multi updates
@@ -198,6 +222,173 @@ class TestElasticDocManager(ElasticsearchTestCase):
         for i, r in enumerate(returned_ids):
             self.assertEqual(r, 2 * i)
 
+    def test_external_versioning(self):
+        """Test that writes older than the document in Elasticsearch are
+        ignored when documents are versioned with the oplog timestamp."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            externalVersioning=True)
+        try:
+            docman.upsert({'_id': '1', 'name': 'new'}, 'test.test', 10)
+            docman.upsert({'_id': '1', 'name': 'old'}, 'test.test', 5)
+            docman.remove('1', 'test.test', 7)
+            docman.bulk_upsert([{'_id': '1', 'name': 'dump'}],
+                               'test.test', 8)
+            self.assertEqual(list(self._search()),
+                             [{'_id': '1', 'name': 'new'}])
+
+            docman.update('1', {'$set': {'a': 1}}, 'test.test', 11)
+            self.assertEqual(list(self._search()),
+                             [{'_id': '1', 'name': 'new', 'a': 1}])
+            doc = self.elastic_conn.get(index='test', doc_type='test',
+                                        id='1')
+            self.assertEqual(doc['_version'], 11)
+        finally:
+            docman.stop()
+
+    def test_routing(self):
+        """Test that documents are routed by the configured field, also for
+        updates and removals which do not carry it."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            routing={'test.*': 'tenant.id'})
+        try:
+            docman.upsert({'_id': '1', 'tenant': {'id': 'a'}, 'name': 'x'},
+                          *TESTARGS)
+            docman.bulk_upsert([{'_id': '2', 'tenant': {'id': 'b'}}],
+                               *TESTARGS)
+            hits = self.elastic_conn.search(index='test')['hits']['hits']
+            self.assertEqual(
+                sorted((hit['_id'], hit.get('_routing')) for hit in hits),
+                [('1', 'a'), ('2', 'b')])
+
+            # Forget the cached routing so that it is looked up
+            docman.routing_cache.pop(('test', 'test', '1'))
+            docman.update('1', {'$set': {'name': 'y'}}, *TESTARGS)
+            doc = self.elastic_conn.get(index='test', doc_type='test',
+                                        id='1', routing='a')
+            self.assertEqual(doc['_source']['name'], 'y')
+
+            docman.remove('2', *TESTARGS)
+            self.assertEqual([doc['_id'] for doc in self._search()], ['1'])
+        finally:
+            docman.stop()
+
+    def test_shard_aware_bulk(self):
+        """Test that bulk requests sent to the nodes holding the primary
+        shards are applied."""
+        docman = DocManager(elastic_pair, auto_commit_interval=None,
+                            shardAwareBulk=True)
+        try:
+            docman.bulk_upsert([{'_id': str(i)} for i in range(10)],
+                               *TESTARGS)
+            for i in range(10, 20):
+                docman.upsert({'_id': str(i)}, *TESTARGS)
+            docman.remove('0', *TESTARGS)
+            docman.commit()
+            self.assertEqual(
+                sorted(int(doc['_id']) for doc in self._search()),
+                list(range(1, 20)))
+        finally:
+            docman.stop()
+
+    def test_infer_mappings(self):
+        """Test that the mapping inferred from sample documents is put
+        before they are indexed, and only once."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            inferMappings=True, mappingSampleSize=2)
+        try:
+            docman.bulk_upsert([{'_id': '1', 'count': 1},
+                                {'_id': '2', 'ratio': 1.5},
+                                {'_id': '3', 'name': 'John'}], *TESTARGS)
+            properties = self.elastic_conn.indices.get_mapping(
+                index='test')['test']['mappings']['test']['properties']
+            self.assertEqual(properties['count']['type'], 'long')
+            self.assertEqual(properties['ratio']['type'], 'double')
+            self.assertEqual(
+                sorted(docman._known_mappings[('test', 'test')]['properties']),
+                ['count', 'ratio'])
+            self.assertEqual(self._count(), 3)
+        finally:
+            docman.stop()
+
+    def test_skip_unchanged_writes(self):
+        """Test that writes which do not change the source of a document
+        are skipped."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            fingerprintCacheSize=100)
+        try:
+            docman.upsert({'_id': '1', 'name': 'John'}, *TESTARGS)
+            docman.upsert({'_id': '1', 'name': 'John'}, *TESTARGS)
+            docman.update('1', {'$set': {'name': 'John'}}, *TESTARGS)
+            self.assertEqual(docman.suppressed_writes, 2)
+            doc = self.elastic_conn.get(index='test', doc_type='test',
+                                        id='1')
+            self.assertEqual(doc['_version'], 1)
+
+            docman.update('1', {'$set': {'name': 'Paul'}}, *TESTARGS)
+            docman.remove('1', *TESTARGS)
+            docman.upsert({'_id': '1', 'name': 'Paul'}, *TESTARGS)
+            self.assertEqual(docman.suppressed_writes, 2)
+            self.assertEqual(list(self._search()),
+                             [{'_id': '1', 'name': 'Paul'}])
+        finally:
+            docman.stop()
+
+    def test_lag_stats(self):
+        """Test that the replication lag and the age of buffered operations
+        are reported for each namespace."""
+        docman = DocManager(elastic_pair, auto_commit_interval=None,
+                            lagLogInterval=0)
+        try:
+            timestamp = int(time.time() - 10) << 32
+            docman.upsert({'_id': '1'}, 'test.test', timestamp)
+            docman.bulk_upsert([{'_id': '2'}], 'test.other', timestamp)
+            stats = docman.stats()['namespaces']
+            self.assertIsNone(stats['test.test']['lag'])
+            self.assertIsNotNone(stats['test.test']['oldest_buffered_age'])
+            self.assertGreaterEqual(stats['test.other']['lag'], 10)
+            self.assertIsNone(stats['test.other']['oldest_buffered_age'])
+
+            docman.commit()
+            stats = docman.stats()['namespaces']['test.test']
+            self.assertEqual(stats['last_ts'], timestamp)
+            self.assertGreaterEqual(stats['lag'], 10)
+            self.assertIsNone(stats['oldest_buffered_age'])
+        finally:
+            docman.stop()
+
+    def test_bulk_upsert_errors(self):
+        """Test that failed items of a bulk request are reported."""
+        self.elastic_conn.indices.put_mapping(
+            index='test', doc_type='test',
+            body={"properties": {"num": {"type": "integer"}}})
+        docs = [{"_id": 1, "num": 1}, {"_id": 2, "num": "not a number"}]
+        with self.assertRaises(errors.OperationFailed):
+            self.elastic_doc.bulk_upsert(docs, *TESTARGS)
+        self.elastic_doc.commit()
+        self.assertEqual([doc['_id'] for doc in self._search()], ['1'])
+
+    def test_sharded_buffer(self):
+        """Test that operations are partitioned into buffer shards and all
+        shards are sent on commit."""
+        docman = DocManager(elastic_pair, auto_commit_interval=None,
+                            bulkBufferShards=4, bulkBufferShardKey='id')
+        try:
+            for i in range(100):
+                docman.upsert({'_id': i, 'name': 'John'}, *TESTARGS)
+            docman.update(1, {'$set': {'name': 'Paul'}}, *TESTARGS)
+            buffered = [len(buf.action_buffer) for buf in docman.buffer_shards]
+            self.assertEqual(sum(buffered), 101)
+            self.assertTrue(all(buffered))
+
+            docman.commit()
+            self.assertEqual(self._count(), 100)
+            self.assertFalse(any(buf.action_buffer
+                                 for buf in docman.buffer_shards))
+            res = self._search({"match": {"name": "Paul"}})
+            self.assertEqual([doc['_id'] for doc in res], ['1'])
+        finally:
+            docman.stop()
+
     def test_remove(self):
         """Test the remove method."""
         docc = {'_id': '1', 'name': 'John'}
@@ -375,6 +566,80 @@ class TestElasticDocManager(ElasticsearchTestCase):
         self.assertEqual(
             self.elastic_doc.elastic.count(index="test")['count'], 3)
 
+    def test_get_last_doc_checkpoint(self):
+        """Test that get_last_doc reads the checkpoint, which is versioned by
+        timestamp and not returned by search.
+        """
+        docc = {'_id': '7', 'name': 'Hare'}
+        self.elastic_doc.upsert(docc, 'test.test', 10)
+        self.elastic_doc.remove('7', 'test.test', 12)
+        doc = self.elastic_doc.get_last_doc()
+        self.assertEqual(doc['_id'], '7')
+        self.assertEqual(doc['_ts'], 12)
+
+        checkpoint = self.elastic_conn.get(
+            index=self.elastic_doc.meta_index_name,
+            doc_type=self.elastic_doc.checkpoint_type,
+            id='checkpoint')
+        self.assertEqual(checkpoint['_version'], 12)
+        self.assertEqual(list(self.elastic_doc.search(0, 12)), [])
+
+        # A checkpoint older than the stored one is ignored
+        self.elastic_doc._checkpoint_ts = None
+        docc = {'_id': '8', 'name': 'Tortoise'}
+        self.elastic_doc.upsert(docc, 'test.test', 11)
+        self.assertEqual(self.elastic_doc.get_last_doc()['_id'], '7')
+
+    def test_partitioned_meta_index(self):
+        """Test that meta entries are written to daily partitions which are
+        searched and dropped as a whole.
+        """
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            partitionMetaIndex=True)
+        try:
+            day = 24 * 60 * 60
+            ts = (int(time.time()) - 2 * day) << 32
+            docman.upsert({'_id': '1', 'name': 'John'}, 'test.test', ts)
+            docman.upsert({'_id': '2', 'name': 'Paul'}, 'test.test',
+                          ts + (day << 32))
+            docman.remove('1', 'test.test', ts + (day << 32) + 1)
+            self.assertIn(docman._meta_index(ts), self._indices())
+
+            search = list(docman.search(ts, ts + (day << 32) + 1))
+            self.assertEqual(sorted(doc['_id'] for doc in search),
+                             ['1', '2'])
+
+            docman.meta_index_retention = day
+            docman.prune_meta_index()
+            retry_until_ok(self.elastic_conn.indices.refresh, index="")
+            self.assertNotIn(docman._meta_index(ts), self._indices())
+            search = list(docman.search(ts, ts + (day << 32) + 1))
+            self.assertEqual(len(search), 2)
+        finally:
+            docman.stop()
+            self.elastic_conn.indices.delete(
+                index='%s-*' % docman.meta_index_name, ignore=404)
+
+    def test_meta_index_retention(self):
+        """Test that expired entries are deleted from a meta index which is
+        not partitioned.
+        """
+        docman = DocManager(elastic_pair, auto_commit_interval=0)
+        try:
+            day = 24 * 60 * 60
+            ts = (int(time.time()) - 2 * day) << 32
+            docman.upsert({'_id': '1', 'name': 'John'}, 'test.test', ts)
+            docman.upsert({'_id': '2', 'name': 'Paul'}, 'test.test',
+                          ts + (day << 32))
+
+            docman.meta_index_retention = 1.5 * day
+            docman.prune_meta_index()
+            retry_until_ok(self.elastic_conn.indices.refresh, index="")
+            search = list(docman.search(ts, ts + (day << 32)))
+            self.assertEqual([doc['_id'] for doc in search], ['2'])
+        finally:
+            docman.stop()
+
     def test_commands(self):
         cmd_args = ('test.$cmd', 1)
         self.elastic_doc.command_helper = CommandHelper()
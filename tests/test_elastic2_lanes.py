@@ -0,0 +1,137 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the priority lanes of the Elastic2 DocManager."""
+import sys
+import threading
+
+sys.path[0:0] = [""]
+
+from elasticsearch.connection import Connection, RequestsHttpConnection
+
+from mongo_connector import errors
+from mongo_connector.doc_managers.elastic2_doc_manager import DocManager
+from mongo_connector.doc_managers.elastic2_lanes import DUMP, LIVE, BulkLanes
+
+from tests import unittest
+from tests.fakes import FakeElasticsearch
+
+
+class TestBulkLanes(unittest.TestCase):
+    """Tests of the sharing of concurrent bulk requests."""
+
+    def test_shares(self):
+        """Test the share of each lane."""
+        self.assertEqual(BulkLanes().shares, {LIVE: 3, DUMP: 1})
+        self.assertEqual(BulkLanes(8, {LIVE: 1, DUMP: 1}).shares,
+                         {LIVE: 4, DUMP: 4})
+        self.assertEqual(BulkLanes(2, {LIVE: 1, DUMP: 9}).shares,
+                         {LIVE: 1, DUMP: 1})
+        self.assertRaises(ValueError, BulkLanes, 1)
+        self.assertRaises(ValueError, BulkLanes, 4, {'other': 1})
+        self.assertRaises(ValueError, BulkLanes, 4, {DUMP: 0})
+
+    def test_dump_limited_to_share(self):
+        """Test that the dump lane waits beyond its share, while the live
+        lane uses the free requests."""
+        lanes = BulkLanes(4, {LIVE: 1, DUMP: 1})
+        for _ in range(2):
+            lanes.acquire(DUMP)
+        acquired = threading.Event()
+
+        def dump():
+            lanes.acquire(DUMP)
+            acquired.set()
+
+        thread = threading.Thread(target=dump)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        # The live lane borrows the requests the dump lane does not use
+        for _ in range(2):
+            lanes.acquire(LIVE)
+        self.assertEqual(lanes.stats()[LIVE]['in_flight'], 2)
+        lanes.release(DUMP)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(lanes.stats()[DUMP]['requests'], 3)
+
+    def test_live_not_blocked_by_dump(self):
+        """Test that the live lane is not blocked by a busy dump lane."""
+        lanes = BulkLanes(2, {LIVE: 1, DUMP: 1})
+        lanes.acquire(DUMP)
+        with lanes.slot(LIVE):
+            self.assertEqual(lanes.stats()[LIVE]['in_flight'], 1)
+        self.assertEqual(lanes.stats()[LIVE]['in_flight'], 0)
+
+
+class TestPriorityLanes(unittest.TestCase):
+    """Tests of the lanes used by the DocManager."""
+
+    def test_dump_client(self):
+        """Test that bulk_upsert uses the client of the dump lane."""
+        docman = DocManager('localhost:9200', auto_commit_interval=None,
+                            autoSendInterval=0, lagLogInterval=0,
+                            priorityLanes=True)
+        try:
+            self.assertIsNot(docman.dump_elastic, docman.elastic)
+            docman.elastic = FakeElasticsearch(docman.meta_index_name)
+            docman.dump_elastic = FakeElasticsearch(docman.meta_index_name)
+            docman.bulk_upsert([{'_id': i} for i in range(3)], 'test.test',
+                               1)
+            docman.upsert({'_id': 3}, 'test.test', 2)
+            docman.commit()
+            self.assertEqual(len(docman.dump_elastic.docs), 3)
+            self.assertEqual(list(docman.elastic.docs),
+                             [('test', 'test', '3')])
+            lanes = docman.stats()['lanes']
+            self.assertEqual(lanes[DUMP]['requests'], 1)
+            self.assertEqual(lanes[LIVE]['requests'], 1)
+        finally:
+            docman.stop()
+
+    def test_requests_pool_size(self):
+        """Test that the pool of a requests dump client is sized to the
+        share of the dump lane."""
+        docman = DocManager(
+            'localhost:9200', auto_commit_interval=None, autoSendInterval=0,
+            lagLogInterval=0, priorityLanes=True, laneConcurrency=4,
+            clientOptions={'connection_class': RequestsHttpConnection})
+        dump_elastic = docman.dump_elastic
+        docman.elastic = FakeElasticsearch(docman.meta_index_name)
+        docman.dump_elastic = FakeElasticsearch(docman.meta_index_name)
+        docman.stop()
+        connection, = dump_elastic.transport.connection_pool.connections
+        adapter = connection.session.get_adapter('http://localhost')
+        self.assertEqual(adapter._pool_maxsize, docman.lanes.shares[DUMP])
+
+    def test_unsized_connection_class(self):
+        """Test that lanes are rejected for a connection class whose
+        connections cannot be limited."""
+        class UnsizedConnection(Connection):
+            pass
+        self.assertRaises(errors.InvalidConfiguration, DocManager,
+                          'localhost:9200', priorityLanes=True,
+                          clientOptions={'connection_class':
+                                         UnsizedConnection})
+
+    def test_invalid_weights(self):
+        """Test that invalid lane options are rejected."""
+        self.assertRaises(errors.InvalidConfiguration, DocManager,
+                          'localhost:9200', priorityLanes=True,
+                          laneWeights={DUMP: -1})
+
+
+if __name__ == '__main__':
+    unittest.main()
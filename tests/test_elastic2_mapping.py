@@ -0,0 +1,111 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the mapping inference of the Elastic2 DocManager."""
+import datetime
+import sys
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_mapping import (infer_mapping,
+                                                           string_mapping)
+
+from tests import unittest
+from tests.fakes import fake_doc_manager
+
+
+class TestInferMapping(unittest.TestCase):
+    """Unit tests for infer_mapping."""
+
+    def test_types(self):
+        """Test that each type of value gets its dynamic mapping."""
+        now = datetime.datetime.utcnow()
+        properties = infer_mapping(
+            [{'_id': 1, 'flag': True, 'count': 1, 'ratio': 0.5,
+              'name': 'John', 'born': now, 'tags': ['a', 'b'],
+              'address': {'zip': 12345}, 'nothing': None}],
+            string_mapping(2))
+        self.assertEqual(properties, {
+            'flag': {'type': 'boolean'},
+            'count': {'type': 'long'},
+            'ratio': {'type': 'double'},
+            'name': {'type': 'string'},
+            'born': {'type': 'date'},
+            'tags': {'type': 'string'},
+            'address': {'properties': {'zip': {'type': 'long'}}}})
+        self.assertEqual(infer_mapping([{'name': 'John'}])['name']['type'],
+                         'text')
+
+    def test_dates(self):
+        """Test that strings in the default dynamic date formats are
+        mapped as dates."""
+        properties = infer_mapping(
+            [{'a': '2015-01-01', 'b': '2015-01-01T12:10:30.123+01:00',
+              'c': '2015/09/02', 'd': '2015/09/02 12:10:30 +0100',
+              'e': '2015-13-01', 'f': '2015-01', 'g': '12:10:30'}],
+            string_mapping(2))
+        slash = {'type': 'date',
+                 'format': 'yyyy/MM/dd HH:mm:ss Z||yyyy/MM/dd Z'}
+        self.assertEqual(properties, {
+            'a': {'type': 'date'}, 'b': {'type': 'date'},
+            'c': slash, 'd': slash,
+            'e': {'type': 'string'}, 'f': {'type': 'string'},
+            'g': {'type': 'string'}})
+        # Dates and other strings in the sample conflict
+        self.assertEqual(
+            infer_mapping([{'a': '2015-01-01'}, {'a': 'John'}]), {})
+
+    def test_merge(self):
+        """Test that the mappings of the sampled documents are merged and
+        conflicting fields are left out."""
+        properties = infer_mapping(
+            [{'a': 1, 'b': 1, 'c': {'d': 1}},
+             {'a': 1.5, 'b': 'one', 'c': {'e': True}, 'f': None},
+             {'f': [None, 2]}],
+            string_mapping(5))
+        self.assertEqual(properties, {
+            'a': {'type': 'double'},
+            'c': {'properties': {'d': {'type': 'long'},
+                                 'e': {'type': 'boolean'}}},
+            'f': {'type': 'long'}})
+
+
+class TestInferMappingDocManager(unittest.TestCase):
+    """Tests of the mappings inferred by the DocManager."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(inferMappings=True)
+        self.docman._es_major_version = 5
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_inferred_once(self):
+        """Test that the mapping of a namespace is inferred once, even when
+        nothing was inferred from its documents."""
+        inferred = []
+        infer = self.docman._infer_mapping
+
+        def count_inferences(namespace, docs):
+            inferred.append(namespace)
+            infer(namespace, docs)
+
+        self.docman._infer_mapping = count_inferences
+        for i in range(3):
+            self.docman.upsert({'_id': i}, 'test.test', i)
+        self.assertEqual(inferred, ['test.test'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the record and replay harness of the Elastic2
+DocManager."""
+import os
+import shutil
+import sys
+import tempfile
+
+from bson import ObjectId
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_replay import (
+    generate_workload, load_records, replay, save_records)
+
+from tests import unittest
+
+
+class CallRecorder(object):
+    """Stand-in for a DocManager which remembers the calls it receives."""
+
+    def __init__(self):
+        self.calls = []
+        self.committed_ts = None
+
+    def upsert(self, doc, namespace, timestamp):
+        self.calls.append(('upsert', doc['_id'], timestamp))
+
+    def update(self, document_id, update_spec, namespace, timestamp):
+        self.calls.append(('update', document_id, timestamp))
+
+    def remove(self, document_id, namespace, timestamp):
+        self.calls.append(('remove', document_id, timestamp))
+
+    def commit(self):
+        self.committed_ts = self.calls[-1][2]
+
+    def get_last_doc(self):
+        if self.committed_ts is None:
+            return None
+        return {'_ts': self.committed_ts}
+
+
+class TestReplay(unittest.TestCase):
+    """Unit tests for generating and replaying workloads."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_generate_workload(self):
+        """Test that workloads are repeatable and follow the mix."""
+        records = list(generate_workload(1000, inserts=2, updates=1,
+                                         deletes=1, seed=42, start=1000))
+        self.assertEqual(records, list(generate_workload(
+            1000, inserts=2, updates=1, deletes=1, seed=42, start=1000)))
+        ops = [record['op'] for record in records]
+        self.assertEqual(ops[0], 'upsert')
+        self.assertTrue(400 < ops.count('upsert') < 600)
+        self.assertTrue(150 < ops.count('remove') < 350)
+        timestamps = [record['args'][-1] for record in records]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+
+        # Only existing documents are updated or removed
+        live = set()
+        for record in records:
+            if record['op'] == 'upsert':
+                live.add(record['args'][0]['_id'])
+            else:
+                self.assertIn(record['args'][0], live)
+                if record['op'] == 'remove':
+                    live.remove(record['args'][0])
+
+    def test_save_and_load(self):
+        """Test that records keep their BSON types in a recording."""
+        path = os.path.join(self.directory, 'recording.gz')
+        records = [{'t': 0.5, 'op': 'upsert',
+                    'args': [{'_id': ObjectId(), 'a': 1}, 'test.test',
+                             6000000000]}]
+        save_records(path, records)
+        self.assertEqual(list(load_records(path)), records)
+
+    def test_replay(self):
+        """Test that all operations are replayed in order and reported."""
+        records = list(generate_workload(200, seed=1))
+        docman = CallRecorder()
+        report = replay(docman, records, sample_interval=0.01)
+        self.assertEqual([call[2] for call in docman.calls],
+                         [record['args'][-1] for record in records])
+        self.assertEqual(report['operations'], 200)
+        self.assertEqual(report['documents'], 200)
+        self.assertTrue(report['drained'])
+        self.assertIsNotNone(report['lag_max'])
+
+    def test_replay_recorded_speed(self):
+        """Test that operations can be replayed at the recorded speed."""
+        records = list(generate_workload(20, rate=100.0, seed=1))
+        report = replay(CallRecorder(), records, speed=2.0,
+                        sample_interval=0.01)
+        # 20 operations at 100/s take 0.19s, replayed twice faster
+        self.assertGreaterEqual(report['seconds'], 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the shadow index resyncs of the Elastic2 DocManager."""
+import json
+import sys
+
+from elasticsearch import exceptions as es_exceptions
+
+sys.path[0:0] = [""]
+
+from mongo_connector import errors
+from mongo_connector.command_helper import CommandHelper
+from mongo_connector.doc_managers.elastic2_resync import (
+    BULK_LOAD_SETTINGS, create_shadow, shadow_name, swap_alias)
+
+from tests import unittest
+from tests.fakes import (
+    FakeElasticsearch, FakeSearchElasticsearch, fake_doc_manager)
+
+
+class FakeAliasIndices(object):
+    """Stand-in for the indices client, with indices and aliases."""
+
+    def __init__(self, docs=None):
+        # Documents of the client, deleted with their index
+        # Format: {(_index, _type, _id): _source}
+        self.docs = {} if docs is None else docs
+        # Format: {index: {"settings": ..., "mappings": ...}}
+        self.indices = {}
+        # Format: {alias: index}
+        self.aliases = {}
+        self.refreshes = 0
+
+    def _resolve(self, index):
+        if index in self.aliases:
+            return [self.aliases[index]]
+        if index in self.indices:
+            return [index]
+        raise es_exceptions.NotFoundError(404, 'index_not_found_exception')
+
+    def get_settings(self, index):
+        return dict((name, {'settings': self.indices[name]['settings']})
+                    for name in self._resolve(index))
+
+    def get_mapping(self, index):
+        return dict((name, {'mappings': self.indices[name]['mappings']})
+                    for name in self._resolve(index))
+
+    def create(self, index, body=None, ignore=None):
+        if index in self.indices and ignore is None:
+            raise es_exceptions.RequestError(
+                400, 'index_already_exists_exception')
+        body = body or {}
+        self.indices.setdefault(index, {
+            'settings': body.get('settings', {'index': {}}),
+            'mappings': body.get('mappings', {})})
+
+    def put_settings(self, index, body):
+        for name in self._resolve(index):
+            self.indices[name]['settings']['index'].update(body['index'])
+
+    def put_mapping(self, index, doc_type, body):
+        for name in self._resolve(index):
+            self.indices[name]['mappings'].setdefault(
+                doc_type, {}).update(body)
+
+    def refresh(self, index=None, ignore_unavailable=False):
+        self.refreshes += 1
+
+    def update_aliases(self, body):
+        # Indices are removed first, the actions are applied at once
+        actions = sorted(body['actions'],
+                         key=lambda action: 'remove_index' not in action)
+        for action in actions:
+            (kind, spec), = action.items()
+            if kind == 'remove_index':
+                self.delete(spec['index'])
+            elif kind == 'add':
+                assert spec['alias'] not in self.indices
+                self.aliases[spec['alias']] = spec['index']
+            else:
+                del self.aliases[spec['alias']]
+
+    def delete(self, index, ignore=None):
+        self.indices.pop(index, None)
+        for key in list(self.docs):
+            if key[0] == index:
+                del self.docs[key]
+
+
+class FakeAliasElasticsearch(FakeSearchElasticsearch):
+    """Stand-in for Elasticsearch resolving aliases in bulk requests and
+    searches."""
+
+    def __init__(self, meta_index_name):
+        super(FakeAliasElasticsearch, self).__init__(meta_index_name)
+        self.indices = FakeAliasIndices(self.docs)
+
+    def _resolve(self, index):
+        return self.indices.aliases.get(index, index)
+
+    def bulk(self, body, filter_path=None):
+        lines = body.splitlines()
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            (op_type, meta), = action.items()
+            meta['_index'] = self._resolve(meta['_index'])
+            lines[i] = json.dumps(action)
+            i += 1 if op_type == 'delete' else 2
+        return super(FakeAliasElasticsearch, self).bulk(
+            '\n'.join(lines) + '\n', filter_path)
+
+    def mget(self, body, realtime=True):
+        docs = [dict(doc, _index=self._resolve(doc['_index']))
+                for doc in body['docs']]
+        return super(FakeAliasElasticsearch, self).mget({'docs': docs},
+                                                        realtime)
+
+    def search(self, index, body=None, doc_type=None, **kwargs):
+        hits = []
+        for name in (doc_type if isinstance(doc_type, list) else [doc_type]):
+            hits.extend(super(FakeAliasElasticsearch, self).search(
+                self._resolve(index), body, name)['hits']['hits'])
+        return {'_scroll_id': 'scroll', 'hits': {'hits': hits},
+                '_shards': {'successful': 1, 'total': 1}}
+
+
+class TestResync(unittest.TestCase):
+    """Tests of the creation and swap of shadow indices."""
+
+    def setUp(self):
+        self.client = FakeElasticsearch('mongodb_meta')
+        self.client.indices = FakeAliasIndices()
+        self.indices = self.client.indices
+
+    def test_shadow_name(self):
+        self.assertEqual(shadow_name('test', 0), 'test-resync-19700101000000')
+
+    def test_create_shadow(self):
+        """Test that the shadow index copies the current index."""
+        self.indices.create('test', {
+            'settings': {'index': {'number_of_shards': '3',
+                                   'number_of_replicas': '2'}},
+            'mappings': {'coll': {'properties': {'a': {'type': 'long'}}}}})
+        resync = create_shadow(self.client, 'test', 0)
+        shadow = self.indices.indices[resync.shadow]
+        self.assertEqual(shadow['mappings'],
+                         self.indices.indices['test']['mappings'])
+        self.assertEqual(shadow['settings']['index'],
+                         dict(BULK_LOAD_SETTINGS, number_of_shards='3'))
+        self.assertEqual(resync.restore['number_of_replicas'], '2')
+
+    def test_swap_index(self):
+        """Test that an index is replaced by an alias to its shadow."""
+        self.indices.create('test')
+        resync = create_shadow(self.client, 'test', 0)
+        swap_alias(self.client, resync)
+        self.assertEqual(self.indices.aliases, {'test': resync.shadow})
+        self.assertEqual(list(self.indices.indices), [resync.shadow])
+        self.assertEqual(
+            self.indices.indices[resync.shadow]['settings']['index'],
+            resync.restore)
+
+    def test_swap_index_rejected(self):
+        """Test that the index is kept when it cannot be replaced by an
+        alias in one request."""
+        self.indices.create('test')
+
+        def update_aliases(body):
+            raise es_exceptions.RequestError(400, 'illegal_argument')
+
+        self.indices.update_aliases = update_aliases
+        resync = create_shadow(self.client, 'test', 0)
+        self.assertRaises(errors.OperationFailed, swap_alias, self.client,
+                          resync)
+        self.assertIn('test', self.indices.indices)
+
+    def test_swap_alias(self):
+        """Test that an alias is moved and its old index deleted."""
+        first = create_shadow(self.client, 'test', 0)
+        swap_alias(self.client, first)
+        second = create_shadow(self.client, 'test', 1)
+        swap_alias(self.client, second)
+        self.assertEqual(self.indices.aliases, {'test': second.shadow})
+        self.assertEqual(list(self.indices.indices), [second.shadow])
+
+
+class TestShadowResync(unittest.TestCase):
+    """Tests of the resyncs made by the DocManager."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(FakeAliasElasticsearch,
+                                       shadowResync=True,
+                                       shadowResyncIdle=3600)
+        self.elastic = self.docman.elastic
+        self.docman.command_helper = CommandHelper()
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_dump_into_shadow(self):
+        """Test that dumps go to the shadow index, and live operations to
+        both indices, until the resync is finished."""
+        self.elastic.indices.create('test')
+        self.docman.bulk_upsert([{'_id': i} for i in range(3)], 'test.coll',
+                                1)
+        shadow = self.docman._resyncs['test'].shadow
+        self.docman.upsert({'_id': 'live'}, 'test.coll', 2)
+        self.docman.commit()
+        self.assertEqual(sorted(self.elastic.docs), [
+            ('test', 'coll', 'live'),
+            (shadow, 'coll', '0'), (shadow, 'coll', '1'),
+            (shadow, 'coll', '2'), (shadow, 'coll', 'live')])
+
+        # Documents were dumped within the idle period
+        self.docman.finish_idle_resyncs(3600)
+        self.assertIn('test', self.docman._resyncs)
+        self.docman.finish_idle_resyncs(0)
+        self.assertEqual(self.docman._resyncs, {})
+        self.assertEqual(self.elastic.indices.aliases, {'test': shadow})
+
+    def test_untouched_collections_copied(self):
+        """Test that the collections of an index which are not dumped are
+        kept when resyncs of the index are separated by the idle time."""
+        self.elastic.indices.create('test', {'mappings': {'a': {}, 'b': {}}})
+        self.elastic.docs[('test', 'a', '1')] = {}
+        self.elastic.docs[('test', 'b', '1')] = {}
+        self.docman.bulk_upsert([{'_id': 2}], 'test.a', 1)
+        self.docman.finish_idle_resyncs(0)
+        first = self.elastic.indices.aliases['test']
+        self.assertEqual(sorted(self.elastic.docs), [
+            (first, 'a', '2'), (first, 'b', '1')])
+
+        # The second resync of the index starts within the same second
+        self.docman.bulk_upsert([{'_id': 3}], 'test.b', 2)
+        self.docman.upsert({'_id': 4}, 'test.a', 3)
+        self.docman.commit()
+        self.docman.finish_idle_resyncs(0)
+        second = self.elastic.indices.aliases['test']
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(self.elastic.docs), [
+            (second, 'a', '2'), (second, 'a', '4'), (second, 'b', '3')])
+        self.assertEqual(list(self.elastic.indices.indices), [second])
+
+    def test_live_writes_during_copy(self):
+        """Test that the documents written by live operations while the
+        other collections are copied keep their newest version."""
+        self.elastic.indices.create('test', {'mappings': {'a': {}, 'b': {}}})
+        self.elastic.docs[('test', 'b', '1')] = {'n': 0}
+        self.elastic.docs[('test', 'b', '2')] = {'n': 0}
+        self.docman.bulk_upsert([{'_id': 1}], 'test.a', 1)
+        search = self.elastic.search
+
+        def search_during_writes(*args, **kwargs):
+            # The copy reads the documents before the live operations
+            resp = search(*args, **kwargs)
+            self.docman.upsert({'_id': 1, 'n': 1}, 'test.b', 2)
+            self.docman.remove(2, 'test.b', 3)
+            self.docman.send_buffered_operations()
+            return resp
+
+        self.elastic.search = search_during_writes
+        self.docman.finish_idle_resyncs(0)
+        shadow = self.elastic.indices.aliases['test']
+        self.assertEqual(self.elastic.docs, {
+            (shadow, 'a', '1'): {}, (shadow, 'b', '1'): {'n': 1}})
+
+    def test_drop_database_aborts(self):
+        """Test that dropping the database drops the shadow index."""
+        self.docman.bulk_upsert([{'_id': 1}], 'test.coll', 1)
+        shadow = self.docman._resyncs['test'].shadow
+        self.docman.handle_command({'dropDatabase': 1}, 'test.$cmd', 2)
+        self.assertEqual(self.docman._resyncs, {})
+        self.assertNotIn(shadow, self.elastic.indices.indices)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the meta index retention of the Elastic2 DocManager."""
+import sys
+import threading
+import time
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_doc_manager import (
+    MetaIndexRetention)
+
+from tests import unittest
+from tests.fakes import FakeSearchElasticsearch, fake_doc_manager
+
+DAY = 24 * 60 * 60
+
+
+class FakeMetaElasticsearch(FakeSearchElasticsearch):
+    """Stand-in for Elasticsearch storing meta entries, with range
+    queries."""
+
+    def __init__(self, meta_index_name):
+        # Meta entries are only skipped for another meta index name
+        super(FakeMetaElasticsearch, self).__init__('unused')
+
+    def search(self, index, body=None, doc_type=None, **kwargs):
+        (field, spec), = body['query']['range'].items()
+        hits = [{'_index': key[0], '_type': key[1], '_id': key[2]}
+                for key, source in sorted(self.docs.items())
+                if key[0] == index and key[1] == doc_type and
+                source[field] < spec['lt']]
+        return {'_scroll_id': 'scroll', 'hits': {'hits': hits},
+                '_shards': {'successful': 1, 'total': 1}}
+
+
+class TestMetaIndexRetention(unittest.TestCase):
+    """Tests of the deletion of expired meta entries."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(FakeMetaElasticsearch)
+        self.elastic = self.docman.elastic
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_prune(self):
+        """Test that expired entries are deleted from a meta index which is
+        not partitioned."""
+        now = time.time()
+        for i in range(3):
+            self.docman.upsert({'_id': i}, 'test.test',
+                               int(now - (3 - i) * DAY) << 32)
+        self.docman.commit()
+        meta = self.docman.meta_index_name
+        self.assertEqual(len([key for key in self.elastic.docs
+                              if key[0] == meta]), 3)
+
+        self.docman.meta_index_retention = 1.5 * DAY
+        self.docman.prune_meta_index(now)
+        self.assertEqual(sorted(key for key in self.elastic.docs
+                                if key[0] == meta),
+                         [(meta, self.docman.meta_type, '2')])
+
+    def test_thread_survives_errors(self):
+        """Test that the retention thread keeps running after an error."""
+        calls = []
+        ran_twice = threading.Event()
+
+        def prune_meta_index():
+            calls.append(1)
+            if len(calls) == 1:
+                raise AttributeError('delete_by_query')
+            ran_twice.set()
+
+        self.docman.prune_meta_index = prune_meta_index
+        retention = MetaIndexRetention(self.docman, interval=0)
+        retention.start()
+        try:
+            self.assertTrue(ran_twice.wait(10))
+        finally:
+            retention.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the shard router of the Elastic2 DocManager."""
+import sys
+
+sys.path[0:0] = [""]
+
+from elasticsearch import exceptions as es_exceptions
+
+from mongo_connector.doc_managers.elastic2_router import (
+    murmur3_hash, shard_id, ShardRouter)
+
+from tests import unittest
+
+
+class FakeIndices(object):
+    def get_settings(self, index, flat_settings):
+        if index == 'missing':
+            raise es_exceptions.NotFoundError(404, 'index_not_found')
+        return {index: {'settings': {'index.number_of_shards': '2'}}}
+
+
+class FakeCluster(object):
+    def state(self, metric, index):
+        shards = {
+            '0': [{'primary': True, 'state': 'STARTED', 'node': 'n0'},
+                  {'primary': False, 'state': 'STARTED', 'node': 'n1'}],
+            '1': [{'primary': False, 'state': 'STARTED', 'node': 'n0'},
+                  {'primary': True, 'state': 'STARTED', 'node': 'n1'}]}
+        return {'routing_table': {'indices': {index: {'shards': shards}}}}
+
+
+class FakeNodes(object):
+    def info(self, node_id, metric):
+        # No address, so the router falls back to the main client
+        return {'nodes': {node_id: {}}}
+
+
+class FakeClient(object):
+    indices = FakeIndices()
+    cluster = FakeCluster()
+    nodes = FakeNodes()
+
+
+class TestShardRouter(unittest.TestCase):
+    """Unit tests for the ShardRouter."""
+
+    def test_murmur3_hash(self):
+        """Test that routing values hash like in Elasticsearch."""
+        self.assertEqual(murmur3_hash('hell') & 0xffffffff, 0x5a0cb7c3)
+        self.assertEqual(murmur3_hash('hello') & 0xffffffff, 0xd7c31989)
+        self.assertEqual(murmur3_hash('hello wo') & 0xffffffff, 0xdf0ca123)
+        self.assertEqual(
+            murmur3_hash('The quick brown fox jumps over the lazy dog') &
+            0xffffffff, 0xe07db09c)
+        # Hashes are signed like Java integers
+        self.assertLess(murmur3_hash('hello'), 0)
+
+    def test_shard_id(self):
+        """Test that negative hashes are mapped to a valid shard."""
+        for number_of_shards in (1, 3, 5):
+            for routing in ('1', '2', 'hello', u'\u00e9t\u00e9'):
+                shard = shard_id(routing, number_of_shards)
+                self.assertTrue(0 <= shard < number_of_shards)
+
+    def test_group(self):
+        """Test that actions are grouped by the node of their primary shard,
+        keeping their order."""
+        router = ShardRouter(FakeClient())
+        actions = [{'_index': 'test', '_id': str(i)} for i in range(20)]
+        actions.append({'_index': 'missing', '_id': '1'})
+        actions.append({'_index': 'test', '_id': '1', '_routing': 'hello'})
+        nodes = dict((action['_id'], router.node_for(action))
+                     for action in actions[:20])
+        self.assertEqual(set(nodes.values()), set(['n0', 'n1']))
+        for action in actions[:20]:
+            expected = 'n%d' % shard_id(action['_id'], 2)
+            self.assertEqual(router.node_for(action), expected)
+        self.assertIsNone(router.node_for(actions[20]))
+        self.assertEqual(router.node_for(actions[21]),
+                         'n%d' % shard_id('hello', 2))
+
+        groups = router.group(actions)
+        grouped = [action for _, group in groups for action in group]
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(grouped, key=actions.index), actions)
+        for _, group in groups:
+            self.assertEqual(sorted(group, key=actions.index), group)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the routing of documents by the Elastic2 DocManager."""
+import sys
+
+sys.path[0:0] = [""]
+
+from elasticsearch import exceptions as es_exceptions
+
+from mongo_connector.doc_managers.elastic2_doc_manager import LRUCache
+
+from tests import unittest
+from tests.fakes import FakeElasticsearch, fake_doc_manager
+
+
+class FakeGetElasticsearch(FakeElasticsearch):
+    """Stand-in for Elasticsearch storing meta entries, with realtime gets
+    and without searches."""
+
+    def __init__(self, meta_index_name):
+        # Meta entries are only skipped for another meta index name
+        super(FakeGetElasticsearch, self).__init__('unused')
+        self.gets = []
+
+    def get(self, index, doc_type, id, realtime=True):
+        self.gets.append((index, doc_type, id, realtime))
+        key = (index, doc_type, id)
+        if key not in self.docs:
+            raise es_exceptions.NotFoundError(404, 'not found')
+        return {'_index': index, '_type': doc_type, '_id': id,
+                'found': True, '_source': dict(self.docs[key])}
+
+    def search(self, **kwargs):
+        raise AssertionError('unexpected search')
+
+
+class TestLRUCache(unittest.TestCase):
+    """Tests of the cache of routing values."""
+
+    def test_eviction(self):
+        """Test that the least recently used entry is evicted."""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+        # Setting an entry again makes it the most recently used
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEqual(cache.get('a'), 4)
+        self.assertIsNone(cache.get('c'))
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key)
+        self.assertEqual(cache.pop('b'), 'b')
+        self.assertEqual(cache.pop('b', 'missing'), 'missing')
+        cache.set('d', 'd')
+        cache.set('e', 'e')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'c')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.set('f', 'f')
+        self.assertEqual(cache.get('f'), 'f')
+
+
+class TestRoutingLookup(unittest.TestCase):
+    """Tests of the routing of updates whose document is not cached."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(FakeGetElasticsearch,
+                                       routing={'test.test': 'user'})
+        self.elastic = self.docman.elastic
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def buffered_routing(self):
+        return self.docman.BulkBuffer.action_buffer[-1].routing
+
+    def test_routing_from_update_spec(self):
+        """Test that an update setting the routing field is routed without
+        looking it up."""
+        for doc_id in ('1', '2'):
+            self.elastic.docs[('test', 'test', doc_id)] = {'user': 'x'}
+        self.docman.update(1, {'$set': {'user': 'a', 'n': 1}},
+                           'test.test', 1)
+        self.assertEqual(self.buffered_routing(), 'a')
+        self.docman.update(2, {'user': 'b'}, 'test.test', 2)
+        self.assertEqual(self.buffered_routing(), 'b')
+        self.assertEqual(self.elastic.gets, [])
+
+    def test_routing_from_meta_entry(self):
+        """Test that the routing of an uncached document is read from its
+        meta entry with a realtime get."""
+        self.docman.upsert({'_id': 1, 'user': 'a'}, 'test.test', 1)
+        self.docman.commit()
+        self.docman.routing_cache.clear()
+        self.docman.update(1, {'$set': {'n': 1}}, 'test.test', 2)
+        self.assertEqual(self.buffered_routing(), 'a')
+        self.assertEqual(self.elastic.gets, [
+            (self.docman.meta_index_name, self.docman.meta_type, '1',
+             True)])
+
+
+    def test_documents_without_routing(self):
+        """Test that full documents without the routing field are routed
+        by _id without any lookup, also when they are removed."""
+        self.docman.bulk_upsert([{'_id': i} for i in range(5)],
+                                'test.test', 1)
+        self.docman.upsert({'_id': 5}, 'test.test', 2)
+        self.assertIsNone(self.buffered_routing())
+        self.assertEqual(self.elastic.gets, [])
+        self.docman.commit()
+        self.docman.remove(5, 'test.test', 3)
+        self.assertIsNone(self.buffered_routing())
+        # The meta entry records that the document is routed by _id
+        self.assertEqual(len(self.elastic.gets), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the shared indices of the Elastic2 DocManager."""
+import logging
+import sys
+
+sys.path[0:0] = [""]
+
+from mongo_connector import errors
+from mongo_connector.command_helper import CommandHelper
+from mongo_connector.doc_managers.elastic2_doc_manager import (
+    DocManager, VERSION_CONFLICT)
+from mongo_connector.doc_managers.elastic2_shared import SharedIndices
+
+from tests import unittest
+from tests.fakes import FakeSearchElasticsearch, fake_doc_manager
+
+
+class ListHandler(logging.Handler):
+    """Logging handler keeping the messages of the records."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestSharedIndices(unittest.TestCase):
+    """Tests of the mapping of namespaces to shared indices."""
+
+    def test_index(self):
+        shared = SharedIndices({'tenants': ['tenant_*.*'],
+                                'small': 'db.coll'})
+        self.assertEqual(shared.index('tenant_1.users'), 'tenants')
+        self.assertEqual(shared.index('db.coll'), 'small')
+        self.assertIsNone(shared.index('db.other'))
+        self.assertEqual(shared.names, ['small', 'tenants'])
+
+    def test_document_id(self):
+        shared = SharedIndices({'tenants': ['tenant_*.*']})
+        doc_id = shared.document_id('tenant_1.users', 'a.b')
+        self.assertEqual(doc_id, 'tenant_1.a.b')
+        self.assertEqual(shared.original_id(doc_id), 'a.b')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, SharedIndices, ['tenant_*.*'])
+        self.assertRaises(ValueError, SharedIndices, {'Tenants': ['a.*']})
+        self.assertRaises(ValueError, SharedIndices, {'tenants': ['a']})
+        self.assertRaises(errors.InvalidConfiguration, DocManager,
+                          'localhost:9200', sharedIndices={'t': ['a']})
+
+
+class TestSharedDocManager(unittest.TestCase):
+    """Tests of the DocManager writing to shared indices."""
+
+    def setUp(self):
+        self.docman = fake_doc_manager(
+            FakeSearchElasticsearch,
+            sharedIndices={'tenants': ['tenant_*.*']})
+        self.elastic = self.docman.elastic
+        self.docman.command_helper = CommandHelper()
+
+    def tearDown(self):
+        self.docman.stop()
+
+    def test_upsert(self):
+        """Test that documents with the same _id in different databases
+        are stored in the shared index with their namespace."""
+        self.docman.upsert({'_id': 1, 'n': 1}, 'tenant_1.users', 1)
+        operation = self.docman.BulkBuffer.action_buffer[0]
+        _, meta_action = self.docman._bulk_actions(operation)
+        # Rollbacks look up the MongoDB _id in the meta index
+        self.assertEqual(meta_action['_id'], '1')
+        self.docman.bulk_upsert([{'_id': 1, 'n': 2}], 'tenant_2.users', 2)
+        self.docman.upsert({'_id': 1, 'n': 3}, 'other.users', 3)
+        self.docman.commit()
+        self.assertEqual(self.elastic.docs, {
+            ('tenants', 'users', 'tenant_1.1'): {
+                'n': 1, 'mongodb_ns': 'tenant_1.users'},
+            ('tenants', 'users', 'tenant_2.1'): {
+                'n': 2, 'mongodb_ns': 'tenant_2.users'},
+            ('other', 'users', '1'): {'n': 3}})
+        self.assertEqual(
+            self.elastic.indices.mappings[('tenants', 'users')],
+            {'properties': {'mongodb_ns': {'type': 'keyword'}}})
+        self.assertEqual(self.elastic.indices.aliases['tenant_1.users'], (
+            'tenants', {'filter': {'term': {'mongodb_ns': 'tenant_1.users'}}}))
+
+    def test_update_and_remove(self):
+        """Test updates and removals of documents in a shared index."""
+        self.elastic.docs[('tenants', 'users', 'tenant_1.1')] = {
+            'n': 1, 'mongodb_ns': 'tenant_1.users'}
+        self.docman.update(1, {'$set': {'n': 2}}, 'tenant_1.users', 1)
+        self.docman.upsert({'_id': 2}, 'tenant_1.users', 2)
+        self.docman.update(2, {'_id': 2, 'n': 3}, 'tenant_1.users', 3)
+        self.docman.commit()
+        self.assertEqual(self.elastic.docs, {
+            ('tenants', 'users', 'tenant_1.1'): {
+                'n': 2, 'mongodb_ns': 'tenant_1.users'},
+            ('tenants', 'users', 'tenant_1.2'): {
+                'n': 3, 'mongodb_ns': 'tenant_1.users'}})
+        self.docman.remove(1, 'tenant_1.users', 4)
+        self.docman.commit()
+        self.assertEqual(list(self.elastic.docs),
+                         [('tenants', 'users', 'tenant_1.2')])
+
+    def test_checkpoint_of_split_buffer(self):
+        """Test that the checkpoint of a buffer split for a command keeps
+        the MongoDB _id."""
+        self.docman.upsert({'_id': 1}, 'tenant_1.users', 1)
+        self.docman.upsert({'_id': 2}, 'tenant_1.groups', 2)
+        part = self.docman.BulkBuffer.split(
+            lambda index, doc_type: doc_type == 'users')
+        self.assertEqual(part.checkpoint['_id'], '1')
+        self.assertEqual(self.docman.BulkBuffer.checkpoint['_id'], '2')
+        self.docman.BulkBuffer.merge(part)
+        self.assertEqual(self.docman.BulkBuffer.checkpoint['_id'], '2')
+
+    def test_stale_write_logged(self):
+        """Test that a write ignored because of its external version is
+        logged with its namespace and MongoDB _id."""
+        def bulk(body, filter_path=None):
+            reason = ('[users][tenant_1.1]: version conflict, current '
+                      'version [5] is higher or equal to the one '
+                      'provided [3]')
+            return {'errors': True, 'items': [
+                {'index': {'error': {'type': VERSION_CONFLICT,
+                                     'reason': reason,
+                                     'index': 'tenants'}}},
+                {'index': {'error': {'type': VERSION_CONFLICT,
+                                     'reason': reason,
+                                     'index': self.docman.meta_index_name}}}]}
+
+        self.elastic.bulk = bulk
+        handler = ListHandler()
+        logger = logging.getLogger(
+            'mongo_connector.doc_managers.elastic2_doc_manager')
+        logger.addHandler(handler)
+        try:
+            self.docman.upsert({'_id': 1}, 'tenant_1.users', 3)
+            self.docman.commit()
+        finally:
+            logger.removeHandler(handler)
+        warnings = [message for message in handler.messages
+                    if 'older than' in message]
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('document 1 in tenant_1.users', warnings[0])
+
+    def test_drop(self):
+        """Test that dropping a collection only deletes its documents."""
+        self.docman.upsert({'_id': 1}, 'tenant_1.users', 1)
+        self.docman.upsert({'_id': 1}, 'tenant_1.groups', 2)
+        self.docman.upsert({'_id': 1}, 'tenant_2.users', 3)
+        self.docman.handle_command({'drop': 'users'}, 'tenant_1.$cmd', 4)
+        # The operations on other namespaces are still buffered
+        self.docman.commit()
+        self.assertEqual(sorted(self.elastic.docs), [
+            ('tenants', 'groups', 'tenant_1.1'),
+            ('tenants', 'users', 'tenant_2.1')])
+
+    def test_drop_database(self):
+        """Test that dropping a database deletes its documents and
+        aliases."""
+        self.docman.upsert({'_id': 1}, 'tenant_1.users', 1)
+        self.docman.upsert({'_id': 1}, 'tenant_1.groups', 2)
+        self.docman.upsert({'_id': 1}, 'tenant_2.users', 3)
+        self.docman.handle_command({'dropDatabase': 1}, 'tenant_1.$cmd', 4)
+        self.assertEqual(list(self.elastic.docs),
+                         [('tenants', 'users', 'tenant_2.1')])
+        self.assertEqual(list(self.elastic.indices.aliases),
+                         ['tenant_2.users'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests of the offline file sink of the Elastic2 DocManager."""
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path[0:0] = [""]
+
+from mongo_connector import errors
+from mongo_connector.command_helper import CommandHelper
+from mongo_connector.doc_managers.elastic2_doc_manager import DocManager
+from mongo_connector.doc_managers.elastic2_sink import (
+    MAPPINGS_FILE, Sink, load, sink_files)
+
+from tests import unittest
+from tests.fakes import (
+    FakeElasticsearch, FakeSharedIndices, fake_doc_manager)
+
+BODY = b'{"index": {"_index": "db", "_type": "coll", "_id": "1"}}\n{}\n'
+
+
+class TestSink(unittest.TestCase):
+    """Tests of the files written by the sink."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rotation(self):
+        """Test that files are rotated, and only complete files are
+        listed."""
+        sink = Sink(self.directory, file_size=len(BODY) * 2)
+        for _ in range(3):
+            sink.write(BODY)
+        self.assertEqual(len(sink_files(self.directory)), 1)
+        sink.close()
+        files = sink_files(self.directory)
+        self.assertEqual(len(files), 2)
+        self.assertEqual(sink.stats(), {'files': 2, 'bytes': len(BODY) * 3,
+                                        'requests': 3})
+        # A new sink continues the numbering of the existing files
+        sink = Sink(self.directory)
+        sink.write(BODY)
+        sink.close()
+        self.assertEqual(sink_files(self.directory)[:2], files)
+        self.assertEqual(len(sink_files(self.directory)), 3)
+
+    def test_compression(self):
+        """Test that compressed files are loaded."""
+        sink = Sink(self.directory, compress_level=1)
+        sink.write(BODY)
+        sink.close()
+        path, = sink_files(self.directory)
+        self.assertTrue(path.endswith('.ndjson.gz'))
+        elastic = FakeElasticsearch('mongodb_meta')
+        report = load(elastic, self.directory)
+        self.assertEqual(report['actions'], 1)
+        self.assertEqual(elastic.docs, {('db', 'coll', '1'): {}})
+
+
+class TestSinkDocManager(unittest.TestCase):
+    """Tests of the DocManager writing to the sink and of the loader."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.docman = fake_doc_manager(chunk_size=2,
+                                       sinkDirectory=self.directory)
+        self.offline = self.docman.elastic
+        # Any request reaching Elasticsearch fails
+        self.offline.bulk = self.offline.mget = self.offline.index = None
+        self.docman.command_helper = CommandHelper()
+
+    def tearDown(self):
+        self.docman.stop()
+        shutil.rmtree(self.directory)
+
+    def test_invalid(self):
+        self.assertRaises(errors.InvalidConfiguration, DocManager,
+                          'localhost:9200', sinkDirectory=self.directory,
+                          sharedIndices={'t': ['a.*']})
+
+    def test_load(self):
+        """Test that loading the files applies the actions in order."""
+        self.docman.bulk_upsert([{'_id': i, 'n': 0} for i in range(10)],
+                                'db.coll', 1)
+        for i in range(10):
+            self.docman.update(i, {'$set': {'n': 1}}, 'db.coll', 2)
+        for i in range(5):
+            self.docman.remove(i, 'db.coll', 3)
+        self.docman.upsert({'_id': 'a', 'n': 2}, 'db.coll', 4)
+        self.docman.commit()
+        self.docman._put_mapping('db', 'coll', {
+            'properties': {'n': {'type': 'long'}}})
+        self.docman.stop()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, MAPPINGS_FILE)))
+        stats = self.docman.stats()['sink']
+        self.assertEqual(stats['files'], 1)
+
+        elastic = FakeElasticsearch(self.docman.meta_index_name)
+        elastic.indices = FakeSharedIndices()
+        report = load(elastic, self.directory, concurrency=4, chunk_size=3)
+        self.assertEqual(report['failures'], 0)
+        self.assertEqual(report['mappings'], 1)
+        self.assertGreater(report['requests'], 4)
+        # The updates of documents which were not buffered with their
+        # source are partial updates
+        expected = dict((('db', 'coll', str(i)), {'n': 1})
+                        for i in range(5, 10))
+        expected[('db', 'coll', 'a')] = {'n': 2}
+        self.assertEqual(elastic.docs, expected)
+        self.assertIn(('db', 'coll'), elastic.indices.mappings)
+
+    def test_partial_updates(self):
+        """Test that updates of documents which are not buffered are
+        written as partial updates, or as the document."""
+        self.docman.bulk_upsert([{'_id': i, 'a': {'b': 0, 'c': 0}, 'd': 0}
+                                 for i in range(3)], 'db.coll', 1)
+        self.docman.update(0, {'$set': {'a.b': 1}, '$unset': {'d': 1}},
+                           'db.coll', 2)
+        self.docman.update(1, {'e': 1}, 'db.coll', 3)
+        self.assertRaises(errors.OperationFailed, self.docman.update, 2,
+                          {'$set': {'list.0': 1}}, 'db.coll', 4)
+        self.docman.stop()
+        elastic = FakeElasticsearch(self.docman.meta_index_name)
+        load(elastic, self.directory)
+        self.assertEqual(elastic.docs, {
+            ('db', 'coll', '0'): {'a': {'b': 1, 'c': 0}, 'd': None},
+            ('db', 'coll', '1'): {'e': 1},
+            ('db', 'coll', '2'): {'a': {'b': 0, 'c': 0}, 'd': 0}})
+
+    def test_drop_ignored(self):
+        """Test that commands deleting documents are not written."""
+        self.docman.upsert({'_id': 1}, 'db.coll', 1)
+        self.docman.handle_command({'drop': 'coll'}, 'db.$cmd', 2)
+        self.docman.commit()
+        self.docman.stop()
+        elastic = FakeElasticsearch(self.docman.meta_index_name)
+        load(elastic, self.directory)
+        self.assertEqual(elastic.docs, {('db', 'coll', '1'): {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the on-disk spool of the Elastic2 DocManager."""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from elasticsearch import exceptions as es_exceptions
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_spool import Spool
+
+from tests import unittest
+from tests.fakes import FakeElasticsearch, FakeIndices, fake_doc_manager
+
+
+class UnavailableIndices(FakeIndices):
+    def __init__(self, elastic):
+        super(UnavailableIndices, self).__init__()
+        self.elastic = elastic
+
+    def refresh(self, index=None, ignore_unavailable=False):
+        self.elastic.check_available()
+        self.refreshes += 1
+
+
+class UnavailableElasticsearch(FakeElasticsearch):
+    """Stand-in for Elasticsearch which can be made unavailable."""
+
+    def __init__(self, meta_index_name):
+        super(UnavailableElasticsearch, self).__init__(meta_index_name)
+        self.indices = UnavailableIndices(self)
+        self.available = True
+
+    def check_available(self):
+        if not self.available:
+            raise es_exceptions.ConnectionError(
+                'N/A', 'Connection refused', Exception())
+
+    def bulk(self, body, filter_path=None):
+        self.check_available()
+        return super(UnavailableElasticsearch, self).bulk(body, filter_path)
+
+    def mget(self, body, realtime=True):
+        self.check_available()
+        return super(UnavailableElasticsearch, self).mget(body, realtime)
+
+
+class TestSpool(unittest.TestCase):
+    """Unit tests for the Spool."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.spool'))
+
+    def test_append_and_consume(self):
+        """Test that records are replayed in order across segments."""
+        spool = Spool(self.directory, segment_size=64)
+        self.assertFalse(spool.pending())
+        self.assertIsNone(spool.peek())
+        records = [('record %d' % i).encode('utf8') * 3 for i in range(5)]
+        for record in records:
+            spool.append(record)
+        self.assertTrue(spool.pending())
+        self.assertGreater(len(self._segments()), 1)
+
+        for record in records:
+            self.assertEqual(spool.peek(), record)
+            # Peeking twice returns the same record
+            self.assertEqual(spool.peek(), record)
+            spool.consume()
+        self.assertFalse(spool.pending())
+        self.assertIsNone(spool.peek())
+        # Replayed segments are removed
+        self.assertEqual(len(self._segments()), 1)
+        spool.close()
+
+    def test_large_record(self):
+        """Test that a record larger than a segment gets its own segment."""
+        spool = Spool(self.directory, segment_size=16)
+        record = b'x' * 100
+        spool.append(record)
+        spool.append(b'small')
+        self.assertEqual(spool.peek(), record)
+        spool.consume()
+        self.assertEqual(spool.peek(), b'small')
+        spool.close()
+
+    def test_reopen(self):
+        """Test that a reopened spool resumes after the consumed records."""
+        spool = Spool(self.directory, segment_size=64)
+        for i in range(4):
+            spool.append(('record %d' % i).encode('utf8'))
+        spool.peek()
+        spool.consume()
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=64)
+        self.assertTrue(spool.pending())
+        self.assertEqual(spool.peek(), b'record 1')
+        spool.append(b'record 4')
+        replayed = []
+        while spool.pending():
+            replayed.append(spool.peek())
+            spool.consume()
+        self.assertEqual(replayed, [b'record 1', b'record 2', b'record 3',
+                                    b'record 4'])
+        spool.close()
+
+
+class TestSpoolDocManager(unittest.TestCase):
+    """Tests of the DocManager while Elasticsearch is unavailable."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.docman = fake_doc_manager(UnavailableElasticsearch, chunk_size=2,
+                                       spoolDirectory=self.directory,
+                                       spoolReplayInterval=0.05,
+                                       spoolMaxHeldOperations=4)
+        self.elastic = self.docman.elastic
+
+    def tearDown(self):
+        self.elastic.available = True
+        self.docman.stop()
+        shutil.rmtree(self.directory)
+
+    def test_no_refresh_while_spooled(self):
+        """Test that full buffers are spooled without refreshing."""
+        self.elastic.available = False
+        start = time.time()
+        for i in range(10):
+            self.docman.upsert({'_id': i}, 'test.test', i + 1)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(self.docman.spool.pending())
+        self.assertEqual(self.elastic.indices.refreshes, 0)
+
+        self.elastic.available = True
+        self.docman._spool_retry_at = 0
+        self.docman.commit()
+        self.assertFalse(self.docman.spool.pending())
+        self.assertEqual(len(self.elastic.docs), 10)
+        self.assertEqual(self.elastic.indices.refreshes, 1)
+
+    def test_held_operations_bounded(self):
+        """Test that the operations held back because of updates wait for
+        the spool to be replayed once they reach the limit."""
+        self.docman.upsert({'_id': 0, 'n': 0}, 'test.test', 1)
+        self.docman.commit()
+        self.elastic.available = False
+        self.docman.upsert({'_id': 1}, 'test.test', 2)
+        self.docman.upsert({'_id': 2}, 'test.test', 3)
+        self.assertTrue(self.docman.spool.pending())
+
+        recovery = threading.Timer(
+            0.5, lambda: setattr(self.elastic, 'available', True))
+        recovery.start()
+        for i in range(6):
+            self.docman.update(0, {'$set': {'n': i + 1}}, 'test.test', i + 4)
+        recovery.join()
+        self.assertFalse(self.docman.spool.pending())
+        self.assertLess(len(self.docman.BulkBuffer.action_buffer), 4)
+        self.docman.commit()
+        self.assertEqual(self.elastic.docs[('test', 'test', '0')], {'n': 6})
+        self.assertEqual(len(self.elastic.docs), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+# Copyright 2016 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrency stress tests of the Elastic2 DocManager.
+
+Producer threads send mixed operations to one DocManager while another
+thread keeps flushing its buffers, like the AutoCommiter does. Requests go
+to an in-memory stand-in for Elasticsearch, so that the final state, the
+number of writes of each document, and the time spent waiting for buffer
+locks can be checked without a cluster.
+
+Run this module directly to print a benchmark of the throughput and lock
+wait time for several numbers of threads and buffer shards::
+
+  python -m tests.test_elastic2_stress
+"""
+import itertools
+import random
+import sys
+import threading
+import time
+
+sys.path[0:0] = [""]
+
+from mongo_connector.doc_managers.elastic2_doc_manager import SingleFlight
+
+from tests import unittest
+from tests.fakes import fake_doc_manager
+
+
+class TimedLock(object):
+    """Lock measuring the time spent waiting to acquire it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait = 0.0
+        self.acquisitions = 0
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        acquired = self._lock.acquire(blocking)
+        if acquired:
+            self.wait += time.time() - start
+            self.acquisitions += 1
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Producer(threading.Thread):
+    """Thread sending mixed operations on its own documents, and tracking
+    the state they should end up in."""
+
+    def __init__(self, docman, number, operations, keys, namespaces,
+                 timestamps):
+        super(Producer, self).__init__()
+        self.docman = docman
+        self.number = number
+        self.operations = operations
+        self.keys = keys
+        self.namespaces = namespaces
+        self.timestamps = timestamps
+        self.rng = random.Random(number)
+        # Format: {(namespace, _id): source}
+        self.expected = {}
+        # Format: {(namespace, _id): number of operations}
+        self.issued = {}
+        self.error = None
+
+    def run(self):
+        try:
+            for i in range(self.operations):
+                self.operate(i)
+        except Exception as exc:
+            self.error = exc
+
+    def operate(self, i):
+        namespace = self.rng.choice(self.namespaces)
+        doc_id = '%d-%d' % (self.number, self.rng.randrange(self.keys))
+        key = (namespace, doc_id)
+        timestamp = next(self.timestamps)
+        choice = self.rng.random()
+        if key not in self.expected or choice < 0.3:
+            doc = {'_id': doc_id, 'producer': self.number, 'value': i}
+            self.docman.upsert(doc, namespace, timestamp)
+            self.expected[key] = {'producer': self.number, 'value': i}
+        elif choice < 0.9:
+            self.docman.update(doc_id, {'$set': {'value': i}}, namespace,
+                               timestamp)
+            self.expected[key]['value'] = i
+        else:
+            self.docman.remove(doc_id, namespace, timestamp)
+            del self.expected[key]
+        self.issued[key] = self.issued.get(key, 0) + 1
+
+
+class Flusher(threading.Thread):
+    """Thread flushing the buffers as often as possible, standing in for
+    the AutoCommiter."""
+
+    def __init__(self, docman):
+        super(Flusher, self).__init__()
+        self.docman = docman
+        self.stopped = False
+        self.flushes = 0
+
+    def run(self):
+        while not self.stopped:
+            self.docman.send_buffered_operations()
+            self.flushes += 1
+            time.sleep(0.001)
+
+
+def stress(threads, operations=2000, keys=50, shards=1, chunk_size=100,
+           namespaces=('test.a', 'test.b', 'test.c', 'test.d')):
+    """Run producers against one DocManager and collect the results.
+
+    Returns a dict of the throughput, the lock wait time, the lost and
+    duplicated writes, and the documents which do not have their expected
+    source in the stand-in Elasticsearch.
+    """
+    docman = fake_doc_manager(chunk_size=chunk_size, bulkBufferShards=shards)
+    elastic = docman.elastic
+    locks = []
+    for buf in docman.buffer_shards:
+        buf.lock = TimedLock()
+        locks.append(buf.lock)
+    docman.lock = docman.BulkBuffer.lock
+
+    timestamps = itertools.count(1 << 32)
+    producers = [Producer(docman, number, operations, keys, namespaces,
+                          timestamps)
+                 for number in range(threads)]
+    flusher = Flusher(docman)
+    start = time.time()
+    flusher.start()
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    elapsed = time.time() - start
+    flusher.stopped = True
+    flusher.join()
+    docman.commit()
+    docman.stop()
+
+    errors = [producer.error for producer in producers if producer.error]
+    expected, issued = {}, {}
+    for producer in producers:
+        for (namespace, doc_id), source in producer.expected.items():
+            index, doc_type = namespace.split('.', 1)
+            expected[(index, doc_type, doc_id)] = source
+        for (namespace, doc_id), count in producer.issued.items():
+            index, doc_type = namespace.split('.', 1)
+            issued[(index, doc_type, doc_id)] = count
+    lost = sum(max(count - elastic.writes.get(key, 0), 0)
+               for key, count in issued.items())
+    duplicated = sum(max(elastic.writes.get(key, 0) - count, 0)
+                     for key, count in issued.items())
+    wrong = sorted(key for key in set(expected) | set(elastic.docs)
+                   if expected.get(key) != elastic.docs.get(key))
+    total = threads * operations
+    return {
+        'threads': threads,
+        'shards': shards,
+        'operations': total,
+        'seconds': elapsed,
+        'ops_per_sec': total / elapsed if elapsed else None,
+        'lock_wait': sum(lock.wait for lock in locks),
+        'lock_acquisitions': sum(lock.acquisitions for lock in locks),
+        'bulk_requests': elastic.requests,
+        'flushes': flusher.flushes,
+        'lost': lost,
+        'duplicated': duplicated,
+        'wrong': wrong,
+        'errors': errors,
+    }
+
+
+class TestStress(unittest.TestCase):
+    """Concurrency stress tests of the DocManager."""
+
+    def assertConsistent(self, report):
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['lost'], 0)
+        self.assertEqual(report['duplicated'], 0)
+        self.assertEqual(report['wrong'], [])
+
+    def test_single_buffer(self):
+        """Test concurrent producers sharing one buffer."""
+        self.assertConsistent(stress(threads=8, operations=500))
+
+    def test_sharded_buffers(self):
+        """Test concurrent producers with buffers sharded by namespace."""
+        self.assertConsistent(stress(threads=8, operations=500, shards=4))
+
+    def test_flush_on_full_buffer(self):
+        """Test producers flushing buffers which fill up concurrently."""
+        self.assertConsistent(stress(threads=4, operations=500,
+                                     chunk_size=5))
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Tests of the coalescing of concurrent flushes."""
+
+    def test_concurrent_callers(self):
+        """Test that callers arriving during a run share the next one."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def func():
+            started.set()
+            release.wait()
+
+        flight = SingleFlight(func)
+        first = threading.Thread(target=flight)
+        first.start()
+        started.wait()
+        others = [threading.Thread(target=flight) for _ in range(8)]
+        for thread in others:
+            thread.start()
+        while flight.calls < 9:
+            time.sleep(0.001)
+        release.set()
+        for thread in [first] + others:
+            thread.join()
+        self.assertEqual(flight.runs, 2)
+
+    def test_shared_error(self):
+        """Test that the callers sharing a run get its exception."""
+        release = threading.Event()
+        errors = []
+
+        def func():
+            release.wait()
+            raise ValueError('failed')
+
+        def call():
+            try:
+                flight()
+            except ValueError as exc:
+                errors.append(exc)
+
+        flight = SingleFlight(func)
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while flight.calls < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(flight.runs, 2)
+
+    def test_refresh_window(self):
+        """Test that refreshes within refreshWindow are skipped."""
+        docman = fake_doc_manager(refreshWindow=60)
+        try:
+            for i in range(3):
+                docman.upsert({'_id': i}, 'test.test', 1)
+                docman.commit()
+            self.assertEqual(docman.elastic.indices.refreshes, 1)
+            self.assertEqual(len(docman.elastic.docs), 3)
+        finally:
+            docman.refresh_window = 0
+            docman.stop()
+        self.assertEqual(docman.elastic.indices.refreshes, 2)
+
+
+def main():
+    print('%7s %6s %10s %12s %8s %8s %10s' % (
+        'threads', 'shards', 'ops/sec', 'lock wait s', 'bulks', 'lost',
+        'duplicated'))
+    for shards in (1, 4):
+        for threads in (1, 2, 4, 8, 16):
+            report = stress(threads, shards=shards)
+            print('%7d %6d %10.0f %12.3f %8d %8d %10d' % (
+                threads, shards, report['ops_per_sec'], report['lock_wait'],
+                report['bulk_requests'], report['lost'],
+                report['duplicated']))
+
+
+if __name__ == '__main__':
+    main()